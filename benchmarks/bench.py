@@ -0,0 +1,213 @@
+#!/usr/bin/python
+from benchmarks.fakes import FakeElasticsearch, FakeDriver
+from benchmarks.synthetic import generate_docs
+from source.elastic import ElasticScroller
+from source.neo import GraphBuilder
+from source.serializer import FastJSONSerializer
+from source.columnar import ColumnarExtractor
+from yaml import full_load
+from time import perf_counter
+import tracemalloc
+import logging
+import getopt
+import json
+import sys
+from os.path import dirname, join
+
+logger = logging.getLogger('elastic2neo.benchmarks')
+
+DEFAULT_MAPPING = join(dirname(__file__), "mapping.yaml")
+DEFAULT_BASELINE = join(dirname(__file__), "baseline.json")
+STAGES = ["fetch", "decode", "process", "generate", "columnar", "write", "pipeline"]
+
+
+def _measure(func):
+    """
+    Runs the function once for timing and once under tracemalloc for peak memory.
+    :param func: function without arguments
+    :return: tuple of the function result, elapsed seconds and peak memory in bytes
+    """
+    start = perf_counter()
+    result = func()
+    elapsed = perf_counter() - start
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def run(mapping, docs=10000, scroll_size=1000, chunk_size=1000, batch_size=100, width=10, nesting=2,
+        iterator_length=3, cardinality=1000, processors=False, decoder='auto'):
+    """
+    Runs every stage of the pipeline against synthetic documents and local stand-ins for Elasticsearch and Neo4j.
+    :param mapping: mapping as a dictionary
+    :param docs: number of synthetic documents
+    :param scroll_size: documents per scroll page
+    :param chunk_size: the builder chunk size
+    :param batch_size: statements per write transaction
+    :param width: unmapped fields per level of each document
+    :param nesting: levels of unmapped nested data in each document
+    :param iterator_length: items in every iterator array
+    :param cardinality: distinct values per mapped field
+    :param processors: should the processors folder be loaded?
+    :param decoder: the JSON decoder used for the responses (auto, orjson, ujson or json)
+    :return: dictionary of stage name to results
+    """
+    sources = generate_docs(mapping, docs, width=width, nesting=nesting, iterator_length=iterator_length,
+                            cardinality=cardinality)
+
+    serializer = FastJSONSerializer(decoder)
+    responses = [json.dumps({"_scroll_id": "bench", "hits": {"hits": [
+        {"_index": "bench", "_id": str(i), "_source": sources[i]}
+        for i in range(position, min(position + scroll_size, len(sources)))]}}).encode("utf-8")
+        for position in range(0, len(sources), scroll_size)]
+
+    def fetch():
+        scroller = ElasticScroller("localhost", 9200, mapping['index'], size=scroll_size,
+                                   client=FakeElasticsearch(mapping['index'], sources, serializer=serializer))
+        pages = list()
+        page = scroller.scroll()
+        while page:
+            pages.append(page)
+            page = scroller.scroll()
+        return pages
+
+    def decode():
+        return [serializer.loads(response) for response in responses]
+
+    builder = GraphBuilder(None, None, None, mapping, pre=processors, post_node=processors,
+                           post_relationship=processors, chunk_size=chunk_size, batch_size=batch_size,
+                           driver=FakeDriver())
+
+    def process():
+        return [chunk for page in pages for chunk in builder._process(page)]
+
+    def generate():
+        return list(builder._gen_statements(chunks))
+
+    extractor = ColumnarExtractor(builder, mapping)
+
+    def columnar():
+        for page in pages:
+            for i in range(0, len(page), chunk_size):
+                extractor.rows([doc['_source'] for doc in page[i:i + chunk_size]])
+
+    def write():
+        for node_statements, relationship_statements in statements:
+            builder._execute_statements(node_statements, relationship_statements)
+
+    def pipeline():
+        for page in pages:
+            builder.build(page)
+
+    pages, fetch_seconds, fetch_peak = _measure(fetch)
+    _, decode_seconds, decode_peak = _measure(decode)
+    chunks, process_seconds, process_peak = _measure(process)
+    statements, generate_seconds, generate_peak = _measure(generate)
+    statement_count = sum(len(n) + len(r) for n, r in statements)
+    _, columnar_seconds, columnar_peak = _measure(columnar)
+    _, write_seconds, write_peak = _measure(write)
+    _, pipeline_seconds, pipeline_peak = _measure(pipeline)
+    builder.close()
+    results = dict()
+    for stage, seconds, peak in [("fetch", fetch_seconds, fetch_peak), ("decode", decode_seconds, decode_peak),
+                                 ("process", process_seconds, process_peak),
+                                 ("generate", generate_seconds, generate_peak),
+                                 ("columnar", columnar_seconds, columnar_peak),
+                                 ("write", write_seconds, write_peak), ("pipeline", pipeline_seconds, pipeline_peak)]:
+        results[stage] = {"seconds": seconds, "docsPerSec": docs / seconds if seconds else 0,
+                          "statementsPerSec": statement_count / seconds if seconds else 0,
+                          "peakBytes": peak}
+    return results
+
+
+def _report(results, baseline=None, tolerance=0.2):
+    """
+    Prints the results and compares them against a baseline.
+    :param results: dictionary of stage name to results
+    :param baseline: dictionary of stage name to baseline results
+    :param tolerance: the fraction docs/sec may drop below the baseline before it is a regression
+    :return: list of regressed stages
+    """
+    regressions = list()
+    print("{:<10}{:>12}{:>14}{:>18}{:>14}{:>12}".format("stage", "seconds", "docs/sec", "statements/sec",
+                                                         "peak MiB", "vs base"))
+    for stage in STAGES:
+        result = results[stage]
+        delta = ""
+        if baseline and stage in baseline and baseline[stage]["docsPerSec"]:
+            change = result["docsPerSec"] / baseline[stage]["docsPerSec"] - 1
+            delta = "{:+.1%}".format(change)
+            if change < -tolerance:
+                regressions.append(stage)
+                delta += " !"
+        print("{:<10}{:>12.3f}{:>14.0f}{:>18.0f}{:>14.2f}{:>12}".format(
+            stage, result["seconds"], result["docsPerSec"], result["statementsPerSec"],
+            result["peakBytes"] / 1048576, delta))
+    return regressions
+
+
+def _usage():
+    """
+    Prints the usage reminder
+    """
+    print("usage: python -m benchmarks.bench [-M MappingFile] [-n Docs] [-s ScrollSize] [-c ChunkSize] [-b BatchSize]"
+          " [-w Width] [-N Nesting] [-i IteratorLength] [-k Cardinality] [-B BaselineFile] [-t Tolerance] [-S] [-p]"
+          " [-j Decoder] [-h]")
+
+
+def main(argv):
+    """
+    Main function, parses commandline options and runs the benchmark.
+    :param argv: argv from system
+    """
+    try:
+        opts, args = getopt.getopt(argv, "M:n:s:c:b:w:N:i:k:B:t:Sj:ph", [])
+    except getopt.GetoptError:
+        _usage()
+        exit(1)
+    mapping_file = DEFAULT_MAPPING
+    baseline_file = DEFAULT_BASELINE
+    tolerance = 0.2
+    save = False
+    options = dict()
+    for opt, arg in opts:
+        if opt == '-h':
+            _usage()
+            exit(0)
+        elif opt == '-M':
+            mapping_file = arg
+        elif opt == '-B':
+            baseline_file = arg
+        elif opt == '-t':
+            tolerance = float(arg)
+        elif opt == '-S':
+            save = True
+        elif opt == '-p':
+            options['processors'] = True
+        elif opt == '-j':
+            options['decoder'] = arg
+        else:
+            name = {'-n': 'docs', '-s': 'scroll_size', '-c': 'chunk_size', '-b': 'batch_size', '-w': 'width',
+                    '-N': 'nesting', '-i': 'iterator_length', '-k': 'cardinality'}[opt]
+            options[name] = int(arg)
+    mapping = full_load(open(mapping_file).read())
+    results = run(mapping, **options)
+    baseline = None
+    try:
+        baseline = json.load(open(baseline_file))
+    except IOError:
+        print("no baseline found at {}".format(baseline_file))
+    regressions = _report(results, baseline, tolerance)
+    if save:
+        with open(baseline_file, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("saved baseline to {}".format(baseline_file))
+    elif regressions:
+        print("regressions: {}".format(", ".join(regressions)))
+        exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
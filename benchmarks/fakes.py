@@ -0,0 +1,136 @@
+from source.serializer import FastJSONSerializer
+import json
+import logging
+
+module_logger = logging.getLogger('elastic2neo.benchmarks.fakes')
+module_logger.debug("module loaded")
+
+
+class _FakeIndices:
+    def __init__(self, indices):
+        """
+        Stand-in for the indices namespace of the Elasticsearch client.
+        :param indices: the names of the indices that exist
+        """
+        self._indices = indices
+
+    def exists(self, index):
+        return index in self._indices
+
+
+class FakeElasticsearch:
+    def __init__(self, index, docs, serializer=None):
+        """
+        Local stand-in for the Elasticsearch client that serves documents through the scroll API. Pages are stored as
+        JSON bytes and decoded on every request so that response decoding is part of the measured fetch cost.
+        :param index: the name of the index
+        :param docs: list of document sources
+        :param serializer: the serializer responses are decoded with, defaults to a FastJSONSerializer
+        """
+        self.indices = _FakeIndices([index])
+        self._docs = docs
+        self._serializer = serializer if serializer else FastJSONSerializer()
+        self._scrolls = dict()
+
+    def _page(self, scroll_id):
+        """
+        Serve the next page of the given scroll.
+        :param scroll_id: the scroll id
+        :return: the decoded response
+        """
+        position, size = self._scrolls[scroll_id]
+        hits = [{"_index": "bench", "_id": str(i), "_source": self._docs[i]}
+                for i in range(position, min(position + size, len(self._docs)))]
+        self._scrolls[scroll_id] = (position + size, size)
+        raw = json.dumps({"_scroll_id": scroll_id, "hits": {"hits": hits}}).encode("utf-8")
+        return self._serializer.loads(raw)
+
+    def search(self, index, scroll, size, body, doc_type=None):
+        scroll_id = "scroll-{}".format(len(self._scrolls))
+        self._scrolls[scroll_id] = (0, size)
+        return self._page(scroll_id)
+
+    def scroll(self, scroll_id, scroll):
+        return self._page(scroll_id)
+
+
+class _FakeResult:
+    def __init__(self, records=None):
+        self._records = records if records else list()
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def single(self):
+        return self._records[0] if self._records else None
+
+    def consume(self):
+        return None
+
+
+class _FakeTransaction:
+    def __init__(self, driver):
+        """
+        Stand-in for a Neo4j transaction that records the statements run in it.
+        :param driver: the FakeDriver that owns the transaction
+        """
+        self._driver = driver
+        self.statements = list()
+
+    def run(self, statement, parameters=None, **kwargs):
+        self._driver.statements += 1
+        if self._driver.record:
+            self._driver.recorded.append((statement, parameters))
+            self.statements.append((statement, parameters))
+        return _FakeResult(self._driver.respond(statement, parameters) if self._driver.respond else None)
+
+
+class _FakeSession:
+    def __init__(self, driver):
+        self._driver = driver
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write_transaction(self, unit_of_work, *args, **kwargs):
+        self._driver.transactions += 1
+        tx = _FakeTransaction(self._driver)
+        result = unit_of_work(tx, *args, **kwargs)
+        self._driver.committed.extend(tx.statements)
+        return result
+
+    def read_transaction(self, unit_of_work, *args, **kwargs):
+        return unit_of_work(_FakeTransaction(self._driver), *args, **kwargs)
+
+    def run(self, statement, parameters=None, **kwargs):
+        self._driver.transactions += 1
+        return _FakeTransaction(self._driver).run(statement, parameters)
+
+    def close(self):
+        pass
+
+
+class FakeDriver:
+    def __init__(self, record=False, respond=None):
+        """
+        Local stand-in for the Neo4j driver that counts (and optionally records) the statements it is sent.
+        :param record: should the statements be kept? The statements of write transactions that completed are also
+        kept as committed
+        :param respond: optional function of the statement and parameters returning the list of result records, it
+        may raise to make the statement fail
+        """
+        self.record = record
+        self.respond = respond
+        self.recorded = list()
+        self.committed = list()
+        self.statements = 0
+        self.transactions = 0
+
+    def session(self, **kwargs):
+        return _FakeSession(self)
+
+    def close(self):
+        pass
@@ -0,0 +1,100 @@
+from datetime import datetime, timedelta
+import logging
+import random
+
+module_logger = logging.getLogger('elastic2neo.benchmarks.synthetic')
+module_logger.debug("module loaded")
+
+BASE_TIME = datetime(2020, 1, 1)
+
+
+def mapped_fields(mapping):
+    """
+    Collects every document field referenced by the mapping.
+    :param mapping: mapping as a dictionary
+    :return: tuple of a dictionary of field path to value type and a dictionary of iterator path to item type
+    """
+    fields = dict()
+    iterators = dict()
+    for node in mapping['nodes']:
+        if node['nodeType'] == 'iterator':
+            iterators[node['iterator']] = "string"
+        for prop in (node.get('properties') or dict()).values():
+            if prop['key'] == 'ITER!':
+                iterators[node['iterator']] = prop['type']
+            else:
+                fields[prop['key']] = prop['type']
+    for relationship in mapping['relationships']:
+        for prop in (relationship.get('properties') or dict()).values():
+            fields[prop['key']] = prop['type']
+    return fields, iterators
+
+
+def _value(value_type, rng, cardinality):
+    """
+    Generates a value of the given mapping type.
+    :param value_type: the mapping type (string, number, datetime or list)
+    :param rng: the random number generator
+    :param cardinality: the number of distinct values to choose from
+    :return: the value
+    """
+    n = rng.randrange(cardinality)
+    if value_type == "number":
+        return n
+    elif value_type == "datetime":
+        return (BASE_TIME + timedelta(seconds=n)).isoformat()
+    elif value_type == "list":
+        return [n]
+    return "value-{}".format(n)
+
+
+def _set_path(doc, path, value):
+    """
+    Sets a dotted path in the document, creating sub-documents as needed.
+    :param doc: the document
+    :param path: the dotted key path
+    :param value: the value to set
+    """
+    keys = path.split(".")
+    for key in keys[:-1]:
+        doc = doc.setdefault(key, dict())
+    doc[keys[-1]] = value
+
+
+def _filler(rng, width, nesting):
+    """
+    Generates unmapped data of the given width and depth.
+    :param rng: the random number generator
+    :param width: number of fields at each level
+    :param nesting: number of nested levels
+    :return: dictionary of filler fields
+    """
+    filler = {"filler{}".format(i): "filler-{}".format(rng.random()) for i in range(width)}
+    if nesting > 0:
+        filler["nested"] = _filler(rng, width, nesting - 1)
+    return filler
+
+
+def generate_docs(mapping, count, width=0, nesting=0, iterator_length=3, cardinality=1000, seed=0):
+    """
+    Generates synthetic Elasticsearch document sources for the given mapping.
+    :param mapping: mapping as a dictionary
+    :param count: how many documents to generate
+    :param width: number of unmapped fields added at each level of filler
+    :param nesting: how many levels of nested unmapped filler to add
+    :param iterator_length: number of items in every iterator array
+    :param cardinality: number of distinct values per field (controls how often MERGE keys repeat)
+    :param seed: seed for the random number generator so runs are reproducible
+    :return: list of document sources
+    """
+    rng = random.Random(seed)
+    fields, iterators = mapped_fields(mapping)
+    docs = list()
+    for _ in range(count):
+        doc = _filler(rng, width, nesting) if width or nesting else dict()
+        for path, value_type in fields.items():
+            _set_path(doc, path, _value(value_type, rng, cardinality))
+        for path, value_type in iterators.items():
+            _set_path(doc, path, [_value(value_type, rng, cardinality) for _ in range(iterator_length)])
+        docs.append(doc)
+    return docs
@@ -0,0 +1,203 @@
+from source.neo import GraphBuilder, WEIGHT_KEY, ROLLUP_AGGREGATIONS
+from source.metrics import Metrics
+from datetime import datetime
+import logging
+import json
+
+module_logger = logging.getLogger('elastic2neo.aggregation')
+module_logger.debug("module loaded")
+
+DEFAULT_PAGE_SIZE = 1000
+DEFAULT_KEYWORD_SUFFIX = ".keyword"
+
+
+class Aggregator:
+    def __init__(self, scroller, builder, mapping, exclude=None, keyword_suffix=DEFAULT_KEYWORD_SUFFIX,
+                 page_size=DEFAULT_PAGE_SIZE, metrics=None):
+        """
+        Ingests the buckets of an Elasticsearch composite aggregation instead of the documents. The buckets group the
+        documents by the keys the mapping reads, each bucket is turned into one document carrying the number of
+        documents it stands for and the min, max and sum of the rollup timestamp and aggregation keys, so rollup
+        relationships get the same count, firstSeen, lastSeen and aggregations as if every document had been read.
+        :param scroller: the ElasticScroller the aggregation is paged with
+        :param builder: the GraphBuilder the bucket documents are written with
+        :param mapping: mapping as a dictionary
+        :param exclude: document keys not to group by, leaving the properties they map unset
+        :param keyword_suffix: appended to string keys to group by their keyword field
+        :param page_size: the number of buckets per page
+        :param metrics: the Metrics object the aggregated documents are counted in
+        """
+        self._logger = logging.getLogger('elastic2neo.aggregation.Aggregator')
+        self._scroller = scroller
+        self._builder = builder
+        self._keyword_suffix = keyword_suffix
+        self._page_size = page_size
+        self._metrics = metrics if metrics else Metrics()
+        self._types = GraphBuilder._mapped_key_types(mapping)
+        self._iterators = GraphBuilder._iterator_keys(mapping)
+        self._metric_keys = self.metric_keys(mapping)
+        exclude = set(exclude) if exclude else set()
+        self._group_keys = [key for key in self.group_keys(mapping) if key not in exclude]
+        if not any(relationship.get('rollup') for relationship in mapping['relationships']):
+            self._logger.warning("the mapping has no rollup relationships, the bucket counts are not written and "
+                                 "each bucket only writes its nodes and relationships once")
+        dropped = self.excluded_properties(mapping, exclude)
+        if dropped:
+            self._logger.warning("excluded keys are not grouped by, these properties are left unset: {}".format(
+                ", ".join(dropped)))
+
+    @staticmethod
+    def excluded_properties(mapping, exclude):
+        """
+        Lists the mapped properties whose document key is excluded from the grouping.
+        :param mapping: mapping as a dictionary
+        :param exclude: set of document keys not grouped by
+        :return: list of property descriptions (mapping node id or relationship type and property name)
+        """
+        dropped = list()
+        for node in mapping['nodes']:
+            for name, prop in (node.get('properties') or dict()).items():
+                if prop['key'] in exclude:
+                    dropped.append("{}.{}".format(node['id'], name))
+        for relationship in mapping['relationships']:
+            for name, prop in (relationship.get('properties') or dict()).items():
+                if prop['key'] in exclude:
+                    dropped.append("{}.{}".format(relationship['type'], name))
+        return dropped
+
+    @staticmethod
+    def metric_keys(mapping):
+        """
+        Collects the document keys of the rollup timestamps and aggregations with the functions computed for them.
+        :param mapping: mapping as a dictionary
+        :return: dictionary of dotted document key to list of functions
+        """
+        keys = dict()
+        for relationship in mapping['relationships']:
+            config = relationship.get('rollup')
+            if not isinstance(config, dict):
+                continue
+            properties = relationship.get('properties') or dict()
+            functions = dict(config.get('aggregations') or dict())
+            if config.get('timestamp'):
+                functions[config['timestamp']] = None
+            for name, function in functions.items():
+                if name not in properties:
+                    continue
+                key_functions = keys.setdefault(properties[name]['key'], list())
+                for added in (['min', 'max'] if function is None else [function]):
+                    if added not in key_functions:
+                        key_functions.append(added)
+        return keys
+
+    @staticmethod
+    def group_keys(mapping):
+        """
+        Collects the document keys the buckets are grouped by: every key the mapping reads except the keys that are
+        only read as a rollup timestamp or aggregation.
+        :param mapping: mapping as a dictionary
+        :return: sorted list of dotted document keys
+        """
+        metric_only = set(Aggregator.metric_keys(mapping))
+        for node in mapping['nodes']:
+            if node['nodeType'] == 'iterator':
+                metric_only.discard(node['iterator'])
+            for prop in (node.get('properties') or dict()).values():
+                metric_only.discard(prop['key'])
+        for relationship in mapping['relationships']:
+            config = relationship.get('rollup')
+            config = config if isinstance(config, dict) else dict()
+            metric_names = set(config.get('aggregations') or dict())
+            if config.get('timestamp'):
+                metric_names.add(config['timestamp'])
+            for name, prop in (relationship.get('properties') or dict()).items():
+                if name not in metric_names:
+                    metric_only.discard(prop['key'])
+        return [key for key in GraphBuilder.mapped_keys(mapping) if key not in metric_only]
+
+    def _sources(self):
+        """
+        Creates the composite sources, string keys are grouped by their keyword field.
+        :return: list of composite sources
+        """
+        sources = list()
+        for key in self._group_keys:
+            field = key if self._types.get(key) in ("number", "datetime") else key + self._keyword_suffix
+            sources.append({key: {"terms": {"field": field, "missing_bucket": True}}})
+        return sources
+
+    def _aggregations(self):
+        """
+        Creates the metric aggregations computed for each bucket.
+        :return: dictionary of aggregation name to aggregation
+        """
+        return {"{}:{}".format(function, key): {function: {"field": key}}
+                for key, functions in self._metric_keys.items() for function in functions}
+
+    def _hit(self, bucket):
+        """
+        Converts a bucket into a document hit.
+        :param bucket: the composite bucket
+        :return: hit whose source holds the bucket key, the metric values and the weight
+        """
+        source = dict()
+        for key, value in bucket['key'].items():
+            if value is None:
+                continue
+            if self._types.get(key) == "datetime" and isinstance(value, (int, float)):
+                value = datetime.utcfromtimestamp(value / 1000).isoformat()
+            if key in self._iterators or self._types.get(key) == "list":
+                value = [value]
+            self._set(source, key, value)
+        weight = {"count": bucket['doc_count']}
+        for function in ROLLUP_AGGREGATIONS:
+            weight[function] = dict()
+        for key, functions in self._metric_keys.items():
+            for function in functions:
+                result = bucket["{}:{}".format(function, key)]
+                if result.get('value') is None:
+                    continue
+                if self._types.get(key) == "datetime":
+                    weight[function][key] = result.get('value_as_string', result['value'])
+                elif isinstance(result['value'], float) and result['value'].is_integer():
+                    # Elasticsearch returns doubles, integral values are kept integers as on the documents
+                    weight[function][key] = int(result['value'])
+                else:
+                    weight[function][key] = result['value']
+            values = [weight[function][key] for function in functions if key in weight[function]]
+            if values:
+                # The key has to be in the document for the property to be generated, its value comes from the weight
+                self._set(source, key, values[-1])
+        source[WEIGHT_KEY] = weight
+        return {"_id": json.dumps(bucket['key'], sort_keys=True), "_source": source}
+
+    @staticmethod
+    def _set(source, key, value):
+        """
+        Sets a dotted key in a document.
+        :param source: the document
+        :param key: the dotted document key
+        :param value: the value
+        """
+        keys = key.split(".")
+        for part in keys[:-1]:
+            source = source.setdefault(part, dict())
+        source[keys[-1]] = value
+
+    def run(self, execute=True):
+        """
+        Pages through the aggregation once and writes the buckets. Running it again over the same documents counts
+        them again in the rollups, so the query should select each time window once.
+        :param execute: Should the statements generated be executed against Neo4j?
+        """
+        self._logger.info("aggregating by {}".format(", ".join(self._group_keys)))
+        buckets = 0
+        docs = 0
+        for page in self._scroller.composite(self._sources(), self._aggregations(), size=self._page_size):
+            hits = [self._hit(bucket) for bucket in page]
+            count = sum(bucket['doc_count'] for bucket in page)
+            self._metrics.inc("e2n_aggregated_docs_total", count)
+            buckets += len(page)
+            docs += count
+            self._builder.build(hits, execute)
+        self._logger.info("wrote {} buckets aggregating {} documents".format(buckets, docs))
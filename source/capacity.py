@@ -0,0 +1,140 @@
+from time import process_time
+import tracemalloc
+import logging
+
+module_logger = logging.getLogger('elastic2neo.capacity')
+module_logger.debug("module loaded")
+
+DEFAULT_SAMPLE_SIZE = 10000
+
+# Peak memory is traced on the first page and every Nth page after it, tracing slows the page down so the CPU time is
+# taken from the other pages
+TRACE_EVERY = 5
+
+
+class CapacityPlanner:
+    def __init__(self, scroller, builder, metrics):
+        """
+        Estimates the size of the graph an index produces and the cost of writing it from a random sample of documents,
+        without connecting to Neo4j.
+        :param scroller: the ElasticScroller the sample is taken with
+        :param builder: the GraphBuilder the sample is processed with (created with execute disabled)
+        :param metrics: the Metrics object shared with the builder, used to count the valid documents
+        """
+        self._logger = logging.getLogger('elastic2neo.capacity.CapacityPlanner')
+        self._scroller = scroller
+        self._builder = builder
+        self._metrics = metrics
+        self._counts = dict()
+        self._distinct = dict()
+        self._statements = 0
+        self._docs = 0
+        self._valid = 0
+        self._cpu = 0.0
+        self._cpu_docs = 0
+        self._traced_cpu = 0.0
+        self._traced_docs = 0
+        self._pages = 0
+        self._peak = 0
+
+    def run(self, sample_size=DEFAULT_SAMPLE_SIZE):
+        """
+        Samples and processes the documents page by page.
+        :param sample_size: the number of documents to sample
+        :return: the report as a dictionary
+        """
+        total = self._scroller.count()
+        self._logger.info("sampling {} of {} documents".format(min(sample_size, total), total))
+        for page in self._scroller.sample(sample_size):
+            self._measure(page)
+        return self.report(total)
+
+    def _measure(self, page):
+        """
+        Processes a page once for the counts and either its transform CPU time or, on traced pages, its peak memory.
+        Each page goes through the builder once so the pipeline metrics, processors and memo cache see it once.
+        :param page: list of elastic documents
+        """
+        traced = self._pages % TRACE_EVERY == 0
+        self._pages += 1
+        valid = self._metrics.total("e2n_docs_valid_total")
+        if traced:
+            tracemalloc.start()
+        start = process_time()
+        statements = list()
+        for nodes, relationships in self._builder._process(page):
+            for key, statement in self._gen_statements(nodes, relationships):
+                statements.append((key, hash(statement)))
+        cpu = process_time() - start
+        if traced:
+            self._peak = max(self._peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            self._traced_cpu += cpu
+            self._traced_docs += len(page)
+        else:
+            self._cpu += cpu
+            self._cpu_docs += len(page)
+        self._valid += self._metrics.total("e2n_docs_valid_total") - valid
+        self._docs += len(page)
+        for key, statement in statements:
+            self._counts[key] = self._counts.get(key, 0) + 1
+            self._distinct.setdefault(key, set()).add(statement)
+        self._statements += len(statements)
+
+    def _gen_statements(self, nodes, relationships):
+        """
+        Generates the statements of a chunk keyed by the mapping node id or relationship type they came from.
+        :param nodes: list of nodes
+        :param relationships: list of relationships
+        :return: generator of tuples of the key and the statement
+        """
+        for node in nodes:
+            for statement in self._builder._gen_node_statements([node]):
+                yield "node {}".format(node['id']), statement
+        for relationship in relationships:
+            for statement in self._builder._gen_relationship_statements([relationship]):
+                yield "relationship {}".format(relationship['type']), statement
+
+    def report(self, total):
+        """
+        Extrapolates the sample to the whole index. Distinct counts assume the distinct ratio of the sample holds for
+        the index, so entities repeated across documents make them an upper bound.
+        :param total: the number of documents in the index
+        :return: the report as a dictionary
+        """
+        scale = total / self._docs if self._docs else 0
+        # A sample of traced pages only still gives a (pessimistic) CPU time
+        cpu, cpu_docs = (self._cpu, self._cpu_docs) if self._cpu_docs else (self._traced_cpu, self._traced_docs)
+        cpu_per_doc = cpu / cpu_docs if cpu_docs else 0
+        items = dict()
+        for key in sorted(self._counts):
+            count = self._counts[key]
+            ratio = len(self._distinct[key]) / count
+            items[key] = {"sampled": count, "projected": int(count * scale), "distinctRatio": ratio,
+                          "projectedDistinct": int(count * scale * ratio)}
+        return {"documents": total, "sampled": self._docs,
+                "validRatio": self._valid / self._docs if self._docs else 0,
+                "statementsPerDoc": self._statements / self._docs if self._docs else 0,
+                "projectedStatements": int(self._statements * scale),
+                "cpuMsPerDoc": cpu_per_doc * 1000,
+                "projectedCpuSeconds": cpu_per_doc * total,
+                "peakBytesPerPage": self._peak, "items": items}
+
+    @staticmethod
+    def format(report):
+        """
+        Formats a report as text.
+        :param report: the report as a dictionary
+        :return: report string
+        """
+        lines = [
+            "documents {} (sampled {}), valid {:.1%}, statements per document {:.2f}, projected statements {}".format(
+                report["documents"], report["sampled"], report["validRatio"], report["statementsPerDoc"],
+                report["projectedStatements"]),
+            "transform cpu {:.3f} ms per document, {:.1f} s projected, peak memory {:.2f} MiB per page".format(
+                report["cpuMsPerDoc"], report["projectedCpuSeconds"], report["peakBytesPerPage"] / 1048576),
+            "{:<40}{:>14}{:>16}{:>12}{:>20}".format("mapping", "sampled", "projected", "distinct", "projected distinct")]
+        for key, item in report["items"].items():
+            lines.append("{:<40}{:>14}{:>16}{:>12.1%}{:>20}".format(key, item["sampled"], item["projected"],
+                                                                     item["distinctRatio"], item["projectedDistinct"]))
+        return "\n".join(lines)
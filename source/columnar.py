@@ -0,0 +1,375 @@
+from collections import OrderedDict
+from itertools import chain
+import logging
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+module_logger = logging.getLogger('elastic2neo.columnar')
+module_logger.debug("module loaded")
+
+# How documents are turned into rows, per document through the processors or per page as columns
+EXTRACTION_MODES = ['documents', 'columnar']
+
+# Marker for a key that is not in the document
+_MISSING = object()
+
+
+def _lookup(source, keys):
+    """
+    Gets the value of a dotted key from a document source.
+    :param source: the document source
+    :param keys: list of keys
+    :return: the value or _MISSING
+    """
+    for key in keys:
+        if isinstance(source, dict) and key in source:
+            source = source[key]
+        else:
+            return _MISSING
+    return source
+
+
+def _array(values):
+    """
+    Converts a list of values to an object array when NumPy is installed.
+    :param values: list of values
+    :return: object array or the list
+    """
+    if numpy is None:
+        return values
+    return numpy.fromiter(values, dtype=object, count=len(values))
+
+
+def _mask(values):
+    """
+    Creates a boolean array from a list of booleans.
+    :param values: list of booleans
+    :return: boolean array or the list
+    """
+    if numpy is None:
+        return values
+    return numpy.fromiter(values, dtype=bool, count=len(values))
+
+
+def _lengths(values):
+    """
+    Creates an integer array from a list of lengths.
+    :param values: list of integers
+    :return: integer array or the list
+    """
+    if numpy is None:
+        return values
+    return numpy.fromiter(values, dtype=numpy.int64, count=len(values))
+
+
+def _and(first, second):
+    if numpy is None:
+        return [a and b for a, b in zip(first, second)]
+    return first & second
+
+
+def _take(values, positions):
+    """
+    Selects values by position.
+    :param values: array or list
+    :param positions: array or list of positions
+    :return: array or list of the selected values
+    """
+    if numpy is None:
+        return [values[i] for i in positions]
+    return values[positions]
+
+
+def _nonzero(mask):
+    if numpy is None:
+        return [i for i, value in enumerate(mask) if value]
+    return numpy.flatnonzero(mask)
+
+
+def _repeat(positions, counts):
+    """
+    Repeats each position by its count, used to explode iterator arrays.
+    :param positions: array or list of positions
+    :param counts: array or list of counts
+    :return: array or list of positions
+    """
+    if numpy is None:
+        return [i for i, count in zip(positions, counts) for _ in range(count)]
+    return numpy.repeat(positions, counts)
+
+
+def _groups(masks, size):
+    """
+    Groups rows by which of the masks are set, every group renders to the same statement template.
+    :param masks: list of boolean arrays or lists
+    :param size: the number of rows
+    :return: list of tuples of the set flags of each mask and the row positions of the group
+    """
+    if numpy is not None and len(masks) < 63:
+        codes = numpy.zeros(size, dtype=numpy.int64)
+        for bit, mask in enumerate(masks):
+            codes |= mask.astype(numpy.int64) << bit
+        unique, inverse = numpy.unique(codes, return_inverse=True)
+        return [(tuple(bool(code >> bit & 1) for bit in range(len(masks))), numpy.flatnonzero(inverse == i))
+                for i, code in enumerate(unique.tolist())]
+    groups = OrderedDict()
+    for i, flags in enumerate(zip(*masks) if masks else [()] * size):
+        groups.setdefault(tuple(bool(flag) for flag in flags), list()).append(i)
+    return list(groups.items())
+
+
+def _to_number(value):
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            return float(value)
+    return value
+
+
+def _coerce(values, value_type):
+    """
+    Converts a column to the values sent as query parameters, matching GraphBuilder._get_row_value.
+    :param values: array or list of values
+    :param value_type: the mapping type
+    :return: list of parameter values
+    """
+    if value_type == "number":
+        values = values.tolist() if numpy is not None else values
+        if any(isinstance(value, str) for value in values):
+            return [_to_number(value) for value in values]
+        return values
+    elif value_type == "list":
+        return values.tolist() if numpy is not None else list(values)
+    if numpy is not None:
+        return values.astype(str).tolist()
+    return [str(value) for value in values]
+
+
+class ColumnarExtractor:
+    def __init__(self, builder, mapping):
+        """
+        Extracts the mapped fields of a whole page into columns and turns them into UNWIND parameter rows without
+        building nodes and relationships per document. Required property checks, template selection and the
+        explosion of iterator arrays work on whole columns, using NumPy when it is installed. The rows match the
+        server write mode of the document pipeline, so it can only be used without processors and rollups.
+        :param builder: the GraphBuilder whose templates the rows are rendered for
+        :param mapping: mapping as a dictionary
+        """
+        self._logger = logging.getLogger('elastic2neo.columnar.ColumnarExtractor')
+        self._builder = builder
+        self._mapping = mapping
+        self._keys = [key for key in builder.mapped_keys(mapping) if key != 'ITER!']
+        self._logger.info("columnar extraction of {} fields using {}".format(
+            len(self._keys), "numpy" if numpy is not None else "lists"))
+
+    def rows(self, sources):
+        """
+        Converts document sources to parameter rows.
+        :param sources: list of document sources
+        :return: tuple of dictionaries of node and relationship templates to their list of rows and a dictionary of
+        the valid document, invalid document, node and relationship counts
+        """
+        size = len(sources)
+        columns = dict()
+        for key in self._keys:
+            keys = key.split(".")
+            values = [_lookup(source, keys) for source in sources]
+            columns[key] = (_array(values), _mask([value is not _MISSING for value in values]))
+        valid = _mask([True] * size)
+        node_masks = dict()
+        explosions = dict()
+        for node in self._mapping['nodes']:
+            mask = self._required_mask(node, columns, size)
+            if node['nodeType'] == 'iterator':
+                values, present = columns[node['iterator']]
+                lengths = _lengths([len(value) if value is not _MISSING else 0 for value in values])
+                mask = _and(mask, _mask([length > 0 for length in lengths]))
+                explosions[node['id']] = (values, lengths)
+            node_masks[node['id']] = mask
+            if node['required']:
+                valid = _and(valid, mask)
+        relationship_masks = list()
+        for relationship in self._mapping['relationships']:
+            mask = self._required_mask(relationship, columns, size)
+            for rel_node in ["sourceNode", "destinationNode"]:
+                mask = _and(mask, node_masks.get(relationship[rel_node], _mask([False] * size)))
+            iterators = [relationship[rel_node] in explosions for rel_node in ["sourceNode", "destinationNode"]]
+            if relationship['relationshipType'] == "iterator" and iterators.count(True) != 1:
+                mask = _mask([False] * size)
+            relationship_masks.append(mask)
+            if relationship['required']:
+                valid = _and(valid, mask)
+        node_rows = OrderedDict()
+        relationship_rows = OrderedDict()
+        counts = {"valid": len(_nonzero(valid)), "nodes": 0, "relationships": 0}
+        counts["invalid"] = size - counts["valid"]
+        instances = dict()
+        for node in self._mapping['nodes']:
+            instances[node['id']] = self._instances(node, _nonzero(_and(node_masks[node['id']], valid)), columns,
+                                                    explosions)
+            counts["nodes"] += self._add_node_rows(node_rows, node, instances[node['id']], columns)
+        for relationship, mask in zip(self._mapping['relationships'], relationship_masks):
+            docs = _nonzero(_and(mask, valid))
+            source = self._mapping_node(relationship['sourceNode'])
+            destination = self._mapping_node(relationship['destinationNode'])
+            source_rows = self._instances(source, docs, columns, explosions)
+            destination_rows = self._instances(destination, docs, columns, explosions)
+            # The standard side of an iterator relationship is repeated for every item of the iterator side
+            if source['nodeType'] == 'iterator' and destination['nodeType'] != 'iterator':
+                destination_rows = self._instances(destination, source_rows[0], columns, explosions)
+            elif destination['nodeType'] == 'iterator' and source['nodeType'] != 'iterator':
+                source_rows = self._instances(source, destination_rows[0], columns, explosions)
+            counts["relationships"] += self._add_relationship_rows(relationship_rows, relationship, source,
+                                                                   source_rows, destination, destination_rows, columns)
+        return node_rows, relationship_rows, counts
+
+    def _mapping_node(self, node_id):
+        for node in self._mapping['nodes']:
+            if node['id'] == node_id:
+                return node
+        return None
+
+    @staticmethod
+    def _required_mask(item, columns, size):
+        """
+        Creates the mask of documents that contain every required property of a node or relationship mapping.
+        :param item: the node or relationship mapping
+        :param columns: dictionary of key to the value array and presence mask
+        :param size: the number of documents
+        :return: boolean mask
+        """
+        mask = _mask([True] * size)
+        for name in item.get('requiredProperties') or list():
+            key = item['properties'][name]['key']
+            if key != 'ITER!':
+                mask = _and(mask, columns[key][1] if key in columns else _mask([False] * size))
+        return mask
+
+    @staticmethod
+    def _instances(node, docs, columns, explosions):
+        """
+        Lays out the rows of a node, one per document or one per iterator item of each document.
+        :param node: the node mapping
+        :param docs: positions of the documents
+        :param columns: dictionary of key to the value array and presence mask
+        :param explosions: dictionary of iterator node id to the iterator values and lengths
+        :return: tuple of the document position of every row and the iterator item of every row (None for standard
+        nodes)
+        """
+        if node['nodeType'] != 'iterator' or node['id'] not in explosions:
+            return docs, None
+        values, lengths = explosions[node['id']]
+        positions = _take(values, docs)
+        return _repeat(docs, _take(lengths, docs)), _array(list(chain.from_iterable(positions)))
+
+    @staticmethod
+    def _property_columns(item, rows, columns):
+        """
+        Gets the value and presence columns of every mapped property for the given rows.
+        :param item: the node or relationship mapping
+        :param rows: tuple of the document position and iterator item of every row
+        :param columns: dictionary of key to the value array and presence mask
+        :return: ordered dictionary of property name to the type, values and presence mask
+        """
+        docs, items = rows
+        properties = OrderedDict()
+        for name, prop in (item.get('properties') or dict()).items():
+            if prop['key'] == 'ITER!':
+                if items is None:
+                    continue
+                properties[name] = (prop['type'], items, _mask([True] * len(items)))
+            elif prop['key'] in columns:
+                values, present = columns[prop['key']]
+                properties[name] = (prop['type'], _take(values, docs), _take(present, docs))
+        return properties
+
+    @staticmethod
+    def _template_item(item, properties, flags, unique_key):
+        """
+        Recreates the node or relationship the document pipeline would build for a group of rows, without values.
+        :param item: the node or relationship mapping
+        :param properties: ordered dictionary of property name to the type, values and presence mask
+        :param flags: which of the properties are present
+        :param unique_key: the mapping key holding the unique property names
+        :return: tuple of the item and the names of its present properties
+        """
+        present = [name for name, flag in zip(properties, flags) if flag]
+        template = {key: item[key] for key in ['labels', 'uniqueLabels', 'type', 'directionality', 'unique']
+                    if key in item}
+        if present:
+            template['properties'] = {name: {"type": properties[name][0], "value": None} for name in present}
+        unique = [name for name in present if name in (item.get(unique_key) or list())]
+        if unique:
+            template['uniqueProperties'] = {name: template['properties'][name] for name in unique}
+        return template, present
+
+    @staticmethod
+    def _match_properties(node):
+        """
+        Gets the properties a relationship matches a node on, the same as GraphBuilder._gen_relationship_row.
+        :param node: the node without values
+        :return: list of property names
+        """
+        return list(node['uniqueProperties'] if 'uniqueProperties' in node else node.get('properties', dict()))
+
+    def _add_node_rows(self, node_rows, node, rows, columns):
+        """
+        Renders the rows of a node mapping grouped by statement template.
+        :param node_rows: dictionary of template to rows that is added to
+        :param node: the node mapping
+        :param rows: tuple of the document position and iterator item of every row
+        :param columns: dictionary of key to the value array and presence mask
+        :return: the number of rows
+        """
+        properties = self._property_columns(node, rows, columns)
+        size = len(rows[0])
+        for flags, positions in _groups([present for _, _, present in properties.values()], size):
+            template_node, present = self._template_item(node, properties, flags, 'uniqueProperties')
+            template, _ = self._builder._gen_node_row(template_node)
+            values = [_coerce(_take(properties[name][1], positions), properties[name][0]) for name in present]
+            if values:
+                node_rows.setdefault(template, list()).extend(dict(zip(present, row)) for row in zip(*values))
+            else:
+                node_rows.setdefault(template, list()).extend(dict() for _ in positions)
+        return size
+
+    def _add_relationship_rows(self, relationship_rows, relationship, source, source_rows, destination,
+                               destination_rows, columns):
+        """
+        Renders the rows of a relationship mapping grouped by statement template.
+        :param relationship_rows: dictionary of template to rows that is added to
+        :param relationship: the relationship mapping
+        :param source: the source node mapping
+        :param source_rows: tuple of the document position and iterator item of every source row
+        :param destination: the destination node mapping
+        :param destination_rows: tuple of the document position and iterator item of every destination row
+        :param columns: dictionary of key to the value array and presence mask
+        :return: the number of rows
+        """
+        sides = [("s", source, self._property_columns(source, source_rows, columns)),
+                 ("d", destination, self._property_columns(destination, destination_rows, columns)),
+                 ("r", relationship, self._property_columns(relationship, (source_rows[0], None), columns))]
+        masks = [present for _, _, properties in sides for _, _, present in properties.values()]
+        size = len(source_rows[0])
+        for flags, positions in _groups(masks, size):
+            items = dict()
+            row_values = list()
+            offset = 0
+            for variable, item, properties in sides:
+                item_flags = flags[offset:offset + len(properties)]
+                offset += len(properties)
+                template_item, present = self._template_item(item, properties, item_flags, 'uniqueProperties')
+                items[variable] = template_item
+                names = present if variable == "r" else self._match_properties(template_item)
+                row_values.append((variable, names, [_coerce(_take(properties[name][1], positions),
+                                                             properties[name][0]) for name in names]))
+            template, _ = self._builder._gen_relationship_row(items["s"], items["d"], items["r"])
+            rows = relationship_rows.setdefault(template, list())
+            for i in range(len(positions)):
+                rows.append({variable: {name: values[j][i] for j, name in enumerate(names)}
+                             for variable, names, values in row_values})
+        return size
@@ -1,4 +1,6 @@
 from elasticsearch import Elasticsearch
+from source.metrics import Metrics
+from source.serializer import FastJSONSerializer, connection_class
 import logging
 
 module_logger = logging.getLogger('elastic2neo.elastic')
@@ -7,7 +9,7 @@ module_logger.debug("module loaded")
 
 class ElasticScroller:
     def __init__(self, host, port, index, https=False, verify_certs=False, http_auth=None, timeout=1000,
-                 doc_type=None, size=1000, body=None):
+                 doc_type=None, size=1000, body=None, metrics=None, client=None, decoder='auto'):
         """
         A simple index scroller for Elasticsearch.
         :param host: the es host
@@ -20,8 +22,12 @@ class ElasticScroller:
         :param doc_type: what document type should be returned
         :param size: how many documents should be returned
         :param body: used to provide a more targeted query
+        :param metrics: the Metrics object fetch latency is recorded in
+        :param client: an already created Elasticsearch client to use instead of connecting to the host
+        :param decoder: the JSON decoder used for responses (auto, orjson, ujson or json)
         """
         self._logger = logging.getLogger('elastic2neo.elastic.ElasticScroller')
+        self._metrics = metrics if metrics else Metrics()
 
         if https:
             url = "https://{}:{}".format(host, port)
@@ -31,11 +37,16 @@ class ElasticScroller:
         self._verify_certs = verify_certs
         self._http_auth = http_auth
         self._timeout = timeout
-        if http_auth:
-            self._es = Elasticsearch(url, http_auth=self._http_auth,
-                                     timeout=self._timeout, verify_certs=self._verify_certs)
+        if client:
+            self._es = client
+        elif http_auth:
+            self._es = Elasticsearch(url, http_auth=self._http_auth, timeout=self._timeout,
+                                     verify_certs=self._verify_certs, connection_class=connection_class(),
+                                     serializer=FastJSONSerializer(decoder, metrics=self._metrics))
         else:
-            self._es = Elasticsearch(url, timeout=self._timeout, verify_certs=self._verify_certs)
+            self._es = Elasticsearch(url, timeout=self._timeout, verify_certs=self._verify_certs,
+                                     connection_class=connection_class(),
+                                     serializer=FastJSONSerializer(decoder, metrics=self._metrics))
 
         self._index = index
         self._doc_type = doc_type
@@ -45,6 +56,38 @@ class ElasticScroller:
         else:
             self._body = body
         self._sid = None
+        self._watermark = None
+        self._watermark_ids = set()
+
+    def add_exists_filters(self, fields):
+        """
+        Restricts the query to documents that contain every one of the fields by adding exists filters to the body.
+        Must be called before the first scroll.
+        :param fields: list of dotted document keys
+        """
+        if not fields:
+            return
+        self._body = self._add_filters(self._body, [{"exists": {"field": field}} for field in fields])
+        self._logger.info("only scrolling documents that contain: {}".format(", ".join(fields)))
+
+    @staticmethod
+    def _add_filters(body, filters):
+        """
+        Adds filter clauses to the query of a search body, keeping the existing query.
+        :param body: the search body
+        :param filters: list of filter clauses
+        :return: the new search body
+        """
+        query = body.get('query')
+        if query and list(query.keys()) == ['bool']:
+            query = dict(query['bool'])
+            existing = query.get('filter', list())
+            query['filter'] = (existing if isinstance(existing, list) else [existing]) + filters
+        elif query:
+            query = {"must": [query], "filter": filters}
+        else:
+            query = {"filter": filters}
+        return dict(body, query={"bool": query})
 
     def _init_scroll(self):
         """
@@ -66,10 +109,11 @@ class ElasticScroller:
         Scroll and return the data
         :return: elastic data as a dictionary
         """
-        if not self._sid:
-            data = self._init_scroll()
-        else:
-            data = self._es.scroll(scroll_id=self._sid, scroll='2m')
+        with self._metrics.time("e2n_stage_seconds", stage="fetch"):
+            if not self._sid:
+                data = self._init_scroll()
+            else:
+                data = self._es.scroll(scroll_id=self._sid, scroll='2m')
         if '_scroll_id' in data:
             self._sid = data['_scroll_id']
             # Get the number of results that returned in the last scroll
@@ -81,9 +125,136 @@ class ElasticScroller:
             self._sid = None
             return None
 
+    def scroll_slice(self, slice_id, slices):
+        """
+        Scrolls one slice of the documents the query matches in index order, so a slice is returned in the same order
+        every time while the index is not changing.
+        :param slice_id: the slice to scroll
+        :param slices: the number of slices the index is split into
+        :return: generator of pages of hits
+        """
+        if not self._es.indices.exists(index=self._index):
+            self._logger.error("index {} does not exist".format(self._index))
+            return
+        body = dict(self._body, sort=["_doc"])
+        if slices > 1:
+            body["slice"] = {"id": slice_id, "max": slices}
+        with self._metrics.time("e2n_stage_seconds", stage="fetch"):
+            if self._doc_type:
+                data = self._es.search(index=self._index, doc_type=self._doc_type, scroll='2m', size=self._size,
+                                       body=body)
+            else:
+                data = self._es.search(index=self._index, scroll='2m', size=self._size, body=body)
+        try:
+            while data['hits']['hits']:
+                yield data['hits']['hits']
+                with self._metrics.time("e2n_stage_seconds", stage="fetch"):
+                    data = self._es.scroll(scroll_id=data['_scroll_id'], scroll='2m')
+        finally:
+            self._es.clear_scroll(scroll_id=data['_scroll_id'])
 
+    def count(self):
+        """
+        Counts the documents the query matches.
+        :return: the number of documents, 0 if the index does not exist
+        """
+        if not self._es.indices.exists(index=self._index):
+            self._logger.error("index {} does not exist".format(self._index))
+            return 0
+        body = {"query": self._body['query']} if 'query' in self._body else None
+        if self._doc_type:
+            return self._es.count(index=self._index, doc_type=self._doc_type, body=body)['count']
+        return self._es.count(index=self._index, body=body)['count']
 
+    def sample(self, count):
+        """
+        Scrolls a random sample of the documents the query matches.
+        :param count: the number of documents to sample
+        :return: generator of pages of hits
+        """
+        if not self._es.indices.exists(index=self._index):
+            self._logger.error("index {} does not exist".format(self._index))
+            return
+        body = dict(self._body, query={"function_score": {"query": self._body.get('query', {"match_all": {}}),
+                                                          "random_score": dict(), "boost_mode": "replace"}})
+        size = min(self._size, count)
+        if self._doc_type:
+            data = self._es.search(index=self._index, doc_type=self._doc_type, scroll='2m', size=size, body=body)
+        else:
+            data = self._es.search(index=self._index, scroll='2m', size=size, body=body)
+        sampled = 0
+        while data['hits']['hits'] and sampled < count:
+            hits = data['hits']['hits'][:count - sampled]
+            sampled += len(hits)
+            yield hits
+            if sampled < count:
+                data = self._es.scroll(scroll_id=data['_scroll_id'], scroll='2m')
+        self._es.clear_scroll(scroll_id=data['_scroll_id'])
 
+    def poll(self, timestamp_field):
+        """
+        Fetches the next documents indexed since the last poll in timestamp order. Unlike a scroll, which only sees the
+        index as it was when the scroll started, every poll is a new search so newly indexed documents are returned.
+        The sort value of each hit is the timestamp in epoch milliseconds.
+        :param timestamp_field: the document timestamp field the index is tailed on
+        :return: list of hits, None if the index does not exist
+        """
+        if not self._es.indices.exists(index=self._index):
+            self._logger.error("index {} does not exist".format(self._index))
+            return None
+        if self._watermark is None:
+            clause = {"exists": {"field": timestamp_field}}
+        else:
+            clause = {"range": {timestamp_field: {"gte": self._watermark, "format": "epoch_millis"}}}
+        body = dict(self._add_filters(self._body, [clause]), sort=[{timestamp_field: "asc"}])
+        # Documents sharing the watermark timestamp are returned again, fetch past all of them
+        size = self._size + len(self._watermark_ids)
+        with self._metrics.time("e2n_stage_seconds", stage="fetch"):
+            if self._doc_type:
+                data = self._es.search(index=self._index, doc_type=self._doc_type, size=size, body=body)
+            else:
+                data = self._es.search(index=self._index, size=size, body=body)
+        hits = data['hits']['hits']
+        new_hits = [hit for hit in hits if hit['_id'] not in self._watermark_ids]
+        if hits:
+            last = hits[-1]['sort'][0]
+            if last != self._watermark:
+                self._watermark = last
+                self._watermark_ids = set()
+            self._watermark_ids.update(hit['_id'] for hit in hits if hit['sort'][0] == last)
+        self._logger.debug("{} new hits on poll for index {}".format(len(new_hits), self._index))
+        return new_hits
 
-
-
+    def composite(self, sources, aggregations=None, size=None):
+        """
+        Pages through a composite aggregation of the documents the query matches. Elasticsearch groups the documents
+        itself, so each bucket stands for every document sharing its key.
+        :param sources: list of composite sources, e.g. [{"src": {"terms": {"field": "src.keyword"}}}]
+        :param aggregations: dictionary of metric aggregations computed for each bucket
+        :param size: the number of buckets per page, defaults to the scroll size
+        :return: generator of pages of buckets
+        """
+        if not self._es.indices.exists(index=self._index):
+            self._logger.error("index {} does not exist".format(self._index))
+            return
+        composite = {"sources": sources, "size": size if size else self._size}
+        body = {"size": 0, "aggs": {"buckets": {"composite": composite}}}
+        if aggregations:
+            body["aggs"]["buckets"]["aggs"] = aggregations
+        if 'query' in self._body:
+            body["query"] = self._body['query']
+        while 1:
+            with self._metrics.time("e2n_stage_seconds", stage="fetch"):
+                if self._doc_type:
+                    data = self._es.search(index=self._index, doc_type=self._doc_type, body=body)
+                else:
+                    data = self._es.search(index=self._index, body=body)
+            result = data['aggregations']['buckets']
+            if not result['buckets']:
+                break
+            self._logger.debug("{} buckets on composite page for index {}".format(len(result['buckets']),
+                                                                                  self._index))
+            yield result['buckets']
+            if 'after_key' not in result:
+                break
+            composite["after"] = result['after_key']
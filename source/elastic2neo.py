@@ -1,7 +1,28 @@
 #!/usr/bin/python
 import logging
-from source.neo import GraphBuilder
+from source.neo import GraphBuilder, DEFAULT_CHUNK_SIZE, DEFAULT_HASH_PROPERTY, DEFAULT_PROCESSOR_BATCH_SIZE, \
+    DEFAULT_NODE_SAMPLE_EVERY
+from source.metrics import Metrics, DEFAULT_LOG_INTERVAL
+from source.fingerprint import FingerprintStore, DEFAULT_EXPECTED_DOCS, DEFAULT_FALSE_POSITIVE_RATE
+from source.memo import MemoCache, DEFAULT_MAX_SIZE
+from source.profiling import Profiler, DEFAULT_DUMP_DIR, DEFAULT_TOP
+from source.writer import DEFAULT_BATCH_SIZE, DEFAULT_MAX_RETRIES, DEFAULT_RETRY_BACKOFF, DEFAULT_DEAD_LETTER_FILE, \
+    DEFAULT_SERVER_BATCH_SIZE, WRITE_MODES, supports_databases
 from source.elastic import ElasticScroller
+from source.serializer import JSON_DECODERS
+from source.plans import PLAN_CHECK_MODES
+from source.capacity import CapacityPlanner
+from source.columnar import EXTRACTION_MODES
+from source.aggregation import Aggregator, DEFAULT_PAGE_SIZE, DEFAULT_KEYWORD_SUFFIX
+from source.leases import FileLeaseStore, Neo4jLeaseStore, LEASE_BACKENDS, DEFAULT_LEASE_PATH
+from source.workers import Worker, DEFAULT_SLICES, DEFAULT_LEASE_SECONDS, DEFAULT_IDLE_SECONDS
+from source.routing import Router, DEFAULT_QUEUE_SIZE
+from source.prune import Pruner, DEFAULT_LAST_SEEN_PROPERTY, DEFAULT_PRUNE_INTERVAL, DEFAULT_PRUNE_BATCH_SIZE, \
+    DEFAULT_PRUNE_MAX_SECONDS
+import neo4j
+from neo4j import GraphDatabase
+from source.microbatch import MicroBatcher, DEFAULT_MAX_SIZE as DEFAULT_MICROBATCH_SIZE, DEFAULT_MAX_DELAY, \
+    DEFAULT_POLL_INTERVAL, DEFAULT_TIMESTAMP_FIELD
 from yaml import full_load, YAMLError
 import getopt
 import sys
@@ -11,23 +32,42 @@ logger = logging.getLogger('elastic2neo')
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(threadName)s - %(levelname)s - %(message)s')
 
 
-def _execute(scroller, builder, scroll=True, execute=True, sleep_delay=15, end_after_empty=False):
+def _execute(scroller, builder, scroll=True, execute=True, sleep_delay=15, end_after_empty=False, metrics=None,
+             profiler=None, batcher=None, worker=None, pruner=None, aggregator=None):
     """
     Execute the main functions.
     :param scroller: the elastic Scroller object
     :param builder: the Neo4j GraphBuilder object
     :param scroll: Should we keep scrolling?
     :param execute: Should the statements generated be executed against Neo4j?
+    :param metrics: the Metrics object to close when done
+    :param profiler: the Profiler object whose report is printed when done
+    :param batcher: the MicroBatcher object used instead of scrolling when micro batching is configured
+    :param worker: the Worker object used instead of scrolling when the workers are configured
+    :param pruner: the Pruner object run between pages on its schedule when pruning is configured
+    :param aggregator: the Aggregator object that writes one pass of aggregated buckets instead of scrolling
     """
     try:
-        if scroll:
+        if worker:
+            worker.run(execute)
+            if pruner:
+                pruner.maybe_run()
+        elif aggregator:
+            aggregator.run(execute)
+            if pruner:
+                pruner.maybe_run()
+        elif scroll and batcher:
+            batcher.run(execute, end_after_empty=end_after_empty, idle=pruner.maybe_run if pruner else None)
+        elif scroll:
             while 1:
                 logger.info("scrolling elastic index")
                 data = scroller.scroll()
                 if len(data):
                     logger.info("building graph")
                     builder.build(data, execute)
-                else:
+                if pruner:
+                    pruner.maybe_run()
+                if not len(data):
                     if end_after_empty:
                         break
                     logger.info("scroll was empty sleeping for {} minutes".format(sleep_delay))
@@ -37,13 +77,40 @@ def _execute(scroller, builder, scroll=True, execute=True, sleep_delay=15, end_a
             data = scroller.scroll()
             logger.info("building graph")
             builder.build(data, execute)
+            if pruner:
+                pruner.maybe_run()
     except KeyboardInterrupt:
         logger.info("interrupt detected")
     finally:
         builder.close()
+        if worker:
+            worker.close()
+        if pruner:
+            pruner.close()
+        if metrics:
+            logger.info(metrics.summary())
+            metrics.close()
+        if profiler:
+            print(profiler.report())
         logger.info("complete")
 
 
+def _plan_capacity(config, mapping, sample_size, metrics):
+    """
+    Runs the capacity planning dry run and prints its report, nothing is written to Neo4j.
+    :param config: config as a dictionary
+    :param mapping: mapping as a dictionary
+    :param sample_size: the number of documents to sample
+    :param metrics: the Metrics object shared by the scroller and builder
+    """
+    scroller, builder = _setup_objects(config, mapping, False, metrics, capacity=True)
+    try:
+        print(CapacityPlanner.format(CapacityPlanner(scroller, builder, metrics).run(sample_size)))
+    finally:
+        builder.close()
+        metrics.close()
+
+
 def _setup_logging(enable_file=False, file_path="e2n.log", debug=False):
     """
     Setup logging for the application.
@@ -119,18 +186,223 @@ REQUIRED_ES_CONFIG_VALUES = ['host', 'port', 'protocol', 'scrollSize', 'sleepMin
 REQUIRED_NEO_CONFIG_VALUES = ['host', 'port', 'protocol', 'user', 'password']
 
 
-def _setup_objects(config, mapping, execute):
+def _setup_metrics(config):
+    """
+    Sets up the metrics registry and starts the optional metrics endpoint and summary logging.
+    :param config: config as a dictionary
+    :return: the Metrics object
+    """
+    metrics = Metrics()
+    options = config.get('metrics') or dict()
+    metrics.start(port=options.get('port'), host=options.get('host', '127.0.0.1'),
+                  log_interval=options.get('logInterval', DEFAULT_LOG_INTERVAL))
+    return metrics
+
+
+def _setup_profiler(config, metrics):
+    """
+    Sets up the profiler used by the --profile mode.
+    :param config: config as a dictionary
+    :param metrics: the Metrics object holding the stage timings
+    :return: the Profiler object
+    """
+    options = config.get('profile') or dict()
+    return Profiler(metrics, sample_every=options.get('sampleEvery', 0),
+                    dump_dir=options.get('dumpDir', DEFAULT_DUMP_DIR), top=options.get('top', DEFAULT_TOP))
+
+
+def _setup_memo(config, metrics):
+    """
+    Sets up the memoization cache shared by the processing modules.
+    :param config: config as a dictionary
+    :param metrics: the Metrics object hit rates are recorded in
+    :return: the MemoCache object
+    """
+    options = config.get('memo') or dict()
+    return MemoCache(max_size=options.get('maxSize', DEFAULT_MAX_SIZE), ttl=options.get('ttl'),
+                     path=options.get('path'), metrics=metrics)
+
+
+def _setup_fingerprints(config, mapping, metrics):
+    """
+    Sets up the optional fingerprint store used to skip unchanged documents.
+    :param config: config as a dictionary
+    :param mapping: mapping as a dictionary
+    :param metrics: the Metrics object skipped documents are counted in
+    :return: the FingerprintStore object or None if it is not configured
+    """
+    options = config.get('fingerprints')
+    if not options:
+        return None
+    if config.get('aggregation'):
+        logger.warning("fingerprints are not used with aggregation, a bucket with the same key can have a new count")
+        return None
+    fields = GraphBuilder.mapped_keys(mapping) + options.get('extraFields', list())
+    return FingerprintStore(options['path'], fields, expected_docs=options.get('expectedDocs', DEFAULT_EXPECTED_DOCS),
+                            false_positive_rate=options.get('falsePositiveRate', DEFAULT_FALSE_POSITIVE_RATE),
+                            metrics=metrics)
+
+
+def _setup_routing(config, mapping):
+    """
+    Sets up the optional routing of nodes and relationships to other Neo4j databases. The connection settings of a
+    target default to the ones of the neo config.
+    :param config: config as a dictionary
+    :param mapping: mapping as a dictionary
+    :return: list of route dictionaries or None if it is not configured
+    """
+    options = config.get('routing')
+    if not options or not options.get('targets'):
+        return None
+    neo = config['neo']
+    routes = list()
+    for target in options['targets']:
+        routes.append({"name": target.get('name'), "labels": target.get('labels'), "types": target.get('types'),
+                       "uri": "{}://{}:{}".format(target.get('protocol', neo['protocol']),
+                                                  target.get('host', neo['host']), target.get('port', neo['port'])),
+                       "user": target.get('user', neo['user']), "password": target.get('password', neo['password']),
+                       "database": target.get('database'),
+                       "encrypted": target.get('encrypted', neo.get('encrypted', False)),
+                       "queue_size": target.get('queueSize', DEFAULT_QUEUE_SIZE)})
+    problems = Router.validate(mapping, routes, "{}://{}:{}".format(neo['protocol'], neo['host'], neo['port']))
+    if not supports_databases():
+        problems.extend("target {} sets database {} but neo4j driver {} ignores it, it needs driver 4.0 or "
+                        "later".format(route['name'], route['database'], neo4j.__version__)
+                        for route in routes if route['database'])
+    for problem in problems:
+        logger.error("routing: {}".format(problem))
+    if problems:
+        exit(1)
+    return routes
+
+
+def _setup_microbatch(config, scroller, builder, metrics):
+    """
+    Sets up the optional micro batching of the continuous mode.
+    :param config: config as a dictionary
+    :param scroller: the elastic Scroller object
+    :param builder: the Neo4j GraphBuilder object
+    :param metrics: the Metrics object the lag is recorded in
+    :return: the MicroBatcher object or None if it is not configured
+    """
+    options = config.get('microbatch')
+    if not options:
+        return None
+    return MicroBatcher(scroller, builder, max_size=options.get('maxSize', DEFAULT_MICROBATCH_SIZE),
+                        max_delay=options.get('maxDelay', DEFAULT_MAX_DELAY),
+                        poll_interval=options.get('pollInterval', DEFAULT_POLL_INTERVAL),
+                        timestamp_field=options.get('timestampField', DEFAULT_TIMESTAMP_FIELD), metrics=metrics)
+
+
+def _setup_aggregation(config, mapping, scroller, builder, metrics):
+    """
+    Sets up the optional ingestion of composite aggregation buckets instead of documents.
+    :param config: config as a dictionary
+    :param mapping: mapping as a dictionary
+    :param scroller: the elastic Scroller object
+    :param builder: the Neo4j GraphBuilder object
+    :param metrics: the Metrics object the aggregated documents are counted in
+    :return: the Aggregator object or None if it is not configured
+    """
+    options = config.get('aggregation')
+    if not options:
+        return None
+    return Aggregator(scroller, builder, mapping, exclude=options.get('exclude'),
+                      keyword_suffix=options.get('keywordSuffix', DEFAULT_KEYWORD_SUFFIX),
+                      page_size=options.get('pageSize', DEFAULT_PAGE_SIZE), metrics=metrics)
+
+
+def _setup_worker(config, mapping, scroller, builder, metrics):
+    """
+    Sets up the optional worker mode that splits the index between cooperating processes.
+    :param config: config as a dictionary
+    :param mapping: mapping as a dictionary
+    :param scroller: the elastic Scroller object
+    :param builder: the Neo4j GraphBuilder object
+    :param metrics: the Metrics object lease events are counted in
+    :return: the Worker object or None if it is not configured
+    """
+    options = config.get('workers')
+    if not options:
+        return None
+    if options.get('backend', LEASE_BACKENDS[0]) not in LEASE_BACKENDS:
+        logger.error("workers backend must be one of: {}".format(", ".join(LEASE_BACKENDS)))
+        exit(1)
+    if options.get('backend', LEASE_BACKENDS[0]) == 'neo4j':
+        neo = config['neo']
+        store = Neo4jLeaseStore(GraphDatabase.driver("{}://{}:{}".format(neo['protocol'], neo['host'], neo['port']),
+                                                     auth=(neo['user'], neo['password']),
+                                                     encrypted=neo.get('encrypted', False)))
+    else:
+        store = FileLeaseStore(options.get('path', DEFAULT_LEASE_PATH))
+    return Worker(scroller, builder, store, options.get('job', mapping['index']),
+                  slices=options.get('slices', DEFAULT_SLICES),
+                  lease_seconds=options.get('leaseSeconds', DEFAULT_LEASE_SECONDS),
+                  idle_seconds=options.get('idleSeconds', DEFAULT_IDLE_SECONDS), metrics=metrics)
+
+
+def _setup_prune(config, execute, builder, metrics):
+    """
+    Sets up the optional pruning of nodes and relationships that have not been written within their retention, in the
+    neo database and every routing target.
+    :param config: config as a dictionary
+    :param execute: Should the statements generated be executed against Neo4j?
+    :param builder: the Neo4j GraphBuilder object whose routing targets are pruned as well
+    :param metrics: the Metrics object deletions are counted in
+    :return: the Pruner object or None if it is not configured or nothing is executed
+    """
+    options = config.get('prune')
+    if not options or not execute:
+        return None
+    if config.get('fingerprints'):
+        logger.warning("documents skipped by their fingerprint are not stamped again, set the prune retention longer "
+                       "than the time between changes of a document")
+    neo = config['neo']
+    return Pruner(GraphDatabase.driver("{}://{}:{}".format(neo['protocol'], neo['host'], neo['port']),
+                                       auth=(neo['user'], neo['password']), encrypted=neo.get('encrypted', False)),
+                  labels=options.get('labels'), types=options.get('types'),
+                  last_seen=neo.get('lastSeenProperty', DEFAULT_LAST_SEEN_PROPERTY),
+                  interval=options.get('interval', DEFAULT_PRUNE_INTERVAL),
+                  batch_size=options.get('batchSize', DEFAULT_PRUNE_BATCH_SIZE),
+                  max_seconds=options.get('maxSeconds', DEFAULT_PRUNE_MAX_SECONDS), metrics=metrics,
+                  targets=builder.routed_stores())
+
+
+def _check_plans(config, builder):
+    """
+    Checks the query plans of the generated statement shapes before the run starts and exits if configured to fail.
+    :param config: config as a dictionary
+    :param builder: the Neo4j GraphBuilder object
+    """
+    mode = config['neo'].get('planCheck', PLAN_CHECK_MODES[1])
+    if mode == 'off':
+        return
+    problems = builder.check_plans()
+    if problems and mode == 'fail':
+        logger.error("{} statement shapes scan nodes, add the missing indexes or set neo planCheck to warn".format(
+            len(problems)))
+        builder.close()
+        exit(1)
+
+
+def _setup_objects(config, mapping, execute, metrics=None, profiler=None, capacity=False):
     """
     Sets up the required class objects for execution
     :param config: config as a dictionary
     :param mapping: mapping as a dictionary
     :param execute: are the statements being executed?
+    :param metrics: the Metrics object shared by the scroller and builder
+    :param profiler: the Profiler object used by the builder
+    :param capacity: is this the capacity planning dry run? (no fingerprint store is opened)
     :return: tuple of objects
     """
     scroller = None
     builder = None
     if all(keys in config for keys in REQUIRED_CONFIG_VALUES):
         elastic = config['elastic']
+        if elastic.get('jsonDecoder', JSON_DECODERS[0]) not in JSON_DECODERS:
+            logger.error("elastic jsonDecoder must be one of: {}".format(", ".join(JSON_DECODERS)))
+            exit(1)
         if all(keys in elastic for keys in REQUIRED_ES_CONFIG_VALUES):
             https = False
             if elastic['protocol'] == 'https':
@@ -141,20 +413,52 @@ def _setup_objects(config, mapping, execute):
             if auth_required:
                 scroller = ElasticScroller(elastic['host'], elastic['port'], index=mapping['index'],
                                            doc_type=mapping['docType'], https=https,
-                                           http_auth=(elastic['user'], elastic['password']), size=elastic['scrollSize'])
+                                           http_auth=(elastic['user'], elastic['password']), size=elastic['scrollSize'],
+                                           metrics=metrics, decoder=elastic.get('jsonDecoder', JSON_DECODERS[0]))
             else:
                 scroller = ElasticScroller(elastic['host'], elastic['port'], index=mapping['index'],
-                                           doc_type=mapping['docType'], https=https, size=elastic['scrollSize'])
+                                           doc_type=mapping['docType'], https=https, size=elastic['scrollSize'],
+                                           metrics=metrics, decoder=elastic.get('jsonDecoder', JSON_DECODERS[0]))
         else:
             logger.error("config file is missing required values")
             exit(1)
         neo = config['neo']
+        if neo.get('writeMode', WRITE_MODES[0]) not in WRITE_MODES:
+            logger.error("neo writeMode must be one of: {}".format(", ".join(WRITE_MODES)))
+            exit(1)
+        if neo.get('extraction', EXTRACTION_MODES[0]) not in EXTRACTION_MODES:
+            logger.error("neo extraction must be one of: {}".format(", ".join(EXTRACTION_MODES)))
+            exit(1)
+        if neo.get('planCheck', PLAN_CHECK_MODES[1]) not in PLAN_CHECK_MODES:
+            logger.error("neo planCheck must be one of: {}".format(", ".join(PLAN_CHECK_MODES)))
+            exit(1)
         if all(keys in neo for keys in REQUIRED_NEO_CONFIG_VALUES):
             builder = GraphBuilder("{}://{}:{}".format(neo['protocol'], neo['host'], neo['port']),
-                                   user=neo['user'], password=neo['password'], mapping=mapping, execute=execute)
+                                   user=neo['user'], password=neo['password'], mapping=mapping, execute=execute,
+                                   chunk_size=neo.get('chunkSize', DEFAULT_CHUNK_SIZE),
+                                   batch_size=neo.get('batchSize', DEFAULT_BATCH_SIZE),
+                                   max_retries=neo.get('maxRetries', DEFAULT_MAX_RETRIES),
+                                   retry_backoff=neo.get('retryBackoff', DEFAULT_RETRY_BACKOFF),
+                                   dead_letter_file=neo.get('deadLetterFile', DEFAULT_DEAD_LETTER_FILE),
+                                   metrics=metrics, profiler=profiler, memo=_setup_memo(config, metrics),
+                                   fingerprints=None if capacity else _setup_fingerprints(config, mapping, metrics),
+                                   write_mode=neo.get('writeMode', WRITE_MODES[0]),
+                                   server_batch_size=neo.get('serverBatchSize', DEFAULT_SERVER_BATCH_SIZE),
+                                   extraction=neo.get('extraction', EXTRACTION_MODES[0]),
+                                   last_seen=neo.get('lastSeenProperty',
+                                                     DEFAULT_LAST_SEEN_PROPERTY if config.get('prune') else None),
+                                   hash_property=neo.get('hashProperty', DEFAULT_HASH_PROPERTY)
+                                   if neo.get('deltaWrites', False) else None,
+                                   routes=_setup_routing(config, mapping),
+                                   processor_batch_size=neo.get('processorBatchSize', DEFAULT_PROCESSOR_BATCH_SIZE),
+                                   encrypted=neo.get('encrypted', False),
+                                   node_sample_every=(config.get('metrics') or dict()).get('nodeSampleEvery',
+                                                                                            DEFAULT_NODE_SAMPLE_EVERY))
         else:
             logger.error("config file is missing required values")
             exit(1)
+        if elastic.get('pushdownFilters', False):
+            scroller.add_exists_filters(builder.pushdown_keys())
     else:
         logger.error("config file is missing required values")
         exit(1)
@@ -165,7 +469,8 @@ def _help():
     """
     Prints the help statement
     """
-    print("usage: elastic2neo.py [-d] [-f [-F LogFile]] [-C ConfigFile] [-M MappingFile] [-o] [-e] [-n] [-h]"
+    print("usage: elastic2neo.py [-d] [-f [-F LogFile]] [-C ConfigFile] [-M MappingFile] [-o] [-e] [-n] [-p] [-c Docs]"
+          " [-h]"
           "\n-d\tEnable debug messages"
           "\n-f\tEnable logging to file"
           "\n-F (LogFile)\tSpecify log file (requires -f)"
@@ -174,6 +479,8 @@ def _help():
           "\n-o\tExecute Elasticsearch scroll  once"
           "\n-e\tEnd execution after the Elasticsearch index is empty"
           "\n-n\tDo not execute cypher statements (for debugging)"
+          "\n-p, --profile\tTime processors and stages and print a ranked report at exit"
+          "\n-c, --capacity (Docs)\tSample Docs documents and print a projected graph size and cost report"
           "\n-h\tView the usage syntax")
 
 
@@ -181,7 +488,8 @@ def _usage():
     """
     Prints the usage reminder
     """
-    print("usage: elastic2neo.py [-d] [-f [-F LogFile]] [-C ConfigFile] [-M MappingFile] [-o] [-e] [-n] [-h]")
+    print("usage: elastic2neo.py [-d] [-f [-F LogFile]] [-C ConfigFile] [-M MappingFile] [-o] [-e] [-n] [-p] [-c Docs]"
+          " [-h]")
 
 
 def main(argv):
@@ -190,7 +498,7 @@ def main(argv):
     :param argv: argv from system
     """
     try:
-        opts, args = getopt.getopt(argv, "dfF:C:M:onh", [])
+        opts, args = getopt.getopt(argv, "dfF:C:M:oenpc:h", ["profile", "capacity="])
         debug = False
         enable_file = False
         log_file = "e2n.log"
@@ -199,6 +507,8 @@ def main(argv):
         scroll = True
         execute = True
         end_after_empty = False
+        profile = False
+        capacity = None
         for opt, arg in opts:
             if opt == '-h':
                 _help()
@@ -223,12 +533,30 @@ def main(argv):
                 execute = False
             elif opt == "-e":
                 end_after_empty = True
+            elif opt in ('-p', '--profile'):
+                profile = True
+            elif opt in ('-c', '--capacity'):
+                if not arg.isdigit() or int(arg) < 1:
+                    _usage()
+                    exit(1)
+                capacity = int(arg)
         _setup_logging(enable_file, log_file, debug)
         mapping = _load_mapping(mapping_file)
         config = _load_config_file(config_file)
-        scroller, builder = _setup_objects(config, mapping, execute)
+        metrics = _setup_metrics(config)
+        profiler = _setup_profiler(config, metrics) if profile else None
+        if capacity:
+            _plan_capacity(config, mapping, capacity, metrics)
+            return
+        scroller, builder = _setup_objects(config, mapping, execute, metrics, profiler)
+        if execute:
+            _check_plans(config, builder)
         _execute(scroller, builder, scroll=scroll, execute=execute, sleep_delay=config['elastic']['sleepMin'],
-                 end_after_empty=end_after_empty)
+                 end_after_empty=end_after_empty, metrics=metrics, profiler=profiler,
+                 batcher=_setup_microbatch(config, scroller, builder, metrics),
+                 worker=_setup_worker(config, mapping, scroller, builder, metrics),
+                 pruner=_setup_prune(config, execute, builder, metrics),
+                 aggregator=_setup_aggregation(config, mapping, scroller, builder, metrics))
     except getopt.GetoptError:
         _usage()
         exit(1)
@@ -0,0 +1,129 @@
+from source.metrics import Metrics
+from hashlib import blake2b
+from math import ceil, log
+import logging
+import json
+import dbm
+
+module_logger = logging.getLogger('elastic2neo.fingerprint')
+module_logger.debug("module loaded")
+
+DEFAULT_EXPECTED_DOCS = 1000000
+DEFAULT_FALSE_POSITIVE_RATE = 0.01
+
+
+class BloomFilter:
+    def __init__(self, expected_items, false_positive_rate):
+        """
+        A simple in-memory Bloom filter.
+        :param expected_items: the number of items the filter is sized for
+        :param false_positive_rate: the acceptable false positive rate at the expected number of items
+        """
+        self._size = max(8, int(ceil(-expected_items * log(false_positive_rate) / (log(2) ** 2))))
+        self._hashes = max(1, int(round(self._size / expected_items * log(2))))
+        self._bits = bytearray((self._size + 7) // 8)
+
+    def _positions(self, key):
+        """
+        Calculates the bit positions of a key using double hashing.
+        :param key: the key string
+        :return: generator of bit positions
+        """
+        digest = blake2b(key.encode("utf-8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self._hashes):
+            yield (first + i * second) % self._size
+
+    def add(self, key):
+        """
+        Add a key to the filter.
+        :param key: the key string
+        """
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class FingerprintStore:
+    def __init__(self, path, fields, expected_docs=DEFAULT_EXPECTED_DOCS,
+                 false_positive_rate=DEFAULT_FALSE_POSITIVE_RATE, metrics=None):
+        """
+        Persistent store of document content fingerprints keyed by the Elasticsearch _id. The fingerprints live in an
+        on-disk hash table (dbm) fronted by an in-memory Bloom filter so new documents rarely touch the disk.
+        :param path: the dbm file the fingerprints are stored in
+        :param fields: the dotted document keys that make up the fingerprint (the fields the mapping uses)
+        :param expected_docs: the number of documents the Bloom filter is sized for
+        :param false_positive_rate: the Bloom filter false positive rate at the expected number of documents
+        :param metrics: the Metrics object skipped documents are counted in
+        """
+        self._logger = logging.getLogger('elastic2neo.fingerprint.FingerprintStore')
+        self._fields = [field.split(".") for field in sorted(set(fields))]
+        self._metrics = metrics if metrics else Metrics()
+        self._db = dbm.open(path, 'c')
+        self._bloom = BloomFilter(expected_docs, false_positive_rate)
+        count = 0
+        for key in self._db.keys():
+            self._bloom.add(key.decode("utf-8"))
+            count += 1
+        self._logger.info("loaded {} fingerprints from {}".format(count, path))
+
+    def fingerprint(self, source):
+        """
+        Calculates the fingerprint of the projected document source.
+        :param source: the document source
+        :return: 16 byte digest
+        """
+        projection = dict()
+        for keys in self._fields:
+            item = source
+            found = True
+            for key in keys:
+                if isinstance(item, dict) and key in item:
+                    item = item[key]
+                else:
+                    found = False
+                    break
+            if found:
+                projection[".".join(keys)] = item
+        return blake2b(json.dumps(projection, sort_keys=True, default=str).encode("utf-8"), digest_size=16).digest()
+
+    def filter(self, data):
+        """
+        Removes the documents whose fingerprint matches the last committed version.
+        :param data: the elastic data
+        :return: tuple of the changed documents and a list of (_id, fingerprint) pairs to commit once written
+        """
+        changed = list()
+        fingerprints = list()
+        for doc in data:
+            if '_id' not in doc:
+                changed.append(doc)
+                continue
+            fingerprint = self.fingerprint(doc['_source'])
+            if doc['_id'] in self._bloom and self._db.get(doc['_id']) == fingerprint:
+                continue
+            changed.append(doc)
+            fingerprints.append((doc['_id'], fingerprint))
+        skipped = len(data) - len(changed)
+        if skipped:
+            self._logger.debug("skipping {} unchanged documents".format(skipped))
+            self._metrics.inc("e2n_docs_skipped_total", skipped)
+        return changed, fingerprints
+
+    def commit(self, fingerprints):
+        """
+        Record the fingerprints of documents that have been written.
+        :param fingerprints: list of (_id, fingerprint) pairs
+        """
+        for doc_id, fingerprint in fingerprints:
+            self._db[doc_id] = fingerprint
+            self._bloom.add(doc_id)
+
+    def close(self):
+        """
+        Close the on-disk store.
+        """
+        self._db.close()
@@ -0,0 +1,223 @@
+from contextlib import contextmanager
+from os import makedirs, replace
+from os.path import join
+from time import time
+import logging
+import fcntl
+import json
+
+module_logger = logging.getLogger('elastic2neo.leases')
+module_logger.debug("module loaded")
+
+LEASE_BACKENDS = ['file', 'neo4j']
+DEFAULT_LEASE_PATH = "leases"
+
+# Neo4j 5 and Neo4j 4 syntax of the lease uniqueness constraint, the first one that succeeds is used
+LEASE_CONSTRAINTS = ["CREATE CONSTRAINT e2n_lease_id IF NOT EXISTS FOR (l:E2NLease) REQUIRE l.id IS UNIQUE",
+                     "CREATE CONSTRAINT ON (l:E2NLease) ASSERT l.id IS UNIQUE"]
+
+
+class FileLeaseStore:
+    def __init__(self, path):
+        """
+        Lease store kept in a JSON file in a directory shared by the workers (a local disk or a network share that
+        supports flock). Every change is made under an exclusive lock and written by atomically replacing the file.
+        :param path: the directory the leases are stored in
+        """
+        self._logger = logging.getLogger('elastic2neo.leases.FileLeaseStore')
+        makedirs(path, exist_ok=True)
+        self._path = join(path, "leases.json")
+        self._lock_path = join(path, "leases.lock")
+
+    @contextmanager
+    def _leases(self):
+        """
+        Context manager that holds the lock and yields the leases, the leases are saved if the body completes.
+        """
+        with open(self._lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(self._path) as f:
+                        leases = json.load(f)
+                except (IOError, ValueError):
+                    leases = dict()
+                yield leases
+                with open(self._path + ".tmp", 'w') as f:
+                    json.dump(leases, f)
+                replace(self._path + ".tmp", self._path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def claim(self, job, units, owner, lease_seconds):
+        """
+        Claims the first unit that is not done and not leased by another worker, or whose lease has expired.
+        :param job: the job name the units belong to
+        :param units: the number of units of the job
+        :param owner: the id of the claiming worker
+        :param lease_seconds: how long the lease is valid without being renewed
+        :return: tuple of the unit, its checkpoint and the previous owner of an expired lease, or None if no unit is
+        available
+        """
+        now = time()
+        with self._leases() as leases:
+            for unit in range(units):
+                lease = leases.setdefault("{}:{}".format(job, unit), {"owner": None, "expires": 0, "checkpoint": 0,
+                                                                      "done": False})
+                if lease["done"] or (lease["owner"] not in (None, owner) and lease["expires"] >= now):
+                    continue
+                previous = lease["owner"] if lease["owner"] != owner else None
+                lease.update(owner=owner, expires=now + lease_seconds)
+                return unit, lease["checkpoint"], previous
+        return None
+
+    def renew(self, job, unit, owner, lease_seconds, checkpoint=None):
+        """
+        Extends a lease and optionally records the progress of the unit.
+        :param job: the job name
+        :param unit: the unit
+        :param owner: the id of the worker holding the lease
+        :param lease_seconds: how long the lease is valid without being renewed
+        :param checkpoint: the number of documents of the unit that have been written, None to keep it
+        :return: False if the lease has been taken over by another worker
+        """
+        with self._leases() as leases:
+            lease = leases.get("{}:{}".format(job, unit))
+            if not lease or lease["owner"] != owner or lease["done"]:
+                return False
+            lease["expires"] = time() + lease_seconds
+            if checkpoint is not None:
+                lease["checkpoint"] = checkpoint
+            return True
+
+    def complete(self, job, unit, owner):
+        """
+        Marks a unit as done and releases its lease.
+        :param job: the job name
+        :param unit: the unit
+        :param owner: the id of the worker holding the lease
+        :return: False if the lease has been taken over by another worker
+        """
+        with self._leases() as leases:
+            lease = leases.get("{}:{}".format(job, unit))
+            if not lease or lease["owner"] != owner:
+                return False
+            lease.update(owner=None, done=True)
+            return True
+
+    def remaining(self, job, units):
+        """
+        Counts the units that are not done.
+        :param job: the job name
+        :param units: the number of units of the job
+        :return: the number of units left
+        """
+        with self._leases() as leases:
+            return sum(1 for unit in range(units) if not leases.get("{}:{}".format(job, unit), {}).get("done"))
+
+    def close(self):
+        """
+        Nothing to close, the file is only open while the lock is held.
+        """
+        pass
+
+
+class Neo4jLeaseStore:
+    def __init__(self, driver):
+        """
+        Lease store kept as (:E2NLease) nodes in Neo4j. A lease is locked by writing to it before its owner is
+        checked, so concurrent claims of the same unit are serialized by the database.
+        :param driver: the Neo4j driver
+        """
+        self._logger = logging.getLogger('elastic2neo.leases.Neo4jLeaseStore')
+        self._driver = driver
+        self._jobs = set()
+        for constraint in LEASE_CONSTRAINTS:
+            try:
+                with self._driver.session() as session:
+                    session.run(constraint).consume()
+                break
+            except Exception as e:
+                self._logger.debug("lease constraint not created: {}".format(e))
+
+    def _run(self, statement, **parameters):
+        """
+        Runs a statement in a write transaction.
+        :param statement: the Cypher statement
+        :param parameters: the statement parameters
+        :return: list of records
+        """
+        with self._driver.session() as session:
+            return session.write_transaction(lambda tx: list(tx.run(statement, parameters)))
+
+    def _create(self, job, units):
+        """
+        Creates the lease nodes of a job once per process.
+        :param job: the job name
+        :param units: the number of units of the job
+        """
+        if job in self._jobs:
+            return
+        self._run("UNWIND range(0, $units - 1) AS unit "
+                  "MERGE (l:E2NLease {id: $job + ':' + toString(unit)}) "
+                  "ON CREATE SET l.job = $job, l.unit = unit, l.checkpoint = 0, l.done = false, l.expires = 0",
+                  job=job, units=units)
+        self._jobs.add(job)
+
+    def claim(self, job, units, owner, lease_seconds):
+        """
+        See FileLeaseStore.claim.
+        """
+        self._create(job, units)
+        for _ in range(units):
+            now = time()
+            candidates = self._run("MATCH (l:E2NLease {job: $job}) "
+                                   "WHERE NOT l.done AND (l.owner IS NULL OR l.owner = $owner OR l.expires < $now) "
+                                   "RETURN l.unit AS unit ORDER BY unit LIMIT 1", job=job, owner=owner, now=now)
+            if not candidates:
+                return None
+            records = self._run("MATCH (l:E2NLease {id: $id}) SET l.lock = true REMOVE l.lock "
+                                "WITH l WHERE NOT l.done AND (l.owner IS NULL OR l.owner = $owner OR l.expires < $now) "
+                                "WITH l, CASE WHEN l.owner = $owner THEN null ELSE l.owner END AS previous "
+                                "SET l.owner = $owner, l.expires = $expires "
+                                "RETURN l.unit AS unit, l.checkpoint AS checkpoint, previous",
+                                id="{}:{}".format(job, candidates[0]["unit"]), owner=owner, now=now,
+                                expires=now + lease_seconds)
+            if records:
+                return records[0]["unit"], records[0]["checkpoint"], records[0]["previous"]
+            # Another worker claimed the unit between the two queries, try the next one
+        return None
+
+    def renew(self, job, unit, owner, lease_seconds, checkpoint=None):
+        """
+        See FileLeaseStore.renew.
+        """
+        records = self._run("MATCH (l:E2NLease {id: $id}) SET l.lock = true REMOVE l.lock "
+                            "WITH l WHERE l.owner = $owner AND NOT l.done "
+                            "SET l.expires = $expires, l.checkpoint = coalesce($checkpoint, l.checkpoint) "
+                            "RETURN l.unit AS unit", id="{}:{}".format(job, unit), owner=owner,
+                            expires=time() + lease_seconds, checkpoint=checkpoint)
+        return len(records) > 0
+
+    def complete(self, job, unit, owner):
+        """
+        See FileLeaseStore.complete.
+        """
+        records = self._run("MATCH (l:E2NLease {id: $id}) SET l.lock = true REMOVE l.lock "
+                            "WITH l WHERE l.owner = $owner SET l.done = true, l.owner = null RETURN l.unit AS unit",
+                            id="{}:{}".format(job, unit), owner=owner)
+        return len(records) > 0
+
+    def remaining(self, job, units):
+        """
+        See FileLeaseStore.remaining.
+        """
+        self._create(job, units)
+        return self._run("MATCH (l:E2NLease {job: $job}) WHERE NOT l.done RETURN count(l) AS remaining",
+                         job=job)[0]["remaining"]
+
+    def close(self):
+        """
+        Close the lease driver.
+        """
+        self._driver.close()
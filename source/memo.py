@@ -0,0 +1,178 @@
+from source.metrics import Metrics
+from collections import OrderedDict
+from threading import Lock
+from time import time
+import logging
+import sqlite3
+import json
+
+module_logger = logging.getLogger('elastic2neo.memo')
+module_logger.debug("module loaded")
+
+DEFAULT_MAX_SIZE = 100000
+
+# Marker used to tell a cached None apart from a miss
+_MISSING = object()
+
+
+class MemoCache:
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, ttl=None, path=None, metrics=None):
+        """
+        A namespaced LRU memoization cache shared by the processing modules. Entries expire after the ttl and the
+        least recently used entries are evicted once max_size is reached. When a path is given the cache is loaded from
+        and saved to a local SQLite file so it survives restarts.
+        :param max_size: the maximum number of entries over all namespaces
+        :param ttl: seconds an entry stays valid, None for no expiry
+        :param path: the file the cache is persisted to, None to keep it in memory only
+        :param metrics: the Metrics object hits and misses are counted in
+        """
+        self._logger = logging.getLogger('elastic2neo.memo.MemoCache')
+        self._max_size = max_size
+        self._ttl = ttl
+        self._path = path
+        self._metrics = metrics if metrics else Metrics()
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        self._stats = dict()
+        if self._path:
+            self._load()
+
+    def get(self, namespace, key, default=None):
+        """
+        Look up a cached value.
+        :param namespace: the namespace of the lookup (e.g. dns, geoip)
+        :param key: the hashable key
+        :param default: returned when the key is not cached
+        :return: the cached value or the default
+        """
+        value = self._get(namespace, key)
+        return default if value is _MISSING else value
+
+    def set(self, namespace, key, value, ttl=None):
+        """
+        Cache a value.
+        :param namespace: the namespace of the lookup
+        :param key: the hashable key
+        :param value: the value to cache
+        :param ttl: seconds the entry stays valid, overrides the cache ttl
+        """
+        ttl = ttl if ttl is not None else self._ttl
+        expires = time() + ttl if ttl is not None else None
+        with self._lock:
+            stats = self._namespace_stats(namespace)
+            if (namespace, key) not in self._entries:
+                stats["size"] += 1
+            self._entries[(namespace, key)] = (value, expires)
+            self._entries.move_to_end((namespace, key))
+            while len(self._entries) > self._max_size:
+                (evicted_namespace, _), _ = self._entries.popitem(last=False)
+                self._stats[evicted_namespace]["size"] -= 1
+
+    def get_or_compute(self, namespace, key, func, ttl=None):
+        """
+        Return the cached value, computing and caching it on a miss.
+        :param namespace: the namespace of the lookup
+        :param key: the hashable key
+        :param func: function called with the key to compute the value
+        :param ttl: seconds the entry stays valid, overrides the cache ttl
+        :return: the value
+        """
+        value = self._get(namespace, key)
+        if value is _MISSING:
+            value = func(key)
+            self.set(namespace, key, value, ttl)
+        return value
+
+    def _get(self, namespace, key):
+        """
+        Look up a cached value, recording the hit or miss.
+        :param namespace: the namespace of the lookup
+        :param key: the hashable key
+        :return: the cached value or _MISSING
+        """
+        value = _MISSING
+        with self._lock:
+            stats = self._namespace_stats(namespace)
+            entry = self._entries.get((namespace, key))
+            if entry is not None:
+                if entry[1] is not None and entry[1] < time():
+                    del self._entries[(namespace, key)]
+                    stats["size"] -= 1
+                else:
+                    self._entries.move_to_end((namespace, key))
+                    value = entry[0]
+            if value is _MISSING:
+                stats["misses"] += 1
+            else:
+                stats["hits"] += 1
+        if value is _MISSING:
+            self._metrics.inc("e2n_memo_misses_total", namespace=namespace)
+        else:
+            self._metrics.inc("e2n_memo_hits_total", namespace=namespace)
+        return value
+
+    def _namespace_stats(self, namespace):
+        """
+        Get the statistics of a namespace, must be called with the lock held.
+        :param namespace: the namespace
+        :return: dictionary of hits, misses and size
+        """
+        if namespace not in self._stats:
+            self._stats[namespace] = {"hits": 0, "misses": 0, "size": 0}
+        return self._stats[namespace]
+
+    def stats(self):
+        """
+        Get the hit rate statistics of every namespace.
+        :return: dictionary of namespace to a dictionary of hits, misses, hitRate and size
+        """
+        with self._lock:
+            stats = dict()
+            for namespace, values in self._stats.items():
+                lookups = values["hits"] + values["misses"]
+                stats[namespace] = dict(values, hitRate=values["hits"] / lookups if lookups else 0.0)
+            return stats
+
+    def _load(self):
+        """
+        Load the unexpired entries from the SQLite file.
+        """
+        with sqlite3.connect(self._path) as db:
+            db.execute("CREATE TABLE IF NOT EXISTS memo (namespace TEXT, key TEXT, value TEXT, expires REAL, "
+                       "PRIMARY KEY (namespace, key))")
+            rows = db.execute("SELECT namespace, key, value, expires FROM memo WHERE expires IS NULL OR expires > ? "
+                              "ORDER BY rowid DESC LIMIT ?", (time(), self._max_size)).fetchall()
+        for namespace, key, value, expires in reversed(rows):
+            key = json.loads(key)
+            key = tuple(key) if isinstance(key, list) else key
+            self._entries[(namespace, key)] = (json.loads(value), expires)
+            self._namespace_stats(namespace)["size"] += 1
+        self._logger.info("loaded {} memoized entries from {}".format(len(rows), self._path))
+
+    def flush(self):
+        """
+        Save the current entries to the SQLite file, entries that cannot be stored as JSON are skipped.
+        """
+        if not self._path:
+            return
+        with self._lock:
+            entries = list(self._entries.items())
+        rows = list()
+        for (namespace, key), (value, expires) in entries:
+            try:
+                rows.append((namespace, json.dumps(key), json.dumps(value), expires))
+            except (TypeError, ValueError):
+                self._logger.debug("skipping entry that cannot be persisted: {} {}".format(namespace, key))
+        with sqlite3.connect(self._path) as db:
+            db.execute("DELETE FROM memo")
+            db.executemany("INSERT OR REPLACE INTO memo (namespace, key, value, expires) VALUES (?, ?, ?, ?)", rows)
+        self._logger.debug("saved {} memoized entries to {}".format(len(rows), self._path))
+
+    def close(self):
+        """
+        Save the cache and log the hit rates.
+        """
+        for namespace, stats in self.stats().items():
+            self._logger.info("memo namespace {}: {} hits, {} misses, {:.1%} hit rate, {} entries".format(
+                namespace, stats["hits"], stats["misses"], stats["hitRate"], stats["size"]))
+        self.flush()
@@ -0,0 +1,271 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from contextlib import contextmanager
+from threading import Lock, Thread, Event
+from time import perf_counter, time
+import logging
+
+module_logger = logging.getLogger('elastic2neo.metrics')
+module_logger.debug("module loaded")
+
+# Upper bounds (in seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+DEFAULT_LOG_INTERVAL = 60
+
+# Help text for every metric, anything recorded without an entry here is still exported
+METRIC_HELP = {
+    "e2n_docs_total": ("counter", "Documents received from Elasticsearch"),
+    "e2n_docs_valid_total": ("counter", "Documents that generated all required nodes and relationships"),
+    "e2n_docs_invalid_total": ("counter", "Documents discarded because of missing required nodes or relationships"),
+    "e2n_docs_skipped_total": ("counter", "Documents skipped because their fingerprint had not changed"),
+    "e2n_nodes_total": ("counter", "Node instances emitted"),
+    "e2n_relationships_total": ("counter", "Relationship instances emitted"),
+    "e2n_statements_total": ("counter", "Cypher statements generated"),
+    "e2n_rows_total": ("counter", "Parameter rows written in server side batching mode"),
+    "e2n_retries_total": ("counter", "Write batches retried after a transient error"),
+    "e2n_dead_letters_total": ("counter", "Statements written to the dead letter file"),
+    "e2n_memo_hits_total": ("counter", "Processor memoization lookups served from the cache"),
+    "e2n_memo_misses_total": ("counter", "Processor memoization lookups that missed the cache"),
+    "e2n_leases_claimed_total": ("counter", "Work unit leases claimed by this worker"),
+    "e2n_leases_reclaimed_total": ("counter", "Work unit leases claimed after another worker's lease expired"),
+    "e2n_leases_lost_total": ("counter", "Work units abandoned because another worker took over the lease"),
+    "e2n_updates_skipped_total": ("counter", "Delta writes whose SET was skipped because the content hash matched"),
+    "e2n_aggregated_docs_total": ("counter", "Documents represented by the aggregation buckets written"),
+    "e2n_pruned_total": ("counter", "Stale nodes and relationships deleted by pruning"),
+    "e2n_target_chunks_total": ("counter", "Chunk parts written to each routing target"),
+    "e2n_stage_seconds": ("histogram", "Latency of each pipeline stage per page or chunk"),
+    "e2n_node_seconds": ("histogram", "Latency of generating a mapping node for a sample of documents"),
+    "e2n_target_seconds": ("histogram", "Latency of writing a chunk part to each routing target"),
+    "e2n_lag_seconds": ("histogram", "Seconds from a document's timestamp until it was written in micro batching mode"),
+}
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        """
+        Cumulative histogram of observed values.
+        :param buckets: sorted upper bounds of the buckets
+        """
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """
+        Record a value.
+        :param value: the observed value
+        """
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        A thread safe registry of counters and latency histograms that can be rendered in the Prometheus text format.
+        :param buckets: upper bounds of the latency histogram buckets
+        """
+        self._logger = logging.getLogger('elastic2neo.metrics.Metrics')
+        self._buckets = buckets
+        self._lock = Lock()
+        self._counters = dict()
+        self._histograms = dict()
+        self._server = None
+        self._stop = Event()
+        self._last_summary = (time(), 0)
+
+    def inc(self, name, value=1, **labels):
+        """
+        Increment a counter.
+        :param name: the metric name
+        :param value: the amount to increment by
+        :param labels: labels of the series
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """
+        Record a value in a histogram.
+        :param name: the metric name
+        :param value: the observed value in seconds
+        :param labels: labels of the series
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = _Histogram(self._buckets)
+            self._histograms[key].observe(value)
+
+    @contextmanager
+    def time(self, name, **labels):
+        """
+        Context manager that records how long its body took in a histogram.
+        :param name: the metric name
+        :param labels: labels of the series
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start, **labels)
+
+    def value(self, name, **labels):
+        """
+        Get the current value of a counter.
+        :param name: the metric name
+        :param labels: labels of the series
+        :return: the counter value
+        """
+        with self._lock:
+            return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def total(self, name):
+        """
+        Get the sum of a counter over all of its series.
+        :param name: the metric name
+        :return: the summed counter value
+        """
+        with self._lock:
+            return sum(value for (metric, labels), value in self._counters.items() if metric == name)
+
+    def histogram_totals(self, name):
+        """
+        Get the observation count and sum of every series of a histogram.
+        :param name: the metric name
+        :return: list of tuples of the series labels as a dictionary, the count and the sum
+        """
+        with self._lock:
+            return [(dict(labels), histogram.count, histogram.sum)
+                    for (metric, labels), histogram in self._histograms.items() if metric == name]
+
+    def render(self):
+        """
+        Render all metrics in the Prometheus text exposition format.
+        :return: the metrics as a string
+        """
+        lines = list()
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+            described = set()
+            for (name, labels), value in counters:
+                self._describe(lines, described, name, "counter")
+                lines.append("{}{} {}".format(name, self._label_string(labels), value))
+            for (name, labels), histogram in histograms:
+                self._describe(lines, described, name, "histogram")
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append("{}_bucket{} {}".format(name, self._label_string(labels + (("le", bound),)),
+                                                         cumulative))
+                lines.append("{}_bucket{} {}".format(name, self._label_string(labels + (("le", "+Inf"),)),
+                                                     histogram.count))
+                lines.append("{}_sum{} {}".format(name, self._label_string(labels), histogram.sum))
+                lines.append("{}_count{} {}".format(name, self._label_string(labels), histogram.count))
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _describe(lines, described, name, metric_type):
+        """
+        Adds the HELP and TYPE lines the first time a metric is rendered.
+        :param lines: the rendered lines
+        :param described: set of metric names already described
+        :param name: the metric name
+        :param metric_type: the default type of the metric
+        """
+        if name not in described:
+            metric_type, help_text = METRIC_HELP.get(name, (metric_type, name))
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, metric_type))
+            described.add(name)
+
+    @staticmethod
+    def _label_string(labels):
+        """
+        Creates a properly formatted and escaped label string.
+        :param labels: tuple of (name, value) pairs
+        :return: label string
+        """
+        if not labels:
+            return ""
+        pairs = list()
+        for name, value in labels:
+            value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+            pairs.append('{}="{}"'.format(name, value))
+        return "{" + ",".join(pairs) + "}"
+
+    def summary(self):
+        """
+        Creates a one line summary of the pipeline since the previous summary.
+        :return: summary string
+        """
+        now = time()
+        docs = self.total("e2n_docs_total")
+        last_time, last_docs = self._last_summary
+        self._last_summary = (now, docs)
+        rate = (docs - last_docs) / max(now - last_time, 1e-9)
+        stages = list()
+        with self._lock:
+            for (name, labels), histogram in sorted(self._histograms.items(), key=lambda item: item[0]):
+                if name == "e2n_stage_seconds" and histogram.count:
+                    stages.append("{} {:.4f}s".format(dict(labels)["stage"], histogram.sum / histogram.count))
+        return ("docs {} ({:.1f}/s), valid {}, invalid {}, nodes {}, relationships {}, statements {}, retries {}, "
+                "dead letters {}, mean stage latency [{}]").format(
+            docs, rate, self.total("e2n_docs_valid_total"), self.total("e2n_docs_invalid_total"),
+            self.total("e2n_nodes_total"), self.total("e2n_relationships_total"),
+            self.total("e2n_statements_total"), self.total("e2n_retries_total"),
+            self.total("e2n_dead_letters_total"), ", ".join(stages))
+
+    def start(self, port=None, host="127.0.0.1", log_interval=DEFAULT_LOG_INTERVAL):
+        """
+        Start serving the metrics over HTTP and logging a periodic summary.
+        :param port: the port to serve /metrics on, None to disable the endpoint
+        :param host: the interface to bind the endpoint to
+        :param log_interval: seconds between summary log lines, None or 0 to disable
+        """
+        if port:
+            metrics = self
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path.split("?")[0] != "/metrics":
+                        self.send_error(404)
+                        return
+                    body = metrics.render().encode("utf-8")
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    metrics._logger.debug(format % args)
+
+            self._server = ThreadingHTTPServer((host, port), Handler)
+            Thread(target=self._server.serve_forever, name="metrics-http", daemon=True).start()
+            self._logger.info("serving metrics on http://{}:{}/metrics".format(host, port))
+        if log_interval:
+            Thread(target=self._log_summaries, args=(log_interval,), name="metrics-log", daemon=True).start()
+
+    def _log_summaries(self, interval):
+        """
+        Log a summary line every interval seconds until stopped.
+        :param interval: seconds between summary lines
+        """
+        while not self._stop.wait(interval):
+            self._logger.info(self.summary())
+
+    def close(self):
+        """
+        Stop the HTTP endpoint and the summary logger.
+        """
+        self._stop.set()
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
@@ -0,0 +1,84 @@
+from source.metrics import Metrics
+from time import monotonic, sleep, time
+import logging
+
+module_logger = logging.getLogger('elastic2neo.microbatch')
+module_logger.debug("module loaded")
+
+DEFAULT_MAX_SIZE = 500
+DEFAULT_MAX_DELAY = 1.0
+DEFAULT_POLL_INTERVAL = 0.5
+DEFAULT_TIMESTAMP_FIELD = "@timestamp"
+
+
+class MicroBatcher:
+    def __init__(self, scroller, builder, max_size=DEFAULT_MAX_SIZE, max_delay=DEFAULT_MAX_DELAY,
+                 poll_interval=DEFAULT_POLL_INTERVAL, timestamp_field=DEFAULT_TIMESTAMP_FIELD, metrics=None):
+        """
+        Tails an index and writes the documents in micro batches. A batch is flushed through the builder as soon as it
+        holds max_size documents or its oldest document has waited max_delay seconds, whichever comes first.
+        :param scroller: the ElasticScroller the index is polled with
+        :param builder: the GraphBuilder the batches are written with
+        :param max_size: the maximum number of documents in a batch
+        :param max_delay: the maximum seconds a document is buffered before its batch is flushed
+        :param poll_interval: seconds between polls while no new documents arrive
+        :param timestamp_field: the document timestamp field the index is tailed on and the lag is measured from
+        :param metrics: the Metrics object the document to graph lag is recorded in
+        """
+        self._logger = logging.getLogger('elastic2neo.microbatch.MicroBatcher')
+        self._scroller = scroller
+        self._builder = builder
+        self._max_size = max_size
+        self._max_delay = max_delay
+        self._poll_interval = poll_interval
+        self._timestamp_field = timestamp_field
+        self._metrics = metrics if metrics else Metrics()
+        self._buffer = list()
+        self._oldest = None
+
+    def run(self, execute=True, end_after_empty=False, idle=None):
+        """
+        Polls and flushes until interrupted, the buffered documents are flushed before returning.
+        :param execute: Should the statements generated be executed against Neo4j?
+        :param end_after_empty: return once a poll finds no new documents
+        :param idle: function called when a poll finds no new documents and nothing is buffered, e.g. pruning
+        """
+        self._logger.info("micro batching up to {} documents or {} seconds".format(self._max_size, self._max_delay))
+        try:
+            while 1:
+                hits = self._scroller.poll(self._timestamp_field)
+                if hits:
+                    if self._oldest is None:
+                        self._oldest = monotonic()
+                    self._buffer.extend(hits)
+                while len(self._buffer) >= self._max_size:
+                    self._flush(execute)
+                if self._buffer and monotonic() - self._oldest >= self._max_delay:
+                    self._flush(execute)
+                if not hits:
+                    if idle and not self._buffer:
+                        idle()
+                    if end_after_empty:
+                        break
+                    wait = self._poll_interval
+                    if self._buffer:
+                        wait = min(wait, max(0.0, self._oldest + self._max_delay - monotonic()))
+                    sleep(wait)
+        finally:
+            while self._buffer:
+                self._flush(execute)
+
+    def _flush(self, execute):
+        """
+        Writes up to max_size buffered documents and records the lag of each one.
+        :param execute: Should the statements generated be executed against Neo4j?
+        """
+        batch = self._buffer[:self._max_size]
+        self._buffer = self._buffer[self._max_size:]
+        if not self._buffer:
+            self._oldest = None
+        self._logger.debug("flushing micro batch of {} documents".format(len(batch)))
+        self._builder.build(batch, execute)
+        now = time()
+        for hit in batch:
+            self._metrics.observe("e2n_lag_seconds", max(0.0, now - hit['sort'][0] / 1000))
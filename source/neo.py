@@ -1,9 +1,19 @@
 from neo4j import GraphDatabase
+from source.writer import StatementWriter, RowWriter, DEFAULT_BATCH_SIZE, DEFAULT_MAX_RETRIES, \
+    DEFAULT_RETRY_BACKOFF, DEFAULT_DEAD_LETTER_FILE, DEFAULT_SERVER_BATCH_SIZE, CHANGED_COLUMN, open_session
+from source.metrics import Metrics
+from source.memo import MemoCache
+from source.plans import explain, flagged_operators
+from source.columnar import ColumnarExtractor
+from source.routing import Router, Target, DEFAULT_TARGET, DEFAULT_QUEUE_SIZE
 import logging
 from os import listdir
-from os.path import isfile, join
+from os.path import isfile, join, splitext
 from importlib.machinery import SourceFileLoader
 from copy import deepcopy
+from collections import OrderedDict
+from time import perf_counter
+from hashlib import blake2b
 
 # Load up the overall module logger
 module_logger = logging.getLogger('elastic2neo.neo')
@@ -20,9 +30,42 @@ REQUIRED_PRE_FUNC = ['pre_process_doc']
 REQUIRED_POST_NODE_FUNC = ['post_process_nodes']
 REQUIRED_POST_RELATIONSHIP_FUNC = ['post_process_relationships']
 
+# Optional batch functions, called once per group of documents and preferred over the functions above
+BATCH_PRE_FUNC = 'pre_process_docs'
+BATCH_POST_NODE_FUNC = 'post_process_nodes_batch'
+BATCH_POST_RELATIONSHIP_FUNC = 'post_process_relationships_batch'
+
+# Aggregations supported by relationship rollups
+ROLLUP_AGGREGATIONS = ['sum', 'min', 'max']
+
+# Document key of the bucket weight of pre-aggregated documents, the number of documents the bucket stands for and the
+# min, max and sum of the rollup timestamp and aggregation keys
+WEIGHT_KEY = "_e2nWeight"
+
+# Optional function called with the shared MemoCache when a processing module is loaded
+MEMO_SETUP_FUNC = 'set_memo'
+
+# The default number of graph elements (node and relationship instances) buffered before they are written
+DEFAULT_CHUNK_SIZE = 1000
+
+# The default sampling of the per mapping node latency histogram, the nodes of every Nth document are timed
+DEFAULT_NODE_SAMPLE_EVERY = 100
+
+# The default number of documents handed to the processors and node and relationship generation at a time
+DEFAULT_PROCESSOR_BATCH_SIZE = 100
+
+# The default property delta writes store the content hash of the settable properties in
+DEFAULT_HASH_PROPERTY = "e2nHash"
+
 
 class GraphBuilder:
-    def __init__(self, uri, user, password, mapping, pre=True, post_node=True, post_relationship=True, execute=True):
+    def __init__(self, uri, user, password, mapping, pre=True, post_node=True, post_relationship=True, execute=True,
+                 chunk_size=DEFAULT_CHUNK_SIZE, batch_size=DEFAULT_BATCH_SIZE, max_retries=DEFAULT_MAX_RETRIES,
+                 retry_backoff=DEFAULT_RETRY_BACKOFF, dead_letter_file=DEFAULT_DEAD_LETTER_FILE, metrics=None,
+                 driver=None, profiler=None, memo=None, fingerprints=None, write_mode="statements",
+                 server_batch_size=DEFAULT_SERVER_BATCH_SIZE, extraction="documents", last_seen=None,
+                 hash_property=None, routes=None, processor_batch_size=DEFAULT_PROCESSOR_BATCH_SIZE,
+                 encrypted=False, node_sample_every=DEFAULT_NODE_SAMPLE_EVERY):
         """
         A GraphBuilding class for generating and executing Cypher statements based on Elasticsearch documents.
         :param uri: URI of the Neo4j serer (include protocol and port e.g. bolt://localhost:7687 )
@@ -32,92 +75,507 @@ class GraphBuilder:
         :param pre: should pre-processing be done?
         :param post_node: should post node processing be done?
         :param post_relationship: should post relationship processing be done?
+        :param execute: should a connection to Neo4j be made?
+        :param chunk_size: the high-water mark of nodes and relationships held in memory before they are written
+        :param batch_size: how many statements are executed in a single transaction
+        :param max_retries: how many times a batch is retried after a transient error
+        :param retry_backoff: the base delay in seconds between retries
+        :param dead_letter_file: the file that statements which cannot be executed are appended to
+        :param metrics: the Metrics object used to instrument the pipeline
+        :param driver: an already created Neo4j driver to use instead of connecting to the uri
+        :param profiler: a Profiler object used to time processors and sample batches (None disables profiling)
+        :param memo: the MemoCache shared with the processing modules
+        :param fingerprints: a FingerprintStore used to skip unchanged documents (None disables skipping)
+        :param write_mode: statements to send interpolated statements or server to send parameter rows that the server
+        commits in batches
+        :param server_batch_size: how many rows the server commits per transaction in server write mode
+        :param extraction: documents to build nodes and relationships per document or columnar to extract the rows of
+        chunk size documents at a time as columns (server write mode without processors or rollups only)
+        :param last_seen: the property every written node and relationship is stamped with the server time in epoch
+        milliseconds (None disables stamping)
+        :param hash_property: the property a content hash of the settable properties of MERGEd nodes and relationships
+        is stored in, the SET is skipped when the hash has not changed (None disables delta writes)
+        :param routes: list of route dictionaries (name, labels, types and the uri, user, password, database, encrypted
+        and queue_size of the target) that send nodes and relationships to other databases (None writes everything to
+        uri)
+        :param processor_batch_size: how many documents are processed at a time, the nodes and relationships of a group
+        are held in memory in addition to the chunk
+        :param encrypted: should the connections to Neo4j be encrypted? (a route can set its own encrypted value)
+        :param node_sample_every: time the nodes of every Nth document for the per mapping node latency histogram,
+        every document is timed while profiling (0 disables the histogram)
         """
         self._logger = logging.getLogger('elastic2neo.neo.GraphBuilder')
+        self._metrics = metrics if metrics else Metrics()
+        self._profiler = profiler
+        self._node_sample_every = node_sample_every
+        self._node_docs = 0
+        self._memo = memo if memo else MemoCache(metrics=self._metrics)
+        self._fingerprints = fingerprints
         self._driver = None
+        self._writer = None
+        self._row_writer = None
         if execute:
-            self._driver = GraphDatabase.driver(uri, auth=(user, password), encrypted=False)
+            self._driver = driver if driver else GraphDatabase.driver(uri, auth=(user, password), encrypted=encrypted)
+            self._writer = StatementWriter(self._driver, batch_size=batch_size, max_retries=max_retries,
+                                           retry_backoff=retry_backoff, dead_letter_file=dead_letter_file,
+                                           metrics=self._metrics)
+            if write_mode == "server":
+                self._row_writer = RowWriter(self._driver, batch_size=server_batch_size, metrics=self._metrics)
+        self._router = None
+        self._targets = OrderedDict()
+        self._pages = 0
+        if execute and routes:
+            self._router = Router(routes)
+            self._targets[DEFAULT_TARGET] = Target(DEFAULT_TARGET, self._driver, self._writer, self._row_writer,
+                                                   metrics=self._metrics)
+            for route in routes:
+                target_driver = GraphDatabase.driver(route.get('uri', uri), auth=(route.get('user', user),
+                                                                                  route.get('password', password)),
+                                                     encrypted=route.get('encrypted', encrypted))
+                database = route.get('database')
+                writer = StatementWriter(target_driver, batch_size=batch_size, max_retries=max_retries,
+                                         retry_backoff=retry_backoff, dead_letter_file=dead_letter_file,
+                                         metrics=self._metrics, database=database)
+                row_writer = None
+                if write_mode == "server":
+                    row_writer = RowWriter(target_driver, batch_size=server_batch_size, metrics=self._metrics,
+                                           database=database)
+                self._targets[route['name']] = Target(route['name'], target_driver, writer, row_writer, database,
+                                                      route.get('queue_size', DEFAULT_QUEUE_SIZE), self._metrics)
+            self._logger.info("routing writes to targets {}".format(", ".join(self._targets)))
         self._mapping = mapping
+        self._chunk_size = chunk_size
+        self._processor_batch_size = processor_batch_size
+        self._last_seen = last_seen
+        self._hash_property = hash_property
+        self._delta_checks = dict()
         self._pre_modules = list()
         self._post_node_modules = list()
         self._post_relationship_modules = list()
         self._load_additional_processing_modules(pre, post_node, post_relationship)
+        self._columnar = None
+        if extraction == "columnar":
+            if not self._row_writer:
+                self._logger.warning("columnar extraction requires the server write mode, extracting per document")
+            elif self._pre_modules or self._post_node_modules or self._post_relationship_modules:
+                self._logger.warning("columnar extraction cannot run processors, extracting per document")
+            elif any(relationship.get('rollup') for relationship in mapping['relationships']):
+                self._logger.warning("columnar extraction does not support rollups, extracting per document")
+            elif hash_property:
+                self._logger.warning("columnar extraction does not support delta writes, extracting per document")
+            elif self._router:
+                self._logger.warning("columnar extraction does not support routing, extracting per document")
+            else:
+                self._columnar = ColumnarExtractor(self, mapping)
 
     def close(self):
         """
-        Properly close the Neo4j driver.
+        Properly close the Neo4j drivers and save the memoization cache.
         """
+        self._memo.close()
+        if self._fingerprints:
+            self._fingerprints.close()
+        for name, target in self._targets.items():
+            target.close()
+            if name != DEFAULT_TARGET:
+                target.driver.close()
         if self._driver:
             self._driver.close()
 
+    def routed_stores(self):
+        """
+        Lists the routing targets other than the default target.
+        :return: list of tuples of the name, driver and database of each target
+        """
+        return [(name, target.driver, target.database) for name, target in self._targets.items()
+                if name != DEFAULT_TARGET]
+
     def build(self, data, execute=True):
         """
         Build out the graph based on the provided elastic data.
         :param data: The elastic data
         :param execute: Should statements be executed against database? (False for debugging purposes)
         """
-        nodes, relationships = self._process(data)
-        node_statements, relationship_statements = self._gen_statements(nodes, relationships)
-        if execute:
-            self._execute_statements(node_statements, relationship_statements)
+        if self._profiler:
+            with self._profiler.batch():
+                self._build(data, execute)
+        else:
+            self._build(data, execute)
 
-    def _execute_statements(self, node_statements, relationship_statements):
+    def _build(self, data, execute):
         """
-        Executes the provided node and relationship generation statements.
-        :param node_statements: list of node statements
-        :param relationship_statements: list of relationship statements
+        Streams the data through processing, statement generation and execution.
+        :param data: The elastic data
+        :param execute: Should statements be executed against database?
         """
-        self._logger.info("executing {} node statements and {} relationship statements against database".format(
-            len(node_statements), len(relationship_statements)))
-        with self._driver.session() as session:
-            for statement in node_statements:
-                self._logger.debug("executing statement: {}".format(statement))
-                result = session.write_transaction(self._run_statement, statement)
-                self._logger.debug('execution result: {}'.format(result))
-            for statement in relationship_statements:
-                self._logger.debug("executing statement: {}".format(statement))
-                result = session.write_transaction(self._run_statement, statement)
-                self._logger.debug('execution result: {}'.format(result))
+        fingerprints = None
+        dead_letters = 0
+        if self._fingerprints:
+            data, fingerprints = self._fingerprints.filter(data)
+            dead_letters = self._metrics.total("e2n_dead_letters_total")
+        if execute and self._router:
+            self._execute_routed(data)
+        elif execute and self._columnar:
+            for i in range(0, len(data), self._chunk_size):
+                self._execute_columnar(data[i:i + self._chunk_size])
+        elif execute and self._row_writer:
+            for nodes, relationships in self._process(data):
+                self._execute_rows(nodes, relationships)
+        else:
+            for node_statements, relationship_statements in self._gen_statements(self._process(data)):
+                if execute:
+                    with self._metrics.time("e2n_stage_seconds", stage="execute"):
+                        self._execute_statements(node_statements, relationship_statements)
+        if execute and fingerprints:
+            if self._metrics.total("e2n_dead_letters_total") > dead_letters:
+                # Statements cannot be traced back to their documents, the whole page is written again next time
+                self._logger.warning("statements were dead lettered, not recording the fingerprints of {} "
+                                     "documents".format(len(fingerprints)))
+            else:
+                self._fingerprints.commit(fingerprints)
 
     @staticmethod
-    def _run_statement(tx, statement):
+    def mapped_keys(mapping):
+        """
+        Collects the document keys referenced by the mapping.
+        :param mapping: mapping as a dictionary
+        :return: sorted list of dotted document keys
+        """
+        keys = set()
+        for node in mapping['nodes']:
+            if node['nodeType'] == 'iterator':
+                keys.add(node['iterator'])
+            for prop in (node.get('properties') or dict()).values():
+                if prop['key'] != 'ITER!':
+                    keys.add(prop['key'])
+        for relationship in mapping['relationships']:
+            for prop in (relationship.get('properties') or dict()).values():
+                keys.add(prop['key'])
+        return sorted(keys)
+
+    @staticmethod
+    def required_keys(mapping):
+        """
+        Collects the document keys every valid document must contain: the iterator and requiredProperties keys of the
+        required nodes, of the nodes used by required relationships and the requiredProperties keys of the required
+        relationships.
+        :param mapping: mapping as a dictionary
+        :return: sorted list of dotted document keys
+        """
+        nodes = {node['id']: node for node in mapping['nodes']}
+        required_nodes = [node['id'] for node in mapping['nodes'] if node['required']]
+        keys = set()
+        for relationship in mapping['relationships']:
+            if relationship['required']:
+                required_nodes += [relationship['sourceNode'], relationship['destinationNode']]
+                for key in relationship.get('requiredProperties') or list():
+                    keys.add(relationship['properties'][key]['key'])
+        for node_id in set(required_nodes):
+            node = nodes.get(node_id)
+            if not node:
+                continue
+            if node['nodeType'] == 'iterator':
+                keys.add(node['iterator'])
+            for key in node.get('requiredProperties') or list():
+                if node['properties'][key]['key'] != 'ITER!':
+                    keys.add(node['properties'][key]['key'])
+        return sorted(keys)
+
+    def pushdown_keys(self):
+        """
+        Gets the required document keys that can be pushed into the Elasticsearch query. Nothing is pushed down when
+        processors are loaded since they can add the keys to the documents or the values to the nodes.
+        :return: sorted list of dotted document keys
+        """
+        if self._pre_modules or self._post_node_modules or self._post_relationship_modules:
+            self._logger.info("processors are loaded, required keys are not pushed into the Elasticsearch query")
+            return list()
+        return self.required_keys(self._mapping)
+
+    @staticmethod
+    def sample_doc(mapping):
+        """
+        Creates a document that contains every key referenced by the mapping, with placeholder values of the mapped
+        types, so that every node and relationship of the mapping can be generated from it.
+        :param mapping: mapping as a dictionary
+        :return: elastic document
+        """
+        samples = {"number": 0, "datetime": "2000-01-01T00:00:00", "list": ["sample"]}
+        iterators = GraphBuilder._iterator_keys(mapping)
+        source = dict()
+        for key, value_type in GraphBuilder._mapped_key_types(mapping).items():
+            value = samples.get(value_type, "sample")
+            item = source
+            keys = key.split(".")
+            for part in keys[:-1]:
+                item = item.setdefault(part, dict())
+            item[keys[-1]] = [value] if key in iterators else value
+        return {"_id": "sample", "_source": source}
+
+    @staticmethod
+    def _mapped_key_types(mapping):
+        """
+        Maps each document key referenced by the mapping to its type, iterator keys take the type of their ITER!
+        property.
+        :param mapping: mapping as a dictionary
+        :return: dictionary of dotted document key to type
+        """
+        types = dict()
+        for node in mapping['nodes']:
+            if node['nodeType'] == 'iterator':
+                types.setdefault(node['iterator'], "string")
+            for prop in (node.get('properties') or dict()).values():
+                types[node['iterator'] if prop['key'] == 'ITER!' else prop['key']] = prop['type']
+        for relationship in mapping['relationships']:
+            for prop in (relationship.get('properties') or dict()).values():
+                types[prop['key']] = prop['type']
+        return types
+
+    @staticmethod
+    def _iterator_keys(mapping):
+        """
+        Collects the iterator keys of the mapping.
+        :param mapping: mapping as a dictionary
+        :return: set of dotted document keys
+        """
+        return set(node['iterator'] for node in mapping['nodes'] if node['nodeType'] == 'iterator')
+
+    def representative_statements(self):
         """
-        Execute the given statement against the Neo4j database.
-        :param tx: function
-        :param statement: Cypher statement string
-        :return: results
+        Renders one statement for every node and relationship of the mapping from a sample document, as rows for the
+        server write mode or as a literal statement otherwise.
+        :return: list of tuples of the mapping id, the statement and its parameters
         """
-        result = tx.run(statement)
-        return result.single()
+        doc = self.sample_doc(self._mapping)['_source']
+        nodes, _ = self._gen_nodes(doc)
+        relationships, _ = self._gen_relationships(doc, nodes)
+        statements = list()
+        for node in nodes:
+            if self._row_writer:
+                template, rows = next(iter(self._gen_rows([node], list())[0].items()))
+                statements.append((node['id'], "UNWIND $rows AS row {}".format(template), {"rows": rows}))
+            else:
+                statements.append((node['id'], next(self._gen_node_statements([node])), None))
+        for relationship in relationships:
+            shape = relationship['type']
+            if self._row_writer and 'rollup' not in relationship:
+                template, rows = next(iter(self._gen_rows(list(), [relationship])[1].items()))
+                statements.append((shape, "UNWIND $rows AS row {}".format(template), {"rows": rows}))
+            else:
+                statements.append((shape, next(self._gen_relationship_statements([relationship])), None))
+        return statements
+
+    def check_plans(self):
+        """
+        Runs EXPLAIN on a representative statement of every node and relationship of the mapping and logs the ones
+        whose plan scans nodes by label, scans all nodes or builds a cartesian product of scans, usually because an
+        index is missing or the matched properties are not indexed.
+        :return: list of tuples of the mapping id, the statement and the flagged operators or error
+        """
+        if not self._driver:
+            return list()
+        problems = list()
+        statements = self.representative_statements()
+        for shape, statement, parameters in statements:
+            try:
+                if self._router:
+                    target = self._targets[self._router.shape_target(self._mapping, shape)]
+                    plan = explain(target.driver, statement, parameters, target.database)
+                else:
+                    plan = explain(self._driver, statement, parameters)
+                flagged = flagged_operators(plan)
+            except Exception as e:
+                flagged = ["error: {}".format(e)]
+            if flagged:
+                self._logger.warning("statement for {} plans with {}: {}".format(shape, ", ".join(flagged), statement))
+                problems.append((shape, statement, flagged))
+            else:
+                self._logger.debug("statement for {} plans without scans".format(shape))
+        self._logger.info("checked the plans of {} statement shapes, {} flagged".format(len(statements),
+                                                                                         len(problems)))
+        return problems
+
+    def _execute_routed(self, data):
+        """
+        Splits every chunk between the targets and queues each part on its target, then waits for every target to
+        write the page. The fingerprints are only committed once every target has written the page, so after a failing
+        target or a restart the documents it has not written are not skipped.
+        :param data: The elastic data
+        """
+        self._pages += 1
+        for nodes, relationships in self._process(data):
+            for name, (target_nodes, target_relationships) in self._router.split(nodes, relationships).items():
+                target = self._targets[name]
+                target.submit(self._execute_target, target_nodes, target_relationships, target)
+        error = None
+        for target in self._targets.values():
+            try:
+                target.wait(self._pages)
+            except Exception as e:
+                error = error if error else e
+        if error:
+            raise error
 
-    def _gen_statements(self, nodes, relationships):
+    def _execute_target(self, nodes, relationships, target):
         """
-        Generates the proper Cypher CREATE and MERGE statements for the given nodes and relationships.
+        Writes the part of a chunk routed to a target, called by the thread of the target.
         :param nodes: The list of nodes
         :param relationships: The list of relationships
-        :return: a tuple containing a list of node statements and a list of relationship statements
+        :param target: the Target
+        """
+        if target.row_writer:
+            self._execute_rows(nodes, relationships, target)
+        else:
+            for node_statements, relationship_statements in self._gen_statements([(nodes, relationships)]):
+                with self._metrics.time("e2n_stage_seconds", stage="execute"):
+                    self._execute_statements(node_statements, relationship_statements, target)
+
+    def _execute_statements(self, node_statements, relationship_statements, target=None):
         """
-        self._logger.debug("generating statements")
-        node_statements = self._gen_node_statements(nodes)
-        relationship_statements = self._gen_relationship_statements(relationships)
-        return node_statements, relationship_statements
+        Executes the provided node and relationship generation statements.
+        :param node_statements: list of node statements
+        :param relationship_statements: list of relationship statements
+        :param target: the Target the statements are routed to (None without routing)
+        """
+        writer = target.writer if target else self._writer
+        self._logger.info("executing {} node statements and {} relationship statements against {}".format(
+            len(node_statements), len(relationship_statements), target.name if target else "database"))
+        writer.write(node_statements)
+        writer.write(relationship_statements)
+
+    def _execute_rows(self, nodes, relationships, target=None):
+        """
+        Writes the nodes and relationships as parameter rows that the server commits in batches. If the server side
+        write fails the templates that have not been written yet are written as statements so failures are retried and
+        dead lettered, followed by the rollup statements that have not been committed. A template whose server side
+        write failed part way may have committed some of its rows, which are written again.
+        :param nodes: The list of nodes
+        :param relationships: The list of relationships
+        :param target: the Target the chunk is routed to (None without routing)
+        """
+        writer = target.writer if target else self._writer
+        row_writer = target.row_writer if target else self._row_writer
+        elements = dict()
+        pending = None
+        rollup_statements = list()
+        rollups_written = 0
+        try:
+            with self._metrics.time("e2n_stage_seconds", stage="generate"):
+                node_rows, relationship_rows = self._gen_rows(nodes, relationships, elements)
+                rollup_statements = list(self._gen_relationship_statements(
+                    [relationship for relationship in relationships if 'rollup' in relationship]))
+            pending = OrderedDict((template, True) for template in list(node_rows) + list(relationship_rows))
+            with self._metrics.time("e2n_stage_seconds", stage="execute"):
+                self._logger.info("writing {} node rows and {} relationship rows against database".format(
+                    sum(len(rows) for rows in node_rows.values()),
+                    sum(len(rows) for rows in relationship_rows.values())))
+                for template, rows in list(node_rows.items()) + list(relationship_rows.items()):
+                    self._write_changed_rows(row_writer, template, rows, target)
+                    del pending[template]
+                # Rollup statements add to counts, so each batch is only ever committed once
+                for i in range(0, len(rollup_statements), writer.batch_size):
+                    writer.write(rollup_statements[i:i + writer.batch_size])
+                    rollups_written = i + writer.batch_size
+        except Exception as e:
+            if pending is None:
+                self._logger.warning("server side batch failed, writing the chunk as statements: {}".format(e))
+                chunk = (nodes, relationships)
+            else:
+                self._logger.warning("server side batch failed, writing {} unwritten templates as statements: "
+                                     "{}".format(len(pending), e))
+                chunk = ([element for template in node_rows if template in pending for element in elements[template]],
+                         [element for template in relationship_rows if template in pending
+                          for element in elements[template]])
+            for node_statements, relationship_statements in self._gen_statements([chunk]):
+                with self._metrics.time("e2n_stage_seconds", stage="execute"):
+                    self._execute_statements(node_statements, relationship_statements, target)
+            # The pending elements hold no rollups, the uncommitted rollup statements are written as generated
+            if pending is not None and rollups_written < len(rollup_statements):
+                with self._metrics.time("e2n_stage_seconds", stage="execute"):
+                    writer.write(rollup_statements[rollups_written:])
+
+    def _write_changed_rows(self, row_writer, template, rows, target=None):
+        """
+        Writes the rows of a template. For a delta write template the rows whose content hash already matches the
+        element are first looked up in one read transaction and dropped, with stamping enabled they are written with a
+        template that only sets the stamp.
+        :param row_writer: the RowWriter the rows are written with
+        :param template: the statement template
+        :param rows: list of parameter rows
+        :param target: the Target the rows are routed to (None without routing)
+        """
+        check, stamp = self._delta_checks.get(template, (None, None))
+        if not check or not rows:
+            row_writer.write(template, rows)
+            return
+        with open_session(target.driver if target else self._driver, target.database if target else None) as session:
+            unchanged = set(session.read_transaction(lambda tx: [record["i"] for record in tx.run(check,
+                                                                                                  {"rows": rows})]))
+        if unchanged:
+            self._metrics.inc("e2n_updates_skipped_total", len(unchanged))
+        changed = [row for i, row in enumerate(rows) if i not in unchanged]
+        if changed:
+            row_writer.write(template, changed)
+        if stamp and unchanged:
+            row_writer.write(stamp, [row for i, row in enumerate(rows) if i in unchanged])
+
+    def _execute_columnar(self, data):
+        """
+        Extracts the parameter rows of the documents as columns and writes them. If the extraction or the server side
+        write fails the documents go through the document pipeline instead.
+        :param data: The elastic data
+        """
+        try:
+            with self._metrics.time("e2n_stage_seconds", stage="process"):
+                node_rows, relationship_rows, counts = self._columnar.rows([doc['_source'] for doc in data])
+            with self._metrics.time("e2n_stage_seconds", stage="execute"):
+                self._logger.info("writing {} node rows and {} relationship rows against database".format(
+                    counts["nodes"], counts["relationships"]))
+                for template, rows in node_rows.items():
+                    self._row_writer.write(template, rows)
+                for template, rows in relationship_rows.items():
+                    self._row_writer.write(template, rows)
+        except Exception as e:
+            self._logger.warning("columnar write failed, writing the documents through the document pipeline: "
+                                 "{}".format(e))
+            for nodes, relationships in self._process(data):
+                self._execute_rows(nodes, relationships)
+            return
+        self._metrics.inc("e2n_docs_total", len(data))
+        self._metrics.inc("e2n_docs_valid_total", counts["valid"])
+        self._metrics.inc("e2n_docs_invalid_total", counts["invalid"])
+        self._metrics.inc("e2n_nodes_total", counts["nodes"])
+        self._metrics.inc("e2n_relationships_total", counts["relationships"])
+
+    def _gen_statements(self, chunks):
+        """
+        Generates the proper Cypher CREATE and MERGE statements for each chunk of nodes and relationships.
+        :param chunks: iterable of tuples containing a list of nodes and a list of relationships
+        :return: generator of tuples containing a list of node statements and a list of relationship statements
+        """
+        for nodes, relationships in chunks:
+            self._logger.debug("generating statements")
+            with self._metrics.time("e2n_stage_seconds", stage="generate"):
+                node_statements = list(self._gen_node_statements(nodes))
+                relationship_statements = list(self._gen_relationship_statements(relationships))
+            self._metrics.inc("e2n_statements_total", len(node_statements) + len(relationship_statements))
+            yield node_statements, relationship_statements
 
     def _gen_node_statements(self, nodes):
         """
         Break out function for generating node statements.
         :param nodes: list of nodes
-        :return: list of node statements
+        :return: generator of node statements
         """
-        node_statements = list()
         for node in nodes:
             if node['nodeType'] == "iterator":
                 statements = self._gen_iterator_node_statements(node)
             else:
                 statements = self._gen_standard_node_statements(node)
             for statement in statements:
+                statement = self._finish(statement, "n")
                 self._logger.debug("created node statement: {}".format(statement))
-                node_statements.append(statement)
-        return node_statements
+                yield statement
 
     def _gen_standard_node_statements(self, node):
         """
@@ -138,7 +596,7 @@ class GraphBuilder:
                 if prop not in node['uniqueProperties']:
                     need_to_set[prop] = node['properties'][prop]
             if len(need_to_set) > 0:
-                statement += self._gen_properties_string(need_to_set, dict_style=False)
+                statement += self._gen_set_string(need_to_set)
             if len(not_in_unique) > 0:
                 if len(need_to_set) > 0:
                     statement += ", n{}".format(self._gen_label_string(not_in_unique))
@@ -179,7 +637,7 @@ class GraphBuilder:
                     if prop not in instance['uniqueProperties']:
                         need_to_set[prop] = instance['uniqueProperties'][prop]
                 if len(need_to_set) > 0:
-                    statement += self._gen_properties_string(need_to_set, dict_style=False)
+                    statement += self._gen_set_string(need_to_set)
                 if len(not_in_unique) > 0:
                     if len(need_to_set) > 0:
                         statement += ", n{}".format(self._gen_label_string(not_in_unique))
@@ -218,18 +676,411 @@ class GraphBuilder:
         """
         Break out function for generating relationship statements.
         :param relationships: list of relationships
-        :return: list of relationship statements
+        :return: generator of relationship statements
         """
-        relationship_statements = list()
+        rollups = OrderedDict()
         for relationship in relationships:
+            if 'rollup' in relationship:
+                self._add_rollup(rollups, relationship)
+                continue
             if relationship['relationshipType'] == "iterator":
                 statements = self._gen_iterative_relationship_statements(relationship)
             else:
                 statements = self._gen_standard_relationship_statements(relationship)
             for statement in statements:
+                statement = self._finish(statement, "r")
                 self._logger.debug("created relationship statement: {}".format(statement))
-                relationship_statements.append(statement)
-        return relationship_statements
+                yield statement
+        for rollup in rollups.values():
+            statement = self._stamp(self._gen_rollup_statement(rollup), "r")
+            self._logger.debug("created rollup relationship statement: {}".format(statement))
+            yield statement
+
+    def _add_rollup(self, rollups, relationship):
+        """
+        Aggregates the instances of a rollup relationship by source, destination and type.
+        :param rollups: dictionary of rollup key to aggregated edge
+        :param relationship: a relationship with a rollup mapping
+        """
+        edges = self._relationship_edges(relationship)
+        config = relationship['rollup'] if isinstance(relationship['rollup'], dict) else dict()
+        aggregations = config.get('aggregations') or dict()
+        weight = relationship.get('weight') or {"count": 1, "properties": dict()}
+        for source, destination, instance in edges:
+            match = self._gen_match_string(source, destination)
+            unique = instance.get('uniqueProperties') or dict()
+            key = (match, relationship['type'], instance.get('directionality', relationship.get('directionality')),
+                   self._gen_properties_string(unique) if unique else "")
+            if key not in rollups:
+                rollups[key] = {"match": match, "type": key[1], "directionality": key[2], "unique": key[3],
+                                "count": 0, "firstSeen": None, "lastSeen": None, "aggregations": dict(),
+                                "properties": dict()}
+            rollup = rollups[key]
+            rollup["count"] += weight["count"]
+            for name, prop in (instance.get('properties') or dict()).items():
+                if name in unique:
+                    continue
+                values = weight["properties"].get(name, dict())
+                if name == config.get('timestamp'):
+                    first = dict(prop, value=values["min"]) if "min" in values else prop
+                    last = dict(prop, value=values["max"]) if "max" in values else prop
+                    if rollup["firstSeen"] is None or first["value"] < rollup["firstSeen"]["value"]:
+                        rollup["firstSeen"] = first
+                    if rollup["lastSeen"] is None or last["value"] > rollup["lastSeen"]["value"]:
+                        rollup["lastSeen"] = last
+                elif name in aggregations:
+                    function = aggregations[name]
+                    if function in values:
+                        prop = dict(prop, value=values[function])
+                    if name not in rollup["aggregations"]:
+                        rollup["aggregations"][name] = {"function": function, "value": prop["value"],
+                                                        "type": prop["type"]}
+                    elif function == "sum":
+                        rollup["aggregations"][name]["value"] += prop["value"]
+                    elif function == "min":
+                        rollup["aggregations"][name]["value"] = min(rollup["aggregations"][name]["value"],
+                                                                    prop["value"])
+                    elif function == "max":
+                        rollup["aggregations"][name]["value"] = max(rollup["aggregations"][name]["value"],
+                                                                    prop["value"])
+                else:
+                    rollup["properties"][name] = prop
+
+    @staticmethod
+    def _rollup_weight(weight, relationship):
+        """
+        Resolves the bucket weight of a pre-aggregated document to the properties of a rollup relationship.
+        :param weight: the weight of the document, the count and dictionaries of function to document key to value
+        :param relationship: the relationship mapping
+        :return: dictionary of the count and of property name to function to value
+        """
+        properties = dict()
+        for name, prop in (relationship.get('properties') or dict()).items():
+            values = {function: weight[function][prop['key']] for function in ROLLUP_AGGREGATIONS
+                      if prop['key'] in weight.get(function, dict())}
+            if values:
+                properties[name] = values
+        return {"count": weight["count"], "properties": properties}
+
+    @staticmethod
+    def _relationship_edges(relationship):
+        """
+        Lists the individual edges of a standard or iterator relationship.
+        :param relationship: a relationship
+        :return: list of tuples of the source node, destination node and relationship instance of each edge
+        """
+        if relationship['relationshipType'] == "iterator":
+            if relationship['sourceNode']['nodeType'] == "iterator":
+                return [(node_instance, relationship['destinationNode'], rel_instance) for node_instance, rel_instance
+                        in zip(relationship['sourceNode']['instances'], relationship['instances'])]
+            return [(relationship['sourceNode'], node_instance, rel_instance) for node_instance, rel_instance
+                    in zip(relationship['destinationNode']['instances'], relationship['instances'])]
+        return [(relationship['sourceNode'], relationship['destinationNode'], relationship)]
+
+    def _gen_rollup_statement(self, rollup):
+        """
+        Generates the MERGE statement of an aggregated rollup relationship. The count, firstSeen and lastSeen
+        properties and the configured aggregations are combined with the values already on the relationship.
+        :param rollup: the aggregated edge
+        :return: relationship statement
+        """
+        statement = rollup["match"] + " MERGE (s)"
+        if rollup["directionality"] == ">":
+            statement += "-[r:{}{}]->(d)".format(rollup["type"], rollup["unique"])
+        else:
+            statement += "<-[r:{}{}]-(d)".format(rollup["type"], rollup["unique"])
+        on_create = ["r.count = {}".format(rollup["count"])]
+        on_match = ["r.count = coalesce(r.count, 0) + {}".format(rollup["count"])]
+        if rollup["firstSeen"] is not None:
+            first_seen = self._get_property_value(rollup["firstSeen"])
+            last_seen = self._get_property_value(rollup["lastSeen"])
+            on_create.extend(["r.firstSeen = {}".format(first_seen), "r.lastSeen = {}".format(last_seen)])
+            on_match.extend(["r.firstSeen = CASE WHEN r.firstSeen IS NULL OR {0} < r.firstSeen THEN {0} "
+                             "ELSE r.firstSeen END".format(first_seen),
+                             "r.lastSeen = CASE WHEN r.lastSeen IS NULL OR {0} > r.lastSeen THEN {0} "
+                             "ELSE r.lastSeen END".format(last_seen)])
+        else:
+            on_create.extend(["r.firstSeen = datetime()", "r.lastSeen = datetime()"])
+            on_match.append("r.lastSeen = datetime()")
+        for name, aggregation in rollup["aggregations"].items():
+            value = self._get_property_value(aggregation)
+            on_create.append("r.{} = {}".format(name, value))
+            if aggregation["function"] == "sum":
+                on_match.append("r.{0} = coalesce(r.{0}, 0) + {1}".format(name, value))
+            elif aggregation["function"] == "min":
+                on_match.append("r.{0} = CASE WHEN r.{0} IS NULL OR {1} < r.{0} THEN {1} ELSE r.{0} END".format(
+                    name, value))
+            else:
+                on_match.append("r.{0} = CASE WHEN r.{0} IS NULL OR {1} > r.{0} THEN {1} ELSE r.{0} END".format(
+                    name, value))
+        for name, prop in rollup["properties"].items():
+            value = self._get_property_value(prop)
+            on_create.append("r.{} = {}".format(name, value))
+            on_match.append("r.{} = {}".format(name, value))
+        statement += " ON CREATE SET {} ON MATCH SET {}".format(", ".join(on_create), ", ".join(on_match))
+        return statement
+
+    def _gen_rows(self, nodes, relationships, elements=None):
+        """
+        Converts nodes and relationships to parameter rows grouped by statement template for UNWIND based writes.
+        Rollup relationships are skipped since they are aggregated into statements.
+        :param nodes: The list of nodes
+        :param relationships: The list of relationships
+        :param elements: dictionary filled with the template of each row to the nodes and relationships of its rows
+        with a single instance each, so the rows of a template can be written as statements (None skips it)
+        :return: a tuple containing dictionaries of node and relationship templates to their list of rows
+        """
+        node_rows = OrderedDict()
+        for node in nodes:
+            instances = node['instances'] if node['nodeType'] == "iterator" else [node]
+            for instance in instances:
+                template, row = self._gen_node_row(instance)
+                node_rows.setdefault(template, list()).append(row)
+                if elements is not None:
+                    elements.setdefault(template, list()).append(
+                        dict(node, instances=[instance]) if node['nodeType'] == "iterator" else node)
+        relationship_rows = OrderedDict()
+        for relationship in relationships:
+            if 'rollup' in relationship:
+                continue
+            for source, destination, instance in self._relationship_edges(relationship):
+                template, row = self._gen_relationship_row(source, destination, instance)
+                relationship_rows.setdefault(template, list()).append(row)
+                if elements is not None:
+                    elements.setdefault(template, list()).append(
+                        self._single_edge(relationship, source, destination, instance))
+        return node_rows, relationship_rows
+
+    @staticmethod
+    def _single_edge(relationship, source, destination, instance):
+        """
+        Narrows a relationship down to one of its edges.
+        :param relationship: a relationship
+        :param source: the source node of the edge
+        :param destination: the destination node of the edge
+        :param instance: the relationship instance of the edge
+        :return: the relationship holding only the edge
+        """
+        if relationship['relationshipType'] != "iterator":
+            return relationship
+        if relationship['sourceNode']['nodeType'] == "iterator":
+            return dict(relationship, sourceNode=dict(relationship['sourceNode'], instances=[source]),
+                        instances=[instance])
+        return dict(relationship, destinationNode=dict(relationship['destinationNode'], instances=[destination]),
+                    instances=[instance])
+
+    def _gen_node_row(self, node):
+        """
+        Generates the statement template and parameter row of a standard node or iterator node instance.
+        :param node: standard node or node instance
+        :return: a tuple containing the template and the row
+        """
+        labels = node['uniqueLabels'] if 'uniqueLabels' in node else node['labels']
+        not_in_unique = GraphBuilder._get_missing_labels(node['labels'], labels)
+        properties = node['properties'] if 'properties' in node else dict()
+        need_to_set = dict()
+        if 'uniqueProperties' in node:
+            need_to_set = GraphBuilder._get_missing_props(properties, node['uniqueProperties'])
+            template = "MERGE (n{}{})".format(self._gen_label_string(labels),
+                                              self._gen_row_map_string(node['uniqueProperties'], "row"))
+        elif 'uniqueLabels' in node:
+            template = "MERGE (n{}{})".format(self._gen_label_string(labels),
+                                              self._gen_row_map_string(properties, "row"))
+        else:
+            template = "CREATE (n{}{})".format(self._gen_label_string(labels),
+                                               self._gen_row_map_string(properties, "row"))
+        head = template
+        assignments = ["n.{} = {}".format(prop, self._gen_row_expression(prop, need_to_set[prop], "row"))
+                       for prop in need_to_set]
+        row = {prop: self._get_row_value(properties[prop]) for prop in properties}
+        if self._hash_property and need_to_set:
+            assignments.append("n.{0} = row.{0}".format(self._hash_property))
+            row[self._hash_property] = self._content_hash(need_to_set, "n")
+        if len(not_in_unique) > 0:
+            assignments.append("n{}".format(self._gen_label_string(not_in_unique)))
+        if len(assignments) > 0:
+            template += " SET " + ", ".join(assignments)
+        template = self._stamp(template, "n")
+        if self._hash_property and need_to_set and template not in self._delta_checks:
+            self._delta_checks[template] = self._gen_delta_check("MATCH" + head[len("MERGE"):], "n", "row")
+        return template, row
+
+    def _gen_relationship_row(self, source, destination, relationship):
+        """
+        Generates the statement template and parameter row of a single relationship edge.
+        :param source: the source node or node instance
+        :param destination: the destination node or node instance
+        :param relationship: the standard relationship or relationship instance
+        :return: a tuple containing the template and the row
+        """
+        row = dict()
+        template = "MATCH "
+        for variable, node in [("s", source), ("d", destination)]:
+            labels = node['uniqueLabels'] if 'uniqueLabels' in node else node['labels']
+            properties = node['uniqueProperties'] if 'uniqueProperties' in node else node.get('properties', dict())
+            template += "({}{}{}), ".format(variable, self._gen_label_string(labels),
+                                            self._gen_row_map_string(properties, "row." + variable))
+            row[variable] = {prop: self._get_row_value(properties[prop]) for prop in properties}
+        template = template[:-2]
+        properties = relationship['properties'] if 'properties' in relationship else dict()
+        unique = ('unique' in relationship and relationship['unique']) or 'uniqueProperties' in relationship
+        if unique:
+            unique_properties = relationship['uniqueProperties'] if 'uniqueProperties' in relationship else dict()
+            need_to_set = GraphBuilder._get_missing_props(properties, unique_properties)
+            pattern = "[r:{}{}]".format(relationship["type"], self._gen_row_map_string(unique_properties, "row.r"))
+            template += " MERGE (s)"
+        else:
+            need_to_set = properties
+            pattern = "[r:{}]".format(relationship["type"])
+            template += " CREATE (s)"
+        if relationship["directionality"] == ">":
+            template += "-{}->(d)".format(pattern)
+        else:
+            template += "<-{}-(d)".format(pattern)
+        head = template
+        assignments = ["r.{} = {}".format(prop, self._gen_row_expression(prop, need_to_set[prop], "row.r"))
+                       for prop in need_to_set]
+        row["r"] = {prop: self._get_row_value(properties[prop]) for prop in properties}
+        delta = self._hash_property and unique and need_to_set
+        if delta:
+            assignments.append("r.{0} = row.r.{0}".format(self._hash_property))
+            row["r"][self._hash_property] = self._content_hash(need_to_set, "r")
+        if len(assignments) > 0:
+            template += " SET " + ", ".join(assignments)
+        template = self._stamp(template, "r")
+        if delta and template not in self._delta_checks:
+            self._delta_checks[template] = self._gen_delta_check(head.replace(" MERGE (s)", " MATCH (s)", 1), "r",
+                                                                 "row.r")
+        return template, row
+
+    def _gen_set_string(self, need_to_set, variable="n"):
+        """
+        Creates the SET clause of the settable properties of a MERGEd node or relationship. With delta writes the
+        clause is guarded by the content hash stored on the element, so the SET and its write lock are skipped when
+        the properties have not changed.
+        :param need_to_set: dictionary of properties that are not part of the MERGE pattern
+        :param variable: the variable of the node (n) or relationship (r)
+        :return: the SET clause
+        """
+        set_string = self._gen_properties_string(need_to_set, dict_style=False, variable=variable)
+        if not self._hash_property:
+            return set_string
+        content_hash = self._content_hash(need_to_set, variable)
+        return '{0} WITH {1} WHERE {1}.{2} IS NULL OR {1}.{2} <> "{3}"{4}, {1}.{2} = "{3}"'.format(
+            self._stamp("", variable), variable, self._hash_property, content_hash, set_string)
+
+    def _content_hash(self, need_to_set, variable):
+        """
+        Hashes the rendered settable properties, so the statement and server write modes store the same hash.
+        :param need_to_set: dictionary of properties that are not part of the MERGE pattern
+        :param variable: the variable of the node (n) or relationship (r)
+        :return: 16 hex digit hash
+        """
+        set_string = self._gen_properties_string(need_to_set, dict_style=False, variable=variable)
+        return blake2b(set_string.encode("utf-8"), digest_size=8).hexdigest()
+
+    def _gen_delta_check(self, match, variable, row_variable):
+        """
+        Creates the read only statement that finds the rows of a delta write template whose element already has their
+        hash, and the template that only stamps those elements when stamping is enabled.
+        :param match: the template pattern of the element with MERGE replaced by MATCH
+        :param variable: the variable of the node (n) or relationship (r)
+        :param row_variable: the row map holding the hash
+        :return: tuple of the statement returning the indexes of the unchanged rows and the stamp template or None
+        """
+        check = "UNWIND range(0, size($rows) - 1) AS i WITH i, $rows[i] AS row {} WHERE {}.{} = {}.{} " \
+                "RETURN i".format(match, variable, self._hash_property, row_variable, self._hash_property)
+        return check, self._stamp(match, variable) if self._last_seen else None
+
+    def _finish(self, statement, variable):
+        """
+        Completes a node or relationship statement, delta writes return whether their SET was applied and the other
+        statements are stamped.
+        :param statement: the statement
+        :param variable: the variable of the written node (n) or relationship (r)
+        :return: the statement
+        """
+        guard = " WITH {0} WHERE {0}.{1} IS NULL".format(variable, self._hash_property)
+        if self._hash_property and guard in statement:
+            return "{} RETURN count(*) AS {}".format(statement, CHANGED_COLUMN)
+        return self._stamp(statement, variable)
+
+    def _stamp(self, statement, variable):
+        """
+        Appends the last seen stamp to a node or relationship statement or template when stamping is enabled.
+        :param statement: the statement or template
+        :param variable: the variable of the written node (n) or relationship (r)
+        :return: the statement
+        """
+        if self._last_seen:
+            return "{} SET {}.{} = timestamp()".format(statement, variable, self._last_seen)
+        return statement
+
+    @staticmethod
+    def _gen_row_map_string(properties, row_variable):
+        """
+        Creates a properties map that reads its values from a parameter row.
+        :param properties: dictionary of properties
+        :param row_variable: the Cypher expression of the row holding the values
+        :return: a properties map string
+        """
+        if len(properties) == 0:
+            return ""
+        return " {" + ", ".join("{}: {}".format(prop, GraphBuilder._gen_row_expression(prop, properties[prop],
+                                                                                     row_variable))
+                                for prop in properties) + "}"
+
+    @staticmethod
+    def _gen_row_expression(name, prop, row_variable):
+        """
+        Creates the Cypher expression that reads a property value from a parameter row.
+        :param name: the property name
+        :param prop: dictionary containing keys "type" and "value"
+        :param row_variable: the Cypher expression of the row holding the value
+        :return: expression string
+        """
+        if prop["type"] == "datetime":
+            return "datetime({}.{})".format(row_variable, name)
+        return "{}.{}".format(row_variable, name)
+
+    @staticmethod
+    def _get_row_value(prop):
+        """
+        Converts a property to the value sent as a query parameter.
+        :param prop: dictionary containing keys "type" and "value"
+        :return: the parameter value
+        """
+        if prop["type"] == "number":
+            if isinstance(prop["value"], str):
+                try:
+                    return int(prop["value"])
+                except ValueError:
+                    return float(prop["value"])
+            return prop["value"]
+        elif prop["type"] == "list":
+            return prop["value"]
+        return str(prop["value"])
+
+    def _gen_match_string(self, source, destination):
+        """
+        Creates the MATCH clause that finds the source (s) and destination (d) nodes of a relationship.
+        :param source: the source node or node instance
+        :param destination: the destination node or node instance
+        :return: match string
+        """
+        statement = "MATCH (s{}), (d{})".format(
+            self._gen_label_string(source['uniqueLabels'] if 'uniqueLabels' in source else source['labels']),
+            self._gen_label_string(destination['uniqueLabels'] if 'uniqueLabels' in destination
+                                   else destination['labels']))
+        conditions = list()
+        for variable, node in [("s", source), ("d", destination)]:
+            properties = node['uniqueProperties'] if 'uniqueProperties' in node else node.get('properties')
+            if properties:
+                conditions.append(self._gen_properties_string(properties, dict_style=False, match_logic=True,
+                                                              variable=variable, opening_statement=False))
+        if len(conditions) > 0:
+            statement += " WHERE " + " AND ".join(conditions)
+        return statement
 
     def _gen_standard_relationship_statements(self, relationship):
         """
@@ -289,8 +1140,7 @@ class GraphBuilder:
             else:
                 statement += "<-[r:{}]-(d)".format(relationship["type"])
         if len(need_to_set.keys()) > 0:
-            statement += "{}".format(self._gen_properties_string(need_to_set, dict_style=False,
-                                                                 variable="r"))
+            statement += self._gen_set_string(need_to_set, variable="r")
         elif not unique and 'properties' in relationship:
             statement += "{}".format(self._gen_properties_string(relationship['properties'], dict_style=False,
                                                                  variable="r"))
@@ -365,8 +1215,7 @@ class GraphBuilder:
                     else:
                         statement += "<-[r:{}]-(d)".format(rel_instance["type"])
                 if len(need_to_set.keys()) > 0:
-                    statement += "{}".format(self._gen_properties_string(need_to_set, dict_style=False,
-                                                                         variable="r"))
+                    statement += self._gen_set_string(need_to_set, variable="r")
                 elif not unique and 'properties' in rel_instance:
                     statement += "{}".format(self._gen_properties_string(rel_instance['properties'], dict_style=False,
                                                                          variable="r"))
@@ -432,8 +1281,7 @@ class GraphBuilder:
                     else:
                         statement += "<-[r:{}]-(d)".format(rel_instance["type"])
                 if len(need_to_set.keys()) > 0:
-                    statement += "{}".format(self._gen_properties_string(need_to_set, dict_style=False,
-                                                                         variable="r"))
+                    statement += self._gen_set_string(need_to_set, variable="r")
                 elif not unique and 'properties' in rel_instance:
                     statement += "{}".format(self._gen_properties_string(rel_instance['properties'], dict_style=False,
                                                                          variable="r"))
@@ -519,64 +1367,160 @@ class GraphBuilder:
 
     def _process(self, data):
         """
-        Conducts the processing of all the documents returned from elastic.
+        Conducts the processing of all the documents returned from elastic. Documents are handed to the processors in
+        groups of up to processor batch size documents and the resulting nodes and relationships are yielded in chunks
+        once the number of buffered node and relationship instances reaches the chunk size.
         :param data: The elastic data
-        :return: tuple containing a list of nodes and a list of relationships
+        :return: generator of tuples containing a list of nodes and a list of relationships
         """
         nodes = list()
         relationships = list()
+        buffered = 0
         self._logger.debug("processing data")
-        for doc in data:
-            doc = self._pre_process_doc(doc['_source'])
+        start = perf_counter()
+        for i in range(0, len(data), self._processor_batch_size):
+            docs = [doc['_source'] for doc in data[i:i + self._processor_batch_size]]
+            self._metrics.inc("e2n_docs_total", len(docs))
+            for doc_nodes, doc_relationships in self._process_docs(docs):
+                nodes.extend(doc_nodes)
+                relationships.extend(doc_relationships)
+                node_count = self._count_instances(doc_nodes)
+                relationship_count = self._count_instances(doc_relationships)
+                self._metrics.inc("e2n_nodes_total", node_count)
+                self._metrics.inc("e2n_relationships_total", relationship_count)
+                buffered += node_count + relationship_count
+                if buffered >= self._chunk_size:
+                    self._logger.debug("yielding chunk of {} nodes and relationships".format(buffered))
+                    self._metrics.observe("e2n_stage_seconds", perf_counter() - start, stage="process")
+                    yield nodes, relationships
+                    nodes = list()
+                    relationships = list()
+                    buffered = 0
+                    start = perf_counter()
+        self._metrics.observe("e2n_stage_seconds", perf_counter() - start, stage="process")
+        if buffered > 0:
+            yield nodes, relationships
+
+    def _process_docs(self, docs):
+        """
+        Runs a group of documents through the processors and node and relationship generation.
+        :param docs: list of elastic documents
+        :return: list of tuples containing the nodes and relationships of each valid document
+        """
+        docs = self._pre_process_docs(docs)
+        node_docs = list()
+        node_lists = list()
+        for doc in docs:
             doc_nodes, nodes_valid = self._gen_nodes(doc)
             if nodes_valid:
-                doc_nodes = self._post_process_nodes(deepcopy(doc_nodes))
-                doc_relationships, rels_valid = self._gen_relationships(doc, doc_nodes)
-                if rels_valid:
-                    doc_relationships = self._post_process_relationships(deepcopy(doc_relationships))
-                    nodes.extend(doc_nodes)
-                    relationships.extend(doc_relationships)
-                else:
-                    self._logger.debug("document did not generate all required relationships and is invalid")
+                node_docs.append(doc)
+                node_lists.append(deepcopy(doc_nodes))
             else:
+                self._metrics.inc("e2n_docs_invalid_total")
                 self._logger.debug("document did not generate all required nodes and is invalid")
-        return nodes, relationships
+        node_lists = self._post_process_nodes_batch(node_lists)
+        valid_node_lists = list()
+        relationship_lists = list()
+        for doc, doc_nodes in zip(node_docs, node_lists):
+            doc_relationships, rels_valid = self._gen_relationships(doc, doc_nodes)
+            if rels_valid:
+                valid_node_lists.append(doc_nodes)
+                relationship_lists.append(deepcopy(doc_relationships))
+            else:
+                self._metrics.inc("e2n_docs_invalid_total")
+                self._logger.debug("document did not generate all required relationships and is invalid")
+        relationship_lists = self._post_process_relationships_batch(relationship_lists)
+        self._metrics.inc("e2n_docs_valid_total", len(relationship_lists))
+        return list(zip(valid_node_lists, relationship_lists))
 
-    def _pre_process_doc(self, doc):
+    @staticmethod
+    def _count_instances(items):
         """
-        Calls the pre data processing modules.
-        :param doc: the elastic document to be processed
-        :return: the updated elastic document
+        Counts the graph elements represented by a list of nodes or relationships.
+        :param items: list of nodes or relationships
+        :return: the number of instances (iterator items count once per instance)
+        """
+        count = 0
+        for item in items:
+            if 'instances' in item:
+                count += len(item['instances'])
+            else:
+                count += 1
+        return count
+
+    def _pre_process_docs(self, docs):
+        """
+        Calls the pre data processing modules, using a module's batch function when it has one.
+        :param docs: list of elastic documents to be processed
+        :return: the updated list of elastic documents
         """
         if len(self._pre_modules):
             self._logger.debug("running pre-processors")
             for module in self._pre_modules:
-                doc = module.pre_process_doc(doc)
-        return doc
+                if hasattr(module, BATCH_PRE_FUNC):
+                    docs = self._run_processor(module, BATCH_PRE_FUNC, docs)
+                else:
+                    docs = [self._run_processor(module, 'pre_process_doc', doc) for doc in docs]
+        return docs
 
-    def _post_process_nodes(self, nodes):
+    def _post_process_nodes_batch(self, node_lists):
         """
-        Calls the post node processing modules.
-        :param nodes: the list of generated nodes
-        :return: the updated list of nodes
+        Calls the post node processing modules, using a module's batch function when it has one.
+        :param node_lists: list containing the list of generated nodes of each document
+        :return: the updated list of node lists
         """
         if len(self._post_node_modules):
             self._logger.debug("running post-node processors")
             for module in self._post_node_modules:
-                nodes = module.post_process_nodes(nodes)
-        return nodes
+                if hasattr(module, BATCH_POST_NODE_FUNC):
+                    node_lists = self._run_batch_processor(module, BATCH_POST_NODE_FUNC, node_lists)
+                else:
+                    node_lists = [self._run_processor(module, 'post_process_nodes', nodes) for nodes in node_lists]
+        return node_lists
 
-    def _post_process_relationships(self, relationships):
+    def _post_process_relationships_batch(self, relationship_lists):
         """
-        Calls the post relationship processing modules.
-        :param relationships: the list of generated relationships
-        :return: the updated list of relationships
+        Calls the post relationship processing modules, using a module's batch function when it has one.
+        :param relationship_lists: list containing the list of generated relationships of each document
+        :return: the updated list of relationship lists
         """
         if len(self._post_relationship_modules):
             self._logger.debug("running post-relationship processors")
             for module in self._post_relationship_modules:
-                relationships = module.post_process_relationships(relationships)
-        return relationships
+                if hasattr(module, BATCH_POST_RELATIONSHIP_FUNC):
+                    relationship_lists = self._run_batch_processor(module, BATCH_POST_RELATIONSHIP_FUNC,
+                                                                   relationship_lists)
+                else:
+                    relationship_lists = [self._run_processor(module, 'post_process_relationships', relationships)
+                                          for relationships in relationship_lists]
+        return relationship_lists
+
+    def _run_batch_processor(self, module, function, lists):
+        """
+        Calls a batch post processing function, which must return one list per document.
+        :param module: the processing module
+        :param function: the name of the batch function to call
+        :param lists: list containing one list per document
+        :return: the list of lists returned by the function
+        """
+        result = self._run_processor(module, function, lists)
+        if len(result) != len(lists):
+            raise ValueError("{}.{} returned {} lists for {} documents".format(module.__name__, function,
+                                                                               len(result), len(lists)))
+        return result
+
+    def _run_processor(self, module, function, data):
+        """
+        Calls a processing function of a module, timing the call when profiling is enabled.
+        :param module: the processing module
+        :param function: the name of the function to call
+        :param data: the data passed to the function
+        :return: the data returned by the function
+        """
+        if self._profiler:
+            with self._profiler.time("{}.{}".format(module.__name__, function)):
+                return getattr(module, function)(data)
+        return getattr(module, function)(data)
 
     def _gen_nodes(self, doc):
         """
@@ -586,7 +1530,12 @@ class GraphBuilder:
         """
         nodes = list()
         valid_doc = True
+        # Timing every node of every document is only worth its cost while profiling, otherwise a sample is timed
+        self._node_docs += 1
+        timed = self._profiler is not None or (self._node_sample_every > 0 and
+                                               self._node_docs % self._node_sample_every == 0)
         for node in self._mapping['nodes']:
+            start = perf_counter() if timed else 0
             new_node = {"nodeType": node['nodeType'], "labels": node['labels'], "id": node['id']}
             if node['nodeType'] == 'standard':
                 new_node, valid = self._gen_standard_node(doc, node, deepcopy(new_node))
@@ -594,6 +1543,8 @@ class GraphBuilder:
                 new_node, valid = self._gen_iterative_node(doc, node, deepcopy(new_node))
             else:
                 valid = False
+            if timed:
+                self._metrics.observe("e2n_node_seconds", perf_counter() - start, node=node['id'])
             if valid:
                 nodes.append(new_node)
             elif node['required']:
@@ -719,6 +1670,10 @@ class GraphBuilder:
         new_relationship["directionality"] = relationship["directionality"]
         if 'unique' in relationship:
             new_relationship["unique"] = relationship["unique"]
+        if relationship.get('rollup'):
+            new_relationship["rollup"] = relationship["rollup"]
+            if WEIGHT_KEY in doc:
+                new_relationship["weight"] = self._rollup_weight(doc[WEIGHT_KEY], relationship)
         for rel_node in ["sourceNode", "destinationNode"]:
             node_found = False
             for node in nodes:
@@ -762,6 +1717,10 @@ class GraphBuilder:
         valid_iter = True
         iterative_nodes = 0
         iterative_node = None
+        if relationship.get('rollup'):
+            new_relationship["rollup"] = relationship["rollup"]
+            if WEIGHT_KEY in doc:
+                new_relationship["weight"] = self._rollup_weight(doc[WEIGHT_KEY], relationship)
         for rel_node in ["sourceNode", "destinationNode"]:
             node_found = False
             for node in nodes:
@@ -855,27 +1814,34 @@ class GraphBuilder:
         """
         Loads processing modules from the processors folder. Checks each script in the for the required
         functions for each step. If the module has it then it is added to the appropriate list to be executed.
+        Modules that define set_memo are handed the shared memoization cache.
         :param pre: should pre-processing modules be loaded?
         :param post_node: should post node generation processing modules be loaded?
         :param post_relationship: should post relationship modules be loaded?
         """
+        if not (pre or post_node or post_relationship):
+            return
         base_url = 'processors'
         try:
             files = [f for f in listdir(base_url) if isfile(join(base_url, f))]
             for f in files:
                 if '.py' in f and '.pyc' not in f:
                     self._logger.debug('found potential processor: {}'.format(f))
-                    module = SourceFileLoader(f.strip('.py'), './{}/{}'.format(base_url, f)).load_module()
+                    module = SourceFileLoader(splitext(f)[0], './{}/{}'.format(base_url, f)).load_module()
+                    if MEMO_SETUP_FUNC in dir(module):
+                        module.set_memo(self._memo)
                     if pre:
-                        if all(func in dir(module) for func in REQUIRED_PRE_FUNC):
+                        if all(func in dir(module) for func in REQUIRED_PRE_FUNC) or BATCH_PRE_FUNC in dir(module):
                             self._logger.debug('loaded pre processor: {}'.format(f))
                             self._pre_modules.append(module)
                     if post_node:
-                        if all(func in dir(module) for func in REQUIRED_POST_NODE_FUNC):
+                        if all(func in dir(module) for func in REQUIRED_POST_NODE_FUNC) or \
+                                BATCH_POST_NODE_FUNC in dir(module):
                             self._logger.debug('loaded post node processor: {}'.format(f))
                             self._post_node_modules.append(module)
                     if post_relationship:
-                        if all(func in dir(module) for func in REQUIRED_POST_RELATIONSHIP_FUNC):
+                        if all(func in dir(module) for func in REQUIRED_POST_RELATIONSHIP_FUNC) or \
+                                BATCH_POST_RELATIONSHIP_FUNC in dir(module):
                             self._logger.debug('loaded post relationship processor: {}'.format(f))
                             self._post_relationship_modules.append(module)
 
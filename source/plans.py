@@ -0,0 +1,65 @@
+from source.writer import open_session
+import logging
+
+module_logger = logging.getLogger('elastic2neo.plans')
+module_logger.debug("module loaded")
+
+# What to do when a statement shape plans badly: skip the check, log a warning or stop before the run
+PLAN_CHECK_MODES = ['off', 'warn', 'fail']
+
+# Operators that read every node (with a label) instead of seeking an index
+SCAN_OPERATORS = ['NodeByLabelScan', 'AllNodesScan']
+CARTESIAN_PRODUCT = 'CartesianProduct'
+
+
+def explain(driver, statement, parameters=None, database=None):
+    """
+    Plans a statement with EXPLAIN without running it.
+    :param driver: the Neo4j driver
+    :param statement: the Cypher statement
+    :param parameters: the statement parameters
+    :param database: the database the statement is planned on, None for the default database of the server
+    :return: the root Plan of the statement
+    """
+    with open_session(driver, database) as session:
+        return session.run("EXPLAIN {}".format(statement), parameters or dict()).summary().plan
+
+
+def _operator(plan):
+    """
+    Gets the operator name of a plan without the runtime suffix (e.g. NodeByLabelScan@neo4j).
+    :param plan: the Plan
+    :return: operator name
+    """
+    return plan.operator_type.split("@")[0]
+
+
+def _leaves(plan):
+    """
+    Collects the leaf operators of a plan.
+    :param plan: the Plan
+    :return: list of leaf Plans
+    """
+    if not plan.children:
+        return [plan]
+    return [leaf for child in plan.children for leaf in _leaves(child)]
+
+
+def flagged_operators(plan):
+    """
+    Finds the operators of a plan that scan nodes. A CartesianProduct is only flagged when one of its inputs is not an
+    index seek, since matching the source and destination node of a relationship by two seeks is expected.
+    :param plan: the root Plan
+    :return: list of flagged operator names
+    """
+    if plan is None:
+        return list()
+    flagged = list()
+    operator = _operator(plan)
+    if operator in SCAN_OPERATORS:
+        flagged.append(operator)
+    elif operator == CARTESIAN_PRODUCT and not all("Seek" in _operator(leaf) for leaf in _leaves(plan)):
+        flagged.append(operator)
+    for child in plan.children:
+        flagged.extend(flagged_operators(child))
+    return flagged
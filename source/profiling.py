@@ -0,0 +1,88 @@
+from source.metrics import Metrics
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+from os import makedirs
+from os.path import join
+import cProfile
+import logging
+
+module_logger = logging.getLogger('elastic2neo.profiling')
+module_logger.debug("module loaded")
+
+DEFAULT_DUMP_DIR = "profiles"
+DEFAULT_TOP = 20
+
+
+class Profiler:
+    def __init__(self, metrics=None, sample_every=0, dump_dir=DEFAULT_DUMP_DIR, top=DEFAULT_TOP):
+        """
+        Times every processor call and samples batches with cProfile. Stage timings are taken from the metrics.
+        :param metrics: the Metrics object holding the stage latency histograms
+        :param sample_every: write a cProfile dump for every Nth batch, 0 disables the dumps
+        :param dump_dir: the directory pstats dumps are written to
+        :param top: how many entries are shown in the report
+        """
+        self._logger = logging.getLogger('elastic2neo.profiling.Profiler')
+        self._metrics = metrics if metrics else Metrics()
+        self._sample_every = sample_every
+        self._dump_dir = dump_dir
+        self._top = top
+        self._lock = Lock()
+        self._timings = dict()
+        self._batches = 0
+
+    @contextmanager
+    def time(self, name):
+        """
+        Context manager that records one call of the named processor.
+        :param name: the processor name, e.g. module.function
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - start
+            with self._lock:
+                calls, total, slowest = self._timings.get(name, (0, 0.0, 0.0))
+                self._timings[name] = (calls + 1, total + elapsed, max(slowest, elapsed))
+
+    @contextmanager
+    def batch(self):
+        """
+        Context manager wrapped around each batch, sampled batches are profiled with cProfile and dumped.
+        """
+        self._batches += 1
+        if not self._sample_every or self._batches % self._sample_every:
+            yield
+            return
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            makedirs(self._dump_dir, exist_ok=True)
+            path = join(self._dump_dir, "batch-{:06d}.pstats".format(self._batches))
+            profile.dump_stats(path)
+            self._logger.info("wrote profile of batch {} to {}".format(self._batches, path))
+
+    def report(self):
+        """
+        Creates the ranked report of the slowest processors and stages by total time.
+        :return: report string
+        """
+        rows = list()
+        with self._lock:
+            for name, (calls, total, slowest) in self._timings.items():
+                rows.append(("processor", name, calls, total, slowest))
+        for labels, count, total in self._metrics.histogram_totals("e2n_stage_seconds"):
+            rows.append(("stage", labels["stage"], count, total, None))
+        rows.sort(key=lambda row: row[3], reverse=True)
+        lines = ["{:<10}{:<50}{:>10}{:>14}{:>14}{:>14}".format("kind", "name", "calls", "total s", "mean ms",
+                                                               "max ms")]
+        for kind, name, calls, total, slowest in rows[:self._top]:
+            lines.append("{:<10}{:<50}{:>10}{:>14.3f}{:>14.3f}{:>14}".format(
+                kind, name, calls, total, total / calls * 1000 if calls else 0,
+                "{:.3f}".format(slowest * 1000) if slowest is not None else "-"))
+        return "\n".join(lines)
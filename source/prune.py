@@ -0,0 +1,111 @@
+from source.metrics import Metrics
+from source.writer import open_session
+from source.routing import DEFAULT_TARGET
+from time import monotonic
+import logging
+
+module_logger = logging.getLogger('elastic2neo.prune')
+module_logger.debug("module loaded")
+
+DEFAULT_LAST_SEEN_PROPERTY = "e2nLastSeen"
+DEFAULT_PRUNE_INTERVAL = 3600
+DEFAULT_PRUNE_BATCH_SIZE = 10000
+DEFAULT_PRUNE_MAX_SECONDS = 60
+
+
+class Pruner:
+    def __init__(self, driver, labels=None, types=None, last_seen=DEFAULT_LAST_SEEN_PROPERTY,
+                 interval=DEFAULT_PRUNE_INTERVAL, batch_size=DEFAULT_PRUNE_BATCH_SIZE,
+                 max_seconds=DEFAULT_PRUNE_MAX_SECONDS, metrics=None, targets=None):
+        """
+        Deletes the nodes and relationships whose last seen stamp is older than their retention. Each batch of at most
+        batch_size elements is deleted in its own transaction and a run stops after max_seconds, leaving the rest to
+        the next run, so pruning never holds a large transaction or keeps the writes waiting for long.
+        :param driver: the Neo4j driver
+        :param labels: dictionary of node label to retention in seconds
+        :param types: dictionary of relationship type to retention in seconds
+        :param last_seen: the property the builder stamps with the time of the last write in epoch milliseconds
+        :param interval: the minimum seconds between runs
+        :param batch_size: the maximum number of elements deleted per transaction
+        :param max_seconds: the time budget of a run, checked between batches
+        :param metrics: the Metrics object deletions are counted in
+        :param targets: list of tuples of the name, driver and database of the routing targets pruned as well, their
+        drivers are closed by their owner
+        """
+        self._logger = logging.getLogger('elastic2neo.prune.Pruner')
+        self._driver = driver
+        self._stores = [(DEFAULT_TARGET, driver, None)] + list(targets if targets else list())
+        self._labels = labels if labels else dict()
+        self._types = types if types else dict()
+        self._last_seen = last_seen
+        self._interval = interval
+        self._batch_size = batch_size
+        self._max_seconds = max_seconds
+        self._metrics = metrics if metrics else Metrics()
+        self._next = 0.0
+
+    def maybe_run(self):
+        """
+        Runs the pruning if the interval has passed since the last run.
+        :return: the number of elements deleted
+        """
+        if monotonic() < self._next:
+            return 0
+        return self.run()
+
+    def run(self):
+        """
+        Prunes the relationships and then the nodes of every configured type and label in every store. The cutoff is
+        taken from the server clock, the same clock the stamps are written with.
+        :return: the number of elements deleted
+        """
+        start = monotonic()
+        self._next = start + self._interval
+        deadline = start + self._max_seconds
+        deleted = 0
+        with self._metrics.time("e2n_stage_seconds", stage="prune"):
+            # Relationships first so the nodes left behind are deleted with fewer relationships attached
+            for target, driver, database in self._stores:
+                for rel_type, retention in self._types.items():
+                    statement = "MATCH ()-[e:{}]->() WHERE e.{} < timestamp() - $retention WITH e LIMIT $limit " \
+                                "DELETE e RETURN count(*) AS deleted".format(rel_type, self._last_seen)
+                    deleted += self._prune(driver, database, statement, retention, deadline, kind="relationship",
+                                           element=rel_type, target=target)
+                for label, retention in self._labels.items():
+                    statement = "MATCH (e:{}) WHERE e.{} < timestamp() - $retention WITH e LIMIT $limit " \
+                                "DETACH DELETE e RETURN count(*) AS deleted".format(label, self._last_seen)
+                    deleted += self._prune(driver, database, statement, retention, deadline, kind="node",
+                                           element=label, target=target)
+        self._logger.info("pruned {} stale nodes and relationships in {:.1f} seconds".format(deleted,
+                                                                                             monotonic() - start))
+        return deleted
+
+    def _prune(self, driver, database, statement, retention, deadline, **labels):
+        """
+        Deletes batches until a batch comes back short or the time budget is spent.
+        :param driver: the Neo4j driver of the store
+        :param database: the database of the store, None for the default database of the server
+        :param statement: the batch delete statement
+        :param retention: the retention in seconds
+        :param deadline: the monotonic time the run has to stop by
+        :param labels: labels of the deleted counter series
+        :return: the number of elements deleted
+        """
+        parameters = {"retention": int(retention * 1000), "limit": self._batch_size}
+        deleted = 0
+        while monotonic() < deadline:
+            with open_session(driver, database) as session:
+                count = session.write_transaction(lambda tx: tx.run(statement, parameters).single()["deleted"])
+            deleted += count
+            self._metrics.inc("e2n_pruned_total", count, **labels)
+            if count < self._batch_size:
+                return deleted
+        self._logger.info("prune time budget spent, continuing {} {} of {} next run".format(
+            labels["kind"], labels["element"], labels["target"]))
+        return deleted
+
+    def close(self):
+        """
+        Close the pruning driver.
+        """
+        self._driver.close()
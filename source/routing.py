@@ -0,0 +1,193 @@
+from source.metrics import Metrics
+from collections import OrderedDict
+from queue import Queue
+from threading import Thread
+import logging
+
+module_logger = logging.getLogger('elastic2neo.routing')
+module_logger.debug("module loaded")
+
+# The target everything no route matches is written to, the connection and database of the neo config
+DEFAULT_TARGET = "default"
+DEFAULT_QUEUE_SIZE = 4
+
+
+class Router:
+    def __init__(self, routes):
+        """
+        Decides which target each node and relationship is written to. A node goes to the first route that lists one
+        of its labels, a relationship to the route that lists its type or else to the target of its source node.
+        Whatever no route matches goes to the default target.
+        :param routes: list of route dictionaries with the target name and its labels and types
+        """
+        self._logger = logging.getLogger('elastic2neo.routing.Router')
+        self._labels = [(route['name'], set(route.get('labels') or list())) for route in routes]
+        self._types = dict()
+        for route in routes:
+            for rel_type in route.get('types') or list():
+                self._types.setdefault(rel_type, route['name'])
+
+    def node_target(self, labels):
+        """
+        Gets the target of a node.
+        :param labels: the labels of the node
+        :return: the target name
+        """
+        for name, route_labels in self._labels:
+            if route_labels.intersection(labels):
+                return name
+        return DEFAULT_TARGET
+
+    def relationship_target(self, relationship):
+        """
+        Gets the target of a relationship.
+        :param relationship: the relationship as generated by the builder
+        :return: the target name
+        """
+        if relationship['type'] in self._types:
+            return self._types[relationship['type']]
+        return self.node_target(relationship['sourceNode']['labels'])
+
+    def shape_target(self, mapping, shape):
+        """
+        Gets the target of a statement shape of the mapping.
+        :param mapping: mapping as a dictionary
+        :param shape: a mapping node id or relationship type
+        :return: the target name
+        """
+        nodes = {node['id']: node for node in mapping['nodes']}
+        if shape in nodes:
+            return self.node_target(nodes[shape]['labels'])
+        for relationship in mapping['relationships']:
+            if relationship['type'] == shape:
+                return self._types.get(shape, self.node_target(nodes[relationship['sourceNode']]['labels']))
+        return DEFAULT_TARGET
+
+    def split(self, nodes, relationships):
+        """
+        Splits a chunk into the part of every target.
+        :param nodes: The list of nodes
+        :param relationships: The list of relationships
+        :return: ordered dictionary of target name to a tuple of its nodes and relationships
+        """
+        parts = OrderedDict()
+        for node in nodes:
+            parts.setdefault(self.node_target(node['labels']), (list(), list()))[0].append(node)
+        for relationship in relationships:
+            parts.setdefault(self.relationship_target(relationship), (list(), list()))[1].append(relationship)
+        return parts
+
+    @staticmethod
+    def validate(mapping, routes, uri=None):
+        """
+        Checks that the target names are unique, that every target is a different database than the default target
+        and the other targets, and that every relationship of the mapping is routed to the target of both its nodes, a
+        relationship cannot be written to a database its nodes are not in.
+        :param mapping: mapping as a dictionary
+        :param routes: list of route dictionaries with the target name, its labels and types and its uri and database
+        :param uri: the uri of the default target, routes without a uri connect to it
+        :return: list of problem descriptions, empty if the routes are valid
+        """
+        problems = list()
+        names = [route.get('name') for route in routes]
+        for name in names:
+            if not name or name == DEFAULT_TARGET or names.count(name) > 1:
+                problems.append("target names must be unique and not empty or {}: {}".format(DEFAULT_TARGET, name))
+        stores = {(uri, None): DEFAULT_TARGET}
+        for route in routes:
+            store = (route.get('uri', uri), route.get('database'))
+            if store in stores:
+                problems.append("target {} writes to the same server and database as target {}: {}{}".format(
+                    route.get('name'), stores[store], store[0], "/" + store[1] if store[1] else ""))
+            else:
+                stores[store] = route.get('name')
+        router = Router(routes)
+        nodes = {node['id']: node for node in mapping['nodes']}
+        for relationship in mapping['relationships']:
+            source = router.node_target(nodes[relationship['sourceNode']]['labels'])
+            destination = router.node_target(nodes[relationship['destinationNode']]['labels'])
+            target = router._types.get(relationship['type'], source)
+            if not source == destination == target:
+                problems.append("relationship {} is routed to {} but its source node {} is routed to {} and its "
+                                "destination node {} to {}".format(relationship['type'], target,
+                                                                   relationship['sourceNode'], source,
+                                                                   relationship['destinationNode'], destination))
+        return problems
+
+
+class Target:
+    def __init__(self, name, driver, writer, row_writer=None, database=None, queue_size=DEFAULT_QUEUE_SIZE,
+                 metrics=None):
+        """
+        A database the router writes to with its own driver (connection pool) and writers. Chunks are queued and
+        written in order by a thread of the target, so the targets are written in parallel while a slow target only
+        holds up the producer once its queue is full.
+        :param name: the target name
+        :param driver: the Neo4j driver of the target
+        :param writer: the StatementWriter of the target
+        :param row_writer: the RowWriter of the target in server write mode
+        :param database: the database sessions are opened on, None for the default database of the server
+        :param queue_size: how many chunks may wait to be written
+        :param metrics: the Metrics object the chunks written are counted in
+        """
+        self._logger = logging.getLogger('elastic2neo.routing.Target')
+        self.name = name
+        self.driver = driver
+        self.writer = writer
+        self.row_writer = row_writer
+        self.database = database
+        # The last page written, for logging only, it is not persisted and a restart resumes through fingerprints
+        self.last_page = 0
+        self._metrics = metrics if metrics else Metrics()
+        self._queue = Queue(maxsize=queue_size)
+        self._error = None
+        self._thread = Thread(target=self._run, name="target-{}".format(name), daemon=True)
+        self._thread.start()
+
+    def submit(self, function, *args):
+        """
+        Queues a write, blocking while the queue is full.
+        :param function: the function that writes the chunk
+        :param args: the arguments of the function
+        """
+        self._queue.put((function, args))
+
+    def _run(self):
+        """
+        Writes the queued chunks until close is called. After a failure the rest of the queue is dropped until the
+        failure has been reported by wait.
+        """
+        while 1:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                if self._error is None:
+                    function, args = job
+                    with self._metrics.time("e2n_target_seconds", target=self.name):
+                        function(*args)
+                    self._metrics.inc("e2n_target_chunks_total", target=self.name)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def wait(self, page):
+        """
+        Blocks until the queued chunks are written and records the page as the last one written.
+        :param page: the number of the page the chunks belong to
+        """
+        self._queue.join()
+        if self._error is not None:
+            error, self._error = self._error, None
+            self._logger.error("target {} failed after page {}: {}".format(self.name, self.last_page, error))
+            raise error
+        self.last_page = page
+
+    def close(self):
+        """
+        Stops the thread of the target after the queued chunks are written.
+        """
+        self._queue.put(None)
+        self._thread.join()
+        self._logger.info("target {} wrote through page {}".format(self.name, self.last_page))
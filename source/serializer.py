@@ -0,0 +1,125 @@
+from elasticsearch import __version__ as ELASTICSEARCH_VERSION
+from elasticsearch.connection import Urllib3HttpConnection
+from elasticsearch.exceptions import ConnectionError, ConnectionTimeout, SSLError, SerializationError
+from elasticsearch.serializer import JSONSerializer
+from elasticsearch.compat import urlencode
+from urllib3.exceptions import ReadTimeoutError, SSLError as UrllibSSLError
+from urllib3.util.retry import Retry
+from source.metrics import Metrics
+from time import perf_counter
+import logging
+import json
+
+module_logger = logging.getLogger('elastic2neo.serializer')
+module_logger.debug("module loaded")
+
+# Supported JSON decoders, auto picks the fastest one that is installed
+JSON_DECODERS = ['auto', 'orjson', 'ujson', 'json']
+
+# The client version BytesHttpConnection.perform_request was copied from, other versions use the default connection
+BYTES_CONNECTION_CLIENT_VERSION = (7, 6, 0)
+
+
+def load_decoder(name='auto'):
+    """
+    Finds the loads function of a JSON decoder, falling back to the standard library when it is not installed.
+    :param name: one of JSON_DECODERS
+    :return: tuple of the name of the decoder used and its loads function
+    """
+    if name not in JSON_DECODERS:
+        raise ValueError("unknown JSON decoder {}, expected one of: {}".format(name, ", ".join(JSON_DECODERS)))
+    candidates = ['orjson', 'ujson'] if name == 'auto' else [name]
+    for candidate in candidates:
+        if candidate == 'json':
+            break
+        try:
+            module = __import__(candidate)
+            return candidate, module.loads
+        except ImportError:
+            if name != 'auto':
+                module_logger.warning("{} is not installed, falling back to json".format(candidate))
+    return 'json', json.loads
+
+
+class FastJSONSerializer(JSONSerializer):
+    def __init__(self, decoder='auto', metrics=None):
+        """
+        Elasticsearch client serializer that decodes responses with orjson or ujson when installed. Responses are
+        accepted as bytes so they can be decoded without first being copied into a string. Encoding of requests is
+        left to the standard serializer.
+        :param decoder: one of JSON_DECODERS
+        :param metrics: the Metrics object decode latency is recorded in
+        """
+        self._logger = logging.getLogger('elastic2neo.serializer.FastJSONSerializer')
+        self._metrics = metrics if metrics else Metrics()
+        self.decoder, self._loads = load_decoder(decoder)
+        self._logger.info("decoding Elasticsearch responses with {}".format(self.decoder))
+
+    def loads(self, s):
+        start = perf_counter()
+        try:
+            return self._loads(s)
+        except (ValueError, TypeError) as e:
+            raise SerializationError(s, e)
+        finally:
+            self._metrics.observe("e2n_stage_seconds", perf_counter() - start, stage="decode")
+
+
+def connection_class():
+    """
+    Picks the connection class of the Elasticsearch client. BytesHttpConnection copies the request handling of the
+    client it was written against, so it is only used with that exact client version.
+    :return: BytesHttpConnection or the default Urllib3HttpConnection
+    """
+    if tuple(ELASTICSEARCH_VERSION) != BYTES_CONNECTION_CLIENT_VERSION:
+        module_logger.warning("elasticsearch client {} is not {}, responses are decoded to strings before the JSON "
+                              "decoder".format(".".join(map(str, ELASTICSEARCH_VERSION)),
+                                               ".".join(map(str, BYTES_CONNECTION_CLIENT_VERSION))))
+        return Urllib3HttpConnection
+    return BytesHttpConnection
+
+
+class BytesHttpConnection(Urllib3HttpConnection):
+    """
+    Urllib3 connection that hands JSON response bodies to the serializer as the raw bytes instead of decoding them to
+    a string first. Other responses and errors are handled the same as the default connection. The request handling is
+    a copy of the elasticsearch 7.6.0 client's, use connection_class to pick it.
+    """
+
+    def perform_request(self, method, url, params=None, body=None, timeout=None, ignore=(), headers=None):
+        url = self.url_prefix + url
+        if params:
+            url = "%s?%s" % (url, urlencode(params))
+        full_url = self.host + url
+
+        start = perf_counter()
+        orig_body = body
+        try:
+            kw = {}
+            if timeout:
+                kw["timeout"] = timeout
+            request_headers = self.headers.copy()
+            request_headers.update(headers or ())
+            if self.http_compress and body:
+                body = self._gzip_compress(body)
+                request_headers["content-encoding"] = "gzip"
+            response = self.pool.urlopen(method, url, body, retries=Retry(False), headers=request_headers, **kw)
+            duration = perf_counter() - start
+            raw_data = response.data
+        except Exception as e:
+            self.log_request_fail(method, full_url, url, orig_body, perf_counter() - start, exception=e)
+            if isinstance(e, UrllibSSLError):
+                raise SSLError("N/A", str(e), e)
+            if isinstance(e, ReadTimeoutError):
+                raise ConnectionTimeout("TIMEOUT", str(e), e)
+            raise ConnectionError("N/A", str(e), e)
+
+        failed = not (200 <= response.status < 300) and response.status not in ignore
+        if failed or not response.headers.get("content-type", "").startswith(JSONSerializer.mimetype):
+            raw_data = raw_data.decode("utf-8")
+        if failed:
+            self.log_request_fail(method, full_url, url, orig_body, duration, response.status, raw_data)
+            self._raise_error(response.status, raw_data)
+
+        self.log_request_success(method, full_url, url, orig_body, response.status, raw_data, duration)
+        return response.status, response.getheaders(), raw_data
@@ -0,0 +1,126 @@
+from source.metrics import Metrics
+from threading import Thread, Event, Lock
+from socket import gethostname
+from os import getpid
+from time import sleep
+from uuid import uuid4
+import logging
+
+module_logger = logging.getLogger('elastic2neo.workers')
+module_logger.debug("module loaded")
+
+DEFAULT_SLICES = 8
+DEFAULT_LEASE_SECONDS = 120
+DEFAULT_IDLE_SECONDS = 30
+
+
+class Worker:
+    def __init__(self, scroller, builder, store, job, slices=DEFAULT_SLICES, lease_seconds=DEFAULT_LEASE_SECONDS,
+                 idle_seconds=DEFAULT_IDLE_SECONDS, metrics=None):
+        """
+        One of several cooperating processes that split an index into sliced scrolls (work units). A worker claims a
+        unit through a lease in the shared store, renews the lease in the background while it works, checkpoints the
+        number of documents written after every page and marks the unit done at the end. Units whose lease expired
+        because their worker died are claimed again and resumed after their checkpoint.
+        :param scroller: the ElasticScroller the units are scrolled with
+        :param builder: the GraphBuilder the documents are written with
+        :param store: the FileLeaseStore or Neo4jLeaseStore shared by the workers
+        :param job: the name that identifies the units of this index in the store
+        :param slices: the number of units the index is split into, must be the same for every worker
+        :param lease_seconds: how long a lease is valid without being renewed, it is renewed every third of this
+        :param idle_seconds: seconds to wait before looking for expired leases while other workers hold every unit
+        :param metrics: the Metrics object lease events are counted in
+        """
+        self._logger = logging.getLogger('elastic2neo.workers.Worker')
+        self._scroller = scroller
+        self._builder = builder
+        self._store = store
+        self._job = job
+        self._slices = slices
+        self._lease_seconds = lease_seconds
+        self._idle_seconds = idle_seconds
+        self._metrics = metrics if metrics else Metrics()
+        self._owner = "{}-{}-{}".format(gethostname(), getpid(), uuid4().hex[:8])
+        self._lock = Lock()
+
+    def run(self, execute=True):
+        """
+        Claims and works units until every unit of the job is done.
+        :param execute: Should the statements generated be executed against Neo4j?
+        """
+        self._logger.info("worker {} joining job {} of {} units".format(self._owner, self._job, self._slices))
+        while 1:
+            claimed = self._store.claim(self._job, self._slices, self._owner, self._lease_seconds)
+            if claimed is None:
+                remaining = self._store.remaining(self._job, self._slices)
+                if not remaining:
+                    break
+                self._logger.info("{} units are leased by other workers, waiting {} seconds".format(
+                    remaining, self._idle_seconds))
+                sleep(self._idle_seconds)
+                continue
+            unit, checkpoint, previous = claimed
+            self._metrics.inc("e2n_leases_claimed_total")
+            if previous:
+                self._metrics.inc("e2n_leases_reclaimed_total")
+                self._logger.warning("reclaimed unit {} from expired lease of {}, resuming after {} documents".format(
+                    unit, previous, checkpoint))
+            self._work(unit, checkpoint, execute)
+        self._logger.info("every unit of job {} is done".format(self._job))
+
+    def _work(self, unit, checkpoint, execute):
+        """
+        Scrolls a unit from its checkpoint while a background thread keeps the lease alive.
+        :param unit: the slice id
+        :param checkpoint: the number of documents of the unit already written
+        :param execute: Should the statements generated be executed against Neo4j?
+        """
+        lost = Event()
+        done = Event()
+        renewer = Thread(target=self._renew, args=(unit, lost, done), name="lease-{}".format(unit), daemon=True)
+        renewer.start()
+        position = 0
+        try:
+            for page in self._scroller.scroll_slice(unit, self._slices):
+                if lost.is_set():
+                    break
+                if position + len(page) > checkpoint:
+                    self._builder.build(page[max(0, checkpoint - position):], execute)
+                position += len(page)
+                if position > checkpoint:
+                    with self._lock:
+                        if not self._store.renew(self._job, unit, self._owner, self._lease_seconds, position):
+                            lost.set()
+                            break
+        finally:
+            done.set()
+            renewer.join()
+        if lost.is_set() or not self._store.complete(self._job, unit, self._owner):
+            self._metrics.inc("e2n_leases_lost_total")
+            self._logger.warning("lost the lease of unit {} to another worker, abandoning it".format(unit))
+            return
+        self._logger.info("completed unit {} ({} documents)".format(unit, position))
+
+    def _renew(self, unit, lost, done):
+        """
+        Renews the lease every third of the lease time until the unit is done or the lease is lost.
+        :param unit: the slice id
+        :param lost: event set when the lease has been taken over
+        :param done: event set when the unit is finished
+        """
+        while not done.wait(self._lease_seconds / 3):
+            try:
+                with self._lock:
+                    renewed = self._store.renew(self._job, unit, self._owner, self._lease_seconds)
+            except Exception as e:
+                self._logger.warning("could not renew the lease of unit {}: {}".format(unit, e))
+                continue
+            if not renewed:
+                lost.set()
+                return
+
+    def close(self):
+        """
+        Close the lease store.
+        """
+        self._store.close()
@@ -0,0 +1,247 @@
+import neo4j
+from neo4j import SessionExpired
+from neo4j.exceptions import TransientError, ServiceUnavailable, ConnectionExpired
+from source.metrics import Metrics
+import logging
+import json
+import random
+from datetime import datetime
+from time import sleep
+
+module_logger = logging.getLogger('elastic2neo.writer')
+module_logger.debug("module loaded")
+
+# Errors that are worth retrying, anything else is treated as a permanent failure of the batch
+TRANSIENT_ERRORS = (TransientError, ServiceUnavailable, SessionExpired, ConnectionExpired)
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_RETRY_BACKOFF = 0.5
+DEFAULT_MAX_BACKOFF = 30
+DEFAULT_DEAD_LETTER_FILE = "e2n_dead_letters.jsonl"
+DEFAULT_SERVER_BATCH_SIZE = 1000
+
+# Write modes, statements sends interpolated statements and server sends parameter rows batched by the server
+WRITE_MODES = ['statements', 'server']
+
+# Column returned by delta write statements, 0 when the content hash matched and the SET was skipped
+CHANGED_COLUMN = "e2nChanged"
+
+
+def supports_databases():
+    """
+    Checks whether the installed driver can open sessions on a named database. Drivers before 4.0 accept the database
+    argument but silently ignore it and write to the default database of the server.
+    :return: True if the driver honours the database of a session
+    """
+    return int(neo4j.__version__.split(".")[0]) >= 4
+
+
+def open_session(driver, database=None, **config):
+    """
+    Opens a session on the given database, the database argument is only passed when set. A database needs a driver
+    with multiple database support, older drivers would ignore it so that raises instead.
+    :param driver: the Neo4j driver
+    :param database: the database name, None for the default database of the server
+    :param config: further session configuration such as max_retry_time
+    :return: the session
+    """
+    if not database:
+        return driver.session(**config)
+    if not supports_databases():
+        raise ValueError("neo4j driver {} cannot open sessions on database {}, it needs driver 4.0 or "
+                         "later".format(neo4j.__version__, database))
+    return driver.session(database=database, **config)
+
+
+class StatementWriter:
+    def __init__(self, driver, batch_size=DEFAULT_BATCH_SIZE, max_retries=DEFAULT_MAX_RETRIES,
+                 retry_backoff=DEFAULT_RETRY_BACKOFF, max_backoff=DEFAULT_MAX_BACKOFF,
+                 dead_letter_file=DEFAULT_DEAD_LETTER_FILE, metrics=None, database=None):
+        """
+        Writes Cypher statements to Neo4j in batches. Transient errors are retried with jittered exponential backoff
+        and batches that fail permanently or run out of retries are bisected until the offending statements are
+        isolated, those statements are written to the dead letter file while the rest of the batch is committed.
+        :param driver: the Neo4j driver
+        :param batch_size: how many statements are executed in a single transaction
+        :param max_retries: how many times a batch is retried after a transient error
+        :param retry_backoff: the base delay in seconds between retries
+        :param max_backoff: the maximum delay in seconds between retries
+        :param dead_letter_file: the file that statements which cannot be executed are appended to
+        :param metrics: the Metrics object retries and dead letters are counted in
+        :param database: the database the statements are written to, None for the default database of the server
+        """
+        self._logger = logging.getLogger('elastic2neo.writer.StatementWriter')
+        self._driver = driver
+        self._batch_size = batch_size
+        self._max_retries = max_retries
+        self._retry_backoff = retry_backoff
+        self._max_backoff = max_backoff
+        self._dead_letter_file = dead_letter_file
+        self._metrics = metrics if metrics else Metrics()
+        self._database = database
+
+    @property
+    def batch_size(self):
+        """
+        How many statements are executed in a single transaction, the batches of a write commit one after another.
+        :return: the batch size
+        """
+        return self._batch_size
+
+    def write(self, statements):
+        """
+        Execute the given statements in batches.
+        :param statements: list of Cypher statement strings
+        """
+        for i in range(0, len(statements), self._batch_size):
+            self._write_batch(statements[i:i + self._batch_size])
+
+    def _write_batch(self, batch):
+        """
+        Commit the batch, bisecting it when it fails permanently or runs out of retries.
+        :param batch: list of Cypher statement strings
+        """
+        try:
+            skipped = self._commit(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                self._dead_letter(batch[0], e)
+            else:
+                self._logger.debug("batch of {} statements failed, bisecting: {}".format(len(batch), e))
+                middle = len(batch) // 2
+                self._write_batch(batch[:middle])
+                self._write_batch(batch[middle:])
+            return
+        if skipped:
+            self._metrics.inc("e2n_updates_skipped_total", skipped)
+
+    def _commit(self, batch):
+        """
+        Commit the batch in a single transaction, retrying transient errors. The driver's own transaction retries are
+        turned off so the backoff and retry count here are the only ones.
+        :param batch: list of Cypher statement strings
+        :return: the number of delta writes that were skipped
+        """
+        attempt = 0
+        while True:
+            try:
+                with open_session(self._driver, self._database, max_retry_time=0) as session:
+                    return session.write_transaction(self._run_statements, batch)
+            except TRANSIENT_ERRORS as e:
+                if attempt >= self._max_retries:
+                    self._logger.error("giving up on batch after {} retries: {}".format(attempt, e))
+                    raise
+                delay = min(self._max_backoff, self._retry_backoff * 2 ** attempt)
+                delay = delay / 2 + random.uniform(0, delay / 2)
+                attempt += 1
+                self._metrics.inc("e2n_retries_total")
+                self._logger.warning("transient error, retry {} in {:.2f} seconds: {}".format(attempt, delay, e))
+                sleep(delay)
+
+    def _dead_letter(self, statement, error):
+        """
+        Append a statement that could not be executed to the dead letter file.
+        :param statement: the Cypher statement string
+        :param error: the exception raised by the statement
+        """
+        self._metrics.inc("e2n_dead_letters_total")
+        self._logger.error("statement failed and was dead lettered: {}".format(error))
+        self._logger.debug("dead lettered statement: {}".format(statement))
+        with open(self._dead_letter_file, 'a') as f:
+            f.write(json.dumps({"time": datetime.utcnow().isoformat(), "error": str(error),
+                                "statement": statement}) + "\n")
+
+    def _run_statements(self, tx, statements):
+        """
+        Execute the given statements in the provided transaction.
+        :param tx: the transaction
+        :param statements: list of Cypher statement strings
+        :return: the number of delta writes that were skipped
+        """
+        skipped = 0
+        for statement in statements:
+            self._logger.debug("executing statement: {}".format(statement))
+            record = tx.run(statement).single()
+            self._logger.debug('execution result: {}'.format(record))
+            if record is not None and CHANGED_COLUMN in record.keys() and not record[CHANGED_COLUMN]:
+                skipped += 1
+        return skipped
+
+
+class RowWriter:
+    def __init__(self, driver, batch_size=DEFAULT_SERVER_BATCH_SIZE, metrics=None, database=None):
+        """
+        Writes parameter rows with UNWIND and lets the server commit them in chunks. The strategy is chosen from the
+        server version when the writer is created: CALL { ... } IN TRANSACTIONS on Neo4j 4.4 and newer,
+        apoc.periodic.iterate on older servers with APOC installed, otherwise client side transactions of batch_size
+        rows.
+        :param driver: the Neo4j driver
+        :param batch_size: how many rows are committed in each transaction
+        :param metrics: the Metrics object written rows are counted in
+        :param database: the database the rows are written to, None for the default database of the server
+        """
+        self._logger = logging.getLogger('elastic2neo.writer.RowWriter')
+        self._driver = driver
+        self._batch_size = batch_size
+        self._metrics = metrics if metrics else Metrics()
+        self._database = database
+        self.mode = self._detect_mode()
+        self._logger.info("server side batching mode: {}".format(self.mode))
+
+    def _detect_mode(self):
+        """
+        Detects the batching strategy supported by the server.
+        :return: one of transactions, apoc or client
+        """
+        with open_session(self._driver, self._database) as session:
+            record = session.run("CALL dbms.components() YIELD name, versions "
+                                 "WHERE name = 'Neo4j Kernel' RETURN versions[0] AS version").single()
+            version = record["version"] if record else "0"
+            self._logger.info("connected to Neo4j {}".format(version))
+            numbers = [int(part) for part in version.split("-")[0].split(".")[:2] if part.isdigit()]
+            if tuple(numbers) >= (4, 4):
+                return "transactions"
+            try:
+                session.run("RETURN apoc.version() AS version").single()
+                return "apoc"
+            except Exception as e:
+                self._logger.debug("apoc is not available: {}".format(e))
+                return "client"
+
+    def write(self, template, rows):
+        """
+        Write the rows using the given statement template, the template refers to each row as "row".
+        :param template: the Cypher statement executed for every row
+        :param rows: list of parameter rows
+        """
+        self._logger.debug("writing {} rows with template: {}".format(len(rows), template))
+        if self.mode == "transactions":
+            with open_session(self._driver, self._database) as session:
+                session.run("UNWIND $rows AS row CALL {{ WITH row {} }} IN TRANSACTIONS OF {} ROWS".format(
+                    template, self._batch_size), {"rows": rows}).consume()
+        elif self.mode == "apoc":
+            with open_session(self._driver, self._database) as session:
+                record = session.run("CALL apoc.periodic.iterate('UNWIND $rows AS row RETURN row', $action, "
+                                     "{batchSize: $batchSize, params: {rows: $rows}}) "
+                                     "YIELD failedBatches, errorMessages RETURN failedBatches, errorMessages",
+                                     {"rows": rows, "action": template, "batchSize": self._batch_size}).single()
+                if record and record["failedBatches"]:
+                    raise RuntimeError("{} batches failed: {}".format(record["failedBatches"],
+                                                                      record["errorMessages"]))
+        else:
+            with open_session(self._driver, self._database) as session:
+                for i in range(0, len(rows), self._batch_size):
+                    session.write_transaction(self._run_rows, "UNWIND $rows AS row " + template,
+                                              rows[i:i + self._batch_size])
+        self._metrics.inc("e2n_rows_total", len(rows))
+
+    @staticmethod
+    def _run_rows(tx, statement, rows):
+        """
+        Execute the UNWIND statement with the given rows in the provided transaction.
+        :param tx: the transaction
+        :param statement: the UNWIND statement
+        :param rows: list of parameter rows
+        """
+        tx.run(statement, {"rows": rows}).consume()
@@ -0,0 +1,67 @@
+from source.aggregation import Aggregator, WEIGHT_KEY
+import json
+import unittest
+
+MAPPING = {
+    "index": "flows",
+    "nodes": [
+        {"id": "src", "nodeType": "standard", "required": True, "labels": ["host"],
+         "properties": {"ip": {"key": "src", "type": "string"}}, "uniqueProperties": ["ip"]},
+        {"id": "dst", "nodeType": "standard", "required": True, "labels": ["host"],
+         "properties": {"ip": {"key": "flow.dst", "type": "string"}}, "uniqueProperties": ["ip"]},
+        {"id": "port", "nodeType": "iterator", "required": False, "labels": ["port"], "iterator": "ports",
+         "properties": {"number": {"key": "ITER!", "type": "number"}}, "uniqueProperties": ["number"]}
+    ],
+    "relationships": [
+        {"type": "TALKS_TO", "relationshipType": "standard", "required": True, "directionality": ">",
+         "sourceNode": "src", "destinationNode": "dst",
+         "properties": {"seen": {"key": "ts", "type": "datetime"}, "bytes": {"key": "bytes", "type": "number"},
+                        "first": {"key": "first", "type": "datetime"}},
+         "rollup": {"timestamp": "seen", "aggregations": {"bytes": "sum"}}},
+        {"type": "USES", "relationshipType": "iterator", "required": False, "directionality": ">",
+         "sourceNode": "src", "destinationNode": "port", "rollup": True}
+    ]
+}
+
+
+class TestHit(unittest.TestCase):
+    def setUp(self):
+        self.aggregator = Aggregator(None, None, MAPPING)
+
+    def test_group_keys_and_metrics(self):
+        self.assertEqual(['first', 'flow.dst', 'ports', 'src'], self.aggregator._group_keys)
+        self.assertEqual({'bytes': ['sum'], 'ts': ['min', 'max']}, self.aggregator._metric_keys)
+
+    def test_bucket_becomes_weighted_document(self):
+        key = {"first": 1500000000000, "flow.dst": "b", "ports": 443, "src": "a"}
+        hit = self.aggregator._hit({"key": key, "doc_count": 3,
+                                    "min:ts": {"value": 1.5e12, "value_as_string": "2017-07-14T02:40:00.000Z"},
+                                    "max:ts": {"value": 1.6e12, "value_as_string": "2020-09-13T12:26:40.000Z"},
+                                    "sum:bytes": {"value": 30.0}})
+        self.assertEqual(json.dumps(key, sort_keys=True), hit["_id"])
+        source = hit["_source"]
+        self.assertEqual("a", source["src"])
+        self.assertEqual({"dst": "b"}, source["flow"])
+        self.assertEqual([443], source["ports"])
+        self.assertEqual("2017-07-14T02:40:00", source["first"])
+        # Integral doubles stay integers and the metric keys hold the last metric value
+        self.assertEqual(30, source["bytes"])
+        self.assertIsInstance(source["bytes"], int)
+        self.assertEqual("2020-09-13T12:26:40.000Z", source["ts"])
+        self.assertEqual({"count": 3, "sum": {"bytes": 30}, "min": {"ts": "2017-07-14T02:40:00.000Z"},
+                          "max": {"ts": "2020-09-13T12:26:40.000Z"}}, source[WEIGHT_KEY])
+
+    def test_missing_values_are_left_out(self):
+        hit = self.aggregator._hit({"key": {"first": None, "flow.dst": "b", "ports": None, "src": "a"},
+                                    "doc_count": 1, "min:ts": {"value": None}, "max:ts": {"value": None},
+                                    "sum:bytes": {"value": 2.5}})
+        source = hit["_source"]
+        self.assertNotIn("ports", source)
+        self.assertNotIn("first", source)
+        self.assertNotIn("ts", source)
+        self.assertEqual(2.5, source["bytes"])
+        self.assertEqual({"count": 1, "sum": {"bytes": 2.5}, "min": {}, "max": {}}, source[WEIGHT_KEY])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+from benchmarks.fakes import FakeDriver
+from source.neo import GraphBuilder
+import unittest
+
+MAPPING = {
+    "index": "people",
+    "nodes": [{"id": "person", "nodeType": "standard", "required": True, "labels": ["person"],
+               "properties": {"name": {"key": "name", "type": "string"}, "age": {"key": "age", "type": "number"}},
+               "uniqueProperties": ["name"], "requiredProperties": ["name"]}],
+    "relationships": []
+}
+
+
+class _RecordingRowWriter:
+    def __init__(self):
+        self.writes = list()
+
+    def write(self, template, rows):
+        self.writes.append((template, rows))
+
+
+class TestChangedRows(unittest.TestCase):
+    def _builder(self, unchanged, last_seen=None):
+        def respond(statement, parameters):
+            if statement.endswith("RETURN i"):
+                return [{"i": i} for i in unchanged]
+        self.driver = FakeDriver(record=True, respond=respond)
+        return GraphBuilder(None, None, None, MAPPING, pre=False, post_node=False, post_relationship=False,
+                            driver=self.driver, hash_property="e2nHash", last_seen=last_seen)
+
+    def _rows(self, builder):
+        docs = [{"_id": str(i), "_source": {"name": "p{}".format(i), "age": i}} for i in range(4)]
+        for nodes, relationships in builder._process(docs):
+            node_rows, relationship_rows = builder._gen_rows(nodes, relationships)
+            self.assertEqual(1, len(node_rows))
+            return list(node_rows.items())[0]
+
+    def test_unchanged_rows_are_dropped(self):
+        builder = self._builder([1, 3])
+        template, rows = self._rows(builder)
+        row_writer = _RecordingRowWriter()
+        builder._write_changed_rows(row_writer, template, rows)
+        self.assertEqual([(template, [rows[0], rows[2]])], row_writer.writes)
+        self.assertEqual(2, builder._metrics.total("e2n_updates_skipped_total"))
+        # The hash lookup is a read, nothing is committed by it
+        self.assertEqual(1, len(self.driver.recorded))
+        self.assertEqual([], self.driver.committed)
+        self.assertNotIn(" SET ", self.driver.recorded[0][0])
+        self.assertEqual({"rows": rows}, self.driver.recorded[0][1])
+
+    def test_unchanged_rows_are_only_stamped(self):
+        builder = self._builder([0], last_seen="e2nLastSeen")
+        template, rows = self._rows(builder)
+        row_writer = _RecordingRowWriter()
+        builder._write_changed_rows(row_writer, template, rows)
+        self.assertEqual(2, len(row_writer.writes))
+        self.assertEqual((template, rows[1:]), row_writer.writes[0])
+        stamp, stamped = row_writer.writes[1]
+        self.assertEqual([rows[0]], stamped)
+        self.assertTrue(stamp.startswith("MATCH (n:person"))
+        self.assertTrue(stamp.endswith("SET n.e2nLastSeen = timestamp()"))
+        self.assertNotIn("e2nHash", stamp)
+
+    def test_all_rows_changed(self):
+        builder = self._builder([])
+        template, rows = self._rows(builder)
+        row_writer = _RecordingRowWriter()
+        builder._write_changed_rows(row_writer, template, rows)
+        self.assertEqual([(template, rows)], row_writer.writes)
+        self.assertEqual(0, builder._metrics.total("e2n_updates_skipped_total"))
+
+    def test_templates_without_check_are_written_as_is(self):
+        builder = self._builder([0])
+        row_writer = _RecordingRowWriter()
+        builder._write_changed_rows(row_writer, "MERGE (n:other {id: row.id})", [{"id": 1}])
+        self.assertEqual([("MERGE (n:other {id: row.id})", [{"id": 1}])], row_writer.writes)
+        self.assertEqual([], self.driver.recorded)
+
+
+if __name__ == '__main__':
+    unittest.main()
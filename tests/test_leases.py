@@ -0,0 +1,54 @@
+from source.leases import FileLeaseStore
+import tempfile
+import shutil
+import unittest
+
+
+class TestFileLeaseStore(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store = FileLeaseStore(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_claims_free_units_in_order(self):
+        self.assertEqual((0, 0, None), self.store.claim("job", 2, "a", 60))
+        self.assertEqual((1, 0, None), self.store.claim("job", 2, "b", 60))
+        self.assertIsNone(self.store.claim("job", 2, "c", 60))
+
+    def test_owner_reclaims_its_own_unit(self):
+        self.assertEqual((0, 0, None), self.store.claim("job", 2, "a", 60))
+        self.assertEqual((0, 0, None), self.store.claim("job", 2, "a", 60))
+
+    def test_jobs_are_separate(self):
+        self.assertEqual((0, 0, None), self.store.claim("one", 1, "a", 60))
+        self.assertEqual((0, 0, None), self.store.claim("two", 1, "b", 60))
+
+    def test_expired_lease_is_taken_over_at_its_checkpoint(self):
+        self.store.claim("job", 1, "a", 60)
+        self.assertTrue(self.store.renew("job", 0, "a", -1, checkpoint=40))
+        self.assertEqual((0, 40, "a"), self.store.claim("job", 1, "b", 60))
+        # The previous owner lost the lease and can no longer renew or complete the unit
+        self.assertFalse(self.store.renew("job", 0, "a", 60))
+        self.assertFalse(self.store.complete("job", 0, "a"))
+
+    def test_renewed_lease_is_kept(self):
+        self.store.claim("job", 1, "a", -1)
+        self.assertTrue(self.store.renew("job", 0, "a", 60, checkpoint=10))
+        self.assertIsNone(self.store.claim("job", 1, "b", 60))
+
+    def test_done_units_are_not_claimed(self):
+        self.store.claim("job", 2, "a", 60)
+        self.assertTrue(self.store.complete("job", 0, "a"))
+        self.assertEqual((1, 0, None), self.store.claim("job", 2, "a", 60))
+        self.assertTrue(self.store.complete("job", 1, "a"))
+        self.assertIsNone(self.store.claim("job", 2, "b", -1))
+
+    def test_leases_are_shared_through_the_directory(self):
+        self.store.claim("job", 1, "a", 60)
+        self.assertIsNone(FileLeaseStore(self.path).claim("job", 1, "b", 60))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+from source.routing import Router, DEFAULT_TARGET
+import unittest
+
+MAPPING = {
+    "nodes": [{"id": "person", "labels": ["person"]}, {"id": "company", "labels": ["company"]},
+              {"id": "city", "labels": ["city"]}],
+    "relationships": [{"type": "WORKS_AT", "sourceNode": "person", "destinationNode": "company"},
+                      {"type": "LIVES_IN", "sourceNode": "person", "destinationNode": "city"}]
+}
+URI = "bolt://localhost:7687"
+
+
+def _node(label):
+    return {"labels": [label]}
+
+
+def _relationship(rel_type, source, destination):
+    return {"type": rel_type, "sourceNode": _node(source), "destinationNode": _node(destination)}
+
+
+class TestSplit(unittest.TestCase):
+    def test_nodes_and_relationships_follow_their_routes(self):
+        router = Router([{"name": "work", "labels": ["company"], "types": ["WORKS_AT"]},
+                         {"name": "places", "labels": ["city", "person"]}])
+        nodes = [_node("person"), _node("company"), _node("other"), _node("city")]
+        relationships = [_relationship("WORKS_AT", "person", "company"), _relationship("LIVES_IN", "person", "city"),
+                         _relationship("KNOWS", "other", "other")]
+        parts = router.split(nodes, relationships)
+        self.assertEqual(["places", "work", DEFAULT_TARGET], list(parts))
+        self.assertEqual(([nodes[0], nodes[3]], [relationships[1]]), parts["places"])
+        self.assertEqual(([nodes[1]], [relationships[0]]), parts["work"])
+        self.assertEqual(([nodes[2]], [relationships[2]]), parts[DEFAULT_TARGET])
+
+    def test_first_matching_route_wins(self):
+        router = Router([{"name": "a", "labels": ["person"]}, {"name": "b", "labels": ["person", "city"]}])
+        self.assertEqual("a", router.node_target(["city", "person"]))
+        self.assertEqual("b", router.node_target(["city"]))
+        self.assertEqual(DEFAULT_TARGET, router.node_target(["company"]))
+
+    def test_empty_chunk(self):
+        self.assertEqual(0, len(Router([{"name": "a", "labels": ["person"]}]).split([], [])))
+
+
+class TestValidate(unittest.TestCase):
+    def test_valid_routes(self):
+        routes = [{"name": "people", "labels": ["person", "company", "city"], "uri": URI, "database": "people"}]
+        self.assertEqual([], Router.validate(MAPPING, routes, URI))
+
+    def test_relationship_split_from_its_nodes(self):
+        routes = [{"name": "work", "labels": ["company"], "uri": "bolt://work:7687"}]
+        problems = Router.validate(MAPPING, routes, URI)
+        self.assertEqual(1, len(problems))
+        self.assertIn("WORKS_AT", problems[0])
+
+    def test_type_routed_away_from_its_nodes(self):
+        routes = [{"name": "lives", "types": ["LIVES_IN"], "uri": "bolt://lives:7687"}]
+        problems = Router.validate(MAPPING, routes, URI)
+        self.assertEqual(1, len(problems))
+        self.assertIn("LIVES_IN", problems[0])
+
+    def test_names_must_be_unique(self):
+        routes = [{"name": "a", "uri": "bolt://a:7687"}, {"name": "a", "uri": "bolt://b:7687"},
+                  {"name": DEFAULT_TARGET, "uri": "bolt://c:7687"}, {"name": None, "uri": "bolt://d:7687"}]
+        problems = Router.validate(MAPPING, routes, URI)
+        self.assertEqual(4, len([problem for problem in problems if problem.startswith("target names")]))
+
+    def test_targets_must_be_different_stores(self):
+        routes = [{"name": "a"}, {"name": "b", "uri": "bolt://b:7687", "database": "x"},
+                  {"name": "c", "uri": "bolt://b:7687", "database": "x"}, {"name": "d", "uri": "bolt://b:7687"}]
+        problems = Router.validate(MAPPING, routes, URI)
+        self.assertEqual(2, len(problems))
+        self.assertIn("target a writes to the same server and database as target {}".format(DEFAULT_TARGET),
+                      problems[0])
+        self.assertIn("target c writes to the same server and database as target b", problems[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
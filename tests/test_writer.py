@@ -0,0 +1,78 @@
+from benchmarks.fakes import FakeDriver
+from source.writer import StatementWriter
+from source.metrics import Metrics
+from neo4j.exceptions import TransientError
+import json
+import os
+import tempfile
+import shutil
+import unittest
+
+
+class TestBisection(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.dead_letter_file = os.path.join(self.path, "dead_letters.jsonl")
+        self.metrics = Metrics()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _writer(self, respond, batch_size=8, max_retries=2):
+        driver = FakeDriver(record=True, respond=respond)
+        writer = StatementWriter(driver, batch_size=batch_size, max_retries=max_retries, retry_backoff=0,
+                                 dead_letter_file=self.dead_letter_file, metrics=self.metrics)
+        return driver, writer
+
+    def _dead_letters(self):
+        if not os.path.exists(self.dead_letter_file):
+            return list()
+        with open(self.dead_letter_file) as f:
+            return [json.loads(line)["statement"] for line in f]
+
+    def test_failing_statements_are_isolated(self):
+        def respond(statement, parameters):
+            if statement.startswith("bad"):
+                raise ValueError("syntax error")
+        statements = ["good {}".format(i) for i in range(7)]
+        statements[2] = "bad 2"
+        statements[5] = "bad 5"
+        driver, writer = self._writer(respond)
+        writer.write(statements)
+        self.assertEqual(["bad 2", "bad 5"], self._dead_letters())
+        self.assertEqual([statement for statement in statements if statement.startswith("good")],
+                         [statement for statement, parameters in driver.committed])
+        self.assertEqual(2, self.metrics.total("e2n_dead_letters_total"))
+
+    def test_transient_errors_are_retried(self):
+        failures = {"flaky": 2}
+
+        def respond(statement, parameters):
+            if failures.get(statement):
+                failures[statement] -= 1
+                raise TransientError("deadlock")
+        driver, writer = self._writer(respond)
+        writer.write(["one", "flaky", "two"])
+        self.assertEqual([], self._dead_letters())
+        self.assertEqual(["one", "flaky", "two"], [statement for statement, parameters in driver.committed])
+        self.assertEqual(2, self.metrics.total("e2n_retries_total"))
+
+    def test_batches_out_of_retries_are_dead_lettered(self):
+        def respond(statement, parameters):
+            if statement == "locked":
+                raise TransientError("deadlock")
+        driver, writer = self._writer(respond, batch_size=4, max_retries=1)
+        writer.write(["one", "locked", "two", "three", "four"])
+        self.assertEqual(["locked"], self._dead_letters())
+        self.assertEqual(["one", "two", "three", "four"], [statement for statement, parameters in driver.committed])
+
+    def test_skipped_delta_writes_are_counted(self):
+        def respond(statement, parameters):
+            return [{"e2nChanged": 0 if "same" in statement else 1}]
+        driver, writer = self._writer(respond)
+        writer.write(["same 1", "new", "same 2"])
+        self.assertEqual(2, self.metrics.total("e2n_updates_skipped_total"))
+
+
+if __name__ == '__main__':
+    unittest.main()